@@ -1,25 +1,471 @@
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-from anthropic import Anthropic
+from anthropic import Anthropic, APIConnectionError, APIStatusError
 import os
+import re
+import gc
+import sys
+import mmap
 import json
+import random
+import asyncio
+import sqlite3
+import base64
+import struct
+import time
+import hashlib
+import tempfile
+import threading
+import unicodedata
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from collections.abc import Mapping, Sequence
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import asynccontextmanager, contextmanager
 import firebase_admin
 from firebase_admin import credentials, firestore
 import requests
+import httpx
+import click
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, parse_range_header, unquote_etag
+
+try:
+    import fcntl
+except ImportError:
+    # Windows ではスナップショットファイル更新のプロセス間ロックを使わない
+    fcntl = None
 
 app = Flask(__name__)
 CORS(app)
 
+# 処理段階ごとの計測（/metrics で Prometheus 形式で公開する）
+# 値はプロセスごと。gunicorn で複数ワーカーのときは各ワーカーの値がスクレイプのたびに返る
+METRICS_PREFIX = 'ai_kouki_'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class MetricTimer:
+    """with で囲んだ区間の秒数をヒストグラムに記録する"""
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Metrics:
+    """カウンターとヒストグラム（1回の記録はロック1回と bisect だけなので常時有効にしておける）"""
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.definitions = {}
+        # (名前, ラベル) -> カウンターの値 / バケットごとの件数 + [合計, 件数]
+        self.counters = {}
+        self.histograms = {}
+
+    def counter(self, name, help_text):
+        self.definitions[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.definitions[name] = ('histogram', help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.definitions[name][2]
+        index = bisect_left(buckets, value)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, name, **labels):
+        return MetricTimer(self, name, labels)
+
+    def render(self, extra=()):
+        """Prometheus のテキスト形式
+
+        extra はスクレイプ時に集める (名前, 種類, 説明, [(ラベル dict, 値), ...]) の並び。
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(series) for key, series in self.histograms.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            full_name = self.prefix + name
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            if kind == 'counter':
+                for (series_name, labels), value in counters.items():
+                    if series_name == name:
+                        lines.append(f'{full_name}{_format_labels(labels)} {value}')
+                continue
+            for (series_name, labels), series in histograms.items():
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), series):
+                    cumulative += count
+                    lines.append(f'{full_name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{full_name}_sum{_format_labels(labels)} {series[-2]}')
+                lines.append(f'{full_name}_count{_format_labels(labels)} {series[-1]}')
+
+        for name, kind, help_text, samples in extra:
+            full_name = self.prefix + name
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{full_name}{_format_labels(tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('http_request_seconds', 'リクエストの処理時間（ストリーミングはヘッダーを返すまで）')
+metrics.counter('http_requests_total', 'エンドポイント・ステータスごとのリクエスト数')
+metrics.counter('errors_total', '処理段階ごとのエラー数')
+metrics.histogram('blog_fetch_seconds', 'Firestore からの全記事の読み込み時間')
+metrics.histogram('blog_publish_seconds', '記事スナップショットの検索構造の構築時間')
+metrics.histogram('retrieval_seconds', 'ブログ検索の関数ごとの処理時間')
+metrics.histogram('blog_context_chars', 'プロンプトに付けたブログ記事コンテキストの文字数', SIZE_BUCKETS)
+metrics.histogram('upstream_seconds', '上流 API の呼び出し時間（ストリーミングは最初の応答まで）')
+metrics.histogram('tts_chunk_bytes', '音声合成チャンク1つ分の音声のバイト数', SIZE_BUCKETS)
+metrics.counter('tts_chunks_total', '合成した音声チャンク数（キャッシュからか上流からか）')
+metrics.counter('tts_response_bytes_total', '返した音声のバイト数（出力形式ごと）')
+metrics.counter('tts_bytes_saved_total', '既定の形式（128kbps MP3）のチャンクをそのままつないだ場合より減ったバイト数（見積もり）')
+
+@app.before_request
+def start_request_timer():
+    request.environ['ai_kouki.start'] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = request.environ.get('ai_kouki.start')
+    if start is not None and request.endpoint:
+        metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=request.endpoint)
+        metrics.inc('http_requests_total', endpoint=request.endpoint, status=response.status_code)
+    return response
+
+# 上流 API（Claude / ElevenLabs）ごとのレート制限・同時実行数・待ち行列の設定（プロセスごと）
+# rate は1秒あたりのリクエスト数、burst はまとめて出せる数、queue_timeout は枠を待つ最大秒数
+UPSTREAM_DEFAULTS = {
+    'claude': {'rate': 10.0, 'burst': 20, 'max_in_flight': 32, 'max_queue': 64, 'queue_timeout': 10.0, 'max_retries': 3},
+    'elevenlabs': {'rate': 20.0, 'burst': 20, 'max_in_flight': int(os.environ.get('TTS_MAX_WORKERS', 8)),
+                   'max_queue': 128, 'queue_timeout': 10.0, 'max_retries': 3}
+}
+# 再試行の待ち時間（base * 2^試行回数 を上限に一様乱数、cap 秒まで）
+UPSTREAM_BACKOFF_BASE = float(os.environ.get('UPSTREAM_BACKOFF_BASE', 0.25))
+UPSTREAM_BACKOFF_CAP = float(os.environ.get('UPSTREAM_BACKOFF_CAP', 4))
+
+metrics.histogram('upstream_wait_seconds', '上流 API の枠（レート・同時実行数）が空くまでの待ち時間')
+metrics.counter('upstream_retries_total', '上流 API の再試行回数')
+metrics.counter('upstream_rejected_total', '上流 API の枠を取れずに断ったリクエスト数（待ち行列あふれ・期限切れ・再試行切れ）')
+
+OVERLOAD_REASONS = {
+    'queue_full': '待ち行列がいっぱい',
+    'timeout': '待ち時間の上限を超過',
+    'retries': '再試行の上限に到達'
+}
+
+class UpstreamOverloaded(Exception):
+    """上流 API の枠が期限内に取れなかった（呼び出し側は 503 を返す）"""
+
+    def __init__(self, service, reason, retry_after=1):
+        super().__init__(f'{service} が混み合っています（{OVERLOAD_REASONS[reason]}）')
+        self.service = service
+        self.reason = reason
+        self.retry_after = retry_after
+
+class UpstreamLimiter:
+    """上流 API 1つ分のトークンバケット + 同時実行数の上限 + 期限付きの待ち行列
+
+    枠を待てるのは max_queue 件まで。それ以上来たら待たずに、期限までに枠が取れなければ
+    その時点で UpstreamOverloaded を送出する（リクエストを溜め込まない）。
+    """
+
+    def __init__(self, service, rate, burst, max_in_flight, max_queue, queue_timeout, max_retries):
+        self.service = service
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.in_flight = 0
+        self.queued = 0
+        self.counters = {'admitted': 0, 'waited': 0, 'rejected_queue_full': 0, 'rejected_timeout': 0,
+                         'rejected_retries': 0, 'retries': 0, 'max_queued': 0}
+
+    def _try_acquire(self, now):
+        """枠が取れたら 0、取れなければ次に空きそうになるまでの秒数（lock 内で呼ぶ）"""
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.in_flight >= self.max_in_flight:
+            return 0.05
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        self.counters['admitted'] += 1
+        return 0
+
+    def _enqueue(self):
+        if self.queued >= self.max_queue:
+            self.counters['rejected_queue_full'] += 1
+            metrics.inc('upstream_rejected_total', service=self.service, reason='queue_full')
+            raise UpstreamOverloaded(self.service, 'queue_full')
+        self.queued += 1
+        self.counters['waited'] += 1
+        self.counters['max_queued'] = max(self.counters['max_queued'], self.queued)
+
+    def _timed_out(self):
+        self.counters['rejected_timeout'] += 1
+        metrics.inc('upstream_rejected_total', service=self.service, reason='timeout')
+        return UpstreamOverloaded(self.service, 'timeout')
+
+    def deadline(self):
+        return time.monotonic() + self.queue_timeout
+
+    def acquire(self, deadline=None):
+        """枠が空くまで待つ（期限を過ぎたら UpstreamOverloaded）"""
+        deadline = deadline or self.deadline()
+        start = time.monotonic()
+        with self.condition:
+            wait_for = self._try_acquire(start)
+            if wait_for:
+                self._enqueue()
+                try:
+                    while wait_for:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._timed_out()
+                        self.condition.wait(min(wait_for, remaining))
+                        wait_for = self._try_acquire(time.monotonic())
+                finally:
+                    self.queued -= 1
+        metrics.observe('upstream_wait_seconds', time.monotonic() - start, service=self.service)
+
+    async def acquire_async(self, deadline=None):
+        """acquire の asyncio 版（イベントループは止めずに待つ）"""
+        deadline = deadline or self.deadline()
+        start = time.monotonic()
+        with self.condition:
+            wait_for = self._try_acquire(start)
+            if wait_for:
+                self._enqueue()
+        if wait_for:
+            try:
+                while wait_for:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        with self.condition:
+                            raise self._timed_out()
+                    await asyncio.sleep(min(wait_for, remaining))
+                    with self.condition:
+                        wait_for = self._try_acquire(time.monotonic())
+            finally:
+                with self.condition:
+                    self.queued -= 1
+        metrics.observe('upstream_wait_seconds', time.monotonic() - start, service=self.service)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def slot(self, deadline=None):
+        """ストリーミングなど、終わるまで枠を持ち続ける呼び出し用"""
+        self.acquire(deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, deadline=None):
+        await self.acquire_async(deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _backoff(self, attempt, retry_after, deadline):
+        """次の試行までの秒数（期限までにやり直せなければ None）"""
+        if attempt >= self.max_retries:
+            return None
+        delay = max(retry_after, random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * 2 ** attempt)))
+        if time.monotonic() + delay > deadline:
+            return None
+        with self.condition:
+            self.counters['retries'] += 1
+        metrics.inc('upstream_retries_total', service=self.service)
+        return delay
+
+    def _give_up(self, result):
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
+        with self.condition:
+            self.counters['rejected_retries'] += 1
+        metrics.inc('upstream_rejected_total', service=self.service, reason='retries')
+        return UpstreamOverloaded(self.service, 'retries')
+
+    def call(self, fn, retry_after, deadline=None):
+        """枠を取って fn() を呼ぶ
+
+        retry_after(結果, 例外) が秒数を返したら（429・5xx・接続エラーなど）、ジッター付きの
+        指数バックオフで待ってやり直す。None なら結果を返す（例外ならそのまま送出する）。
+        """
+        deadline = deadline or self.deadline()
+        attempt = 0
+        while True:
+            self.acquire(deadline)
+            result, error = None, None
+            try:
+                result = fn()
+            except Exception as e:
+                error = e
+            finally:
+                self.release()
+
+            hint = retry_after(result, error)
+            if hint is None:
+                if error is not None:
+                    raise error
+                return result
+            delay = self._backoff(attempt, hint, deadline)
+            if delay is None:
+                raise self._give_up(result) from error
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, fn, retry_after, deadline=None):
+        """call の asyncio 版（fn はコルーチンを返す関数）"""
+        deadline = deadline or self.deadline()
+        attempt = 0
+        while True:
+            await self.acquire_async(deadline)
+            result, error = None, None
+            try:
+                result = await fn()
+            except Exception as e:
+                error = e
+            finally:
+                self.release()
+
+            hint = retry_after(result, error)
+            if hint is None:
+                if error is not None:
+                    raise error
+                return result
+            delay = self._backoff(attempt, hint, deadline)
+            # やり直す応答は読まずに閉じる（httpx の非同期の応答は close ではなく aclose で閉じる）
+            aclose = getattr(result, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+                result = None
+            if delay is None:
+                raise self._give_up(result) from error
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self.condition:
+            return {**self.counters, 'in_flight': self.in_flight, 'queued': self.queued,
+                    'tokens': round(self.tokens, 2)}
+
+def create_upstream_limiter(service):
+    """UPSTREAM_<SERVICE>_<設定名> の環境変数で既定値を上書きして作る"""
+    settings = {
+        key: type(value)(os.environ.get(f'UPSTREAM_{service.upper()}_{key.upper()}', value))
+        for key, value in UPSTREAM_DEFAULTS[service].items()
+    }
+    return UpstreamLimiter(service, **settings)
+
+upstream_limiters = {service: create_upstream_limiter(service) for service in UPSTREAM_DEFAULTS}
+claude_limiter = upstream_limiters['claude']
+elevenlabs_limiter = upstream_limiters['elevenlabs']
+
+def _retry_after_header(headers):
+    try:
+        return float(headers.get('retry-after') or 0)
+    except ValueError:
+        return 0
+
+def claude_retry_after(result, error):
+    """Claude API の 429・5xx（529 の過負荷を含む）と接続エラーはやり直す"""
+    if isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500):
+        return _retry_after_header(error.response.headers)
+    if isinstance(error, APIConnectionError):
+        return 0
+    return None
+
+def http_retry_after(result, error):
+    """requests / httpx の応答の 429・5xx と接続エラーはやり直す"""
+    if error is not None:
+        return 0 if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)) else None
+    if result.status_code == 429 or result.status_code >= 500:
+        return _retry_after_header(result.headers)
+    return None
+
+def overloaded_response(e):
+    """UpstreamOverloaded を 503 の JSON にする"""
+    response = jsonify({'error': str(e), 'service': e.service, 'reason': e.reason})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# クライアントの初期化はスレッドをまたいで1度だけ
+client_init_lock = threading.Lock()
+
 # Anthropic クライアント初期化（遅延初期化）
 client = None
 
 def get_client():
     global client
     if client is None:
-        api_key = os.environ.get('ANTHROPIC_API_KEY')
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY is not set")
-        client = Anthropic(api_key=api_key)
+        with client_init_lock:
+            if client is None:
+                api_key = os.environ.get('ANTHROPIC_API_KEY')
+                if not api_key:
+                    raise ValueError("ANTHROPIC_API_KEY is not set")
+                # 再試行は claude_limiter で行うので SDK 側では行わない
+                client = Anthropic(api_key=api_key, max_retries=0)
     return client
 
 # Firebase 初期化（遅延初期化）
@@ -28,171 +474,1405 @@ db = None
 def get_firestore_db():
     global db
     if db is None:
-        firebase_creds = os.environ.get('FIREBASE_CREDENTIALS')
-        if not firebase_creds:
-            raise ValueError("FIREBASE_CREDENTIALS is not set")
-        cred_dict = json.loads(firebase_creds)
-        cred = credentials.Certificate(cred_dict)
-        firebase_admin.initialize_app(cred)
-        db = firestore.client()
+        with client_init_lock:
+            if db is None:
+                try:
+                    firebase_app = firebase_admin.get_app()
+                except ValueError:
+                    firebase_creds = os.environ.get('FIREBASE_CREDENTIALS')
+                    if not firebase_creds:
+                        raise ValueError("FIREBASE_CREDENTIALS is not set")
+                    cred_dict = json.loads(firebase_creds)
+                    cred = credentials.Certificate(cred_dict)
+                    firebase_app = firebase_admin.initialize_app(cred)
+                # firestore.client() はアプリごとに1つをキャッシュするので、fork 後に作り直せるよう直接作る
+                db = firestore.Client(project=firebase_app.project_id,
+                                      credentials=firebase_app.credential.get_credential())
     return db
 
+# 会話履歴の上限（セッション数・最終利用からの有効期限・1セッションあたりのトークン数）
+CHAT_MAX_SESSIONS = int(os.environ.get('CHAT_MAX_SESSIONS', 1000))
+CHAT_SESSION_TTL = int(os.environ.get('CHAT_SESSION_TTL', 6 * 60 * 60))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_TOKEN_BUDGET', 2000))
+# 古い発言を捨てるときに要約して残すか
+CHAT_HISTORY_SUMMARIZE = os.environ.get('CHAT_HISTORY_SUMMARIZE', '0') == '1'
+
+def estimate_tokens(text):
+    """トークン数の概算（英数字は4文字で1トークン、日本語は1文字1トークン程度）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+# 集計する Claude API の usage 項目（プロンプトキャッシュの読み込み・書き込みを含む）
+USAGE_KEYS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+# 会話履歴の保存先（memory: プロセス内 / sqlite: ワーカー間で共有し、再起動しても残る）
+CHAT_SESSION_BACKEND = os.environ.get('CHAT_SESSION_BACKEND', 'memory')
+CHAT_SESSION_DB = os.environ.get('CHAT_SESSION_DB', os.path.join(tempfile.gettempdir(), 'ai-kouki-sessions.sqlite3'))
+
+def _count_dropped(roles, tokens, total_tokens, token_budget):
+    """トークン予算に収めるため、古い方から捨てる発言の数
+
+    最新の発言は必ず残し、先頭が user の発言になるようにする。
+    """
+    dropped = 0
+    while len(roles) - dropped > 1 and (total_tokens > token_budget or roles[dropped] != 'user'):
+        total_tokens -= tokens[dropped]
+        dropped += 1
+    return dropped
+
+class SessionStore(ABC):
+    """セッションごとの会話履歴（保存先ごとにサブクラスで実装する）
+
+    セッション数が上限を超えたら最も長く使われていないものから、有効期限切れのものは捨てる。
+    各セッションの履歴は直近の発言からトークン予算に収まる分だけ残す。
+    """
+
+    def __init__(self, max_sessions, ttl, token_budget):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.lock = threading.Lock()
+        self.counters = {
+            'evicted_sessions': 0,
+            'expired_sessions': 0,
+            'truncated_messages': 0,
+            'requests': 0,
+            **{key: 0 for key in USAGE_KEYS}
+        }
+
+    @abstractmethod
+    def append(self, session_id, role, content):
+        """発言を追加し、トークン予算からあふれて捨てた古い発言を返す"""
+
+    @abstractmethod
+    def get_history(self, session_id):
+        """Claude に渡す発言の一覧と、それより前の会話の要約を返す"""
+
+    @abstractmethod
+    def has_history(self, session_id):
+        """このセッションに発言（または要約）が残っているか"""
+
+    @abstractmethod
+    def set_summary(self, session_id, summary):
+        """捨てた発言の要約を保存する（以降の get_history で返す）"""
+
+    @abstractmethod
+    def __len__(self):
+        """保存しているセッション数"""
+
+    def record_usage(self, usage):
+        """Claude API の usage を集計し、このリクエスト分を dict で返す"""
+        tokens = {key: getattr(usage, key, 0) or 0 for key in USAGE_KEYS}
+        with self.lock:
+            self.counters['requests'] += 1
+            for key, value in tokens.items():
+                self.counters[key] += value
+        return tokens
+
+    def counters_snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+class MemorySessionStore(SessionStore):
+    """プロセス内の OrderedDict に持つ会話履歴（有効期限切れはアクセス時に捨てる）"""
+
+    def __init__(self, max_sessions, ttl, token_budget):
+        super().__init__(max_sessions, ttl, token_budget)
+        self.sessions = OrderedDict()
+
+    def _expire(self, now):
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session['updated'] <= self.ttl:
+                break
+            self.sessions.popitem(last=False)
+            self.counters['expired_sessions'] += 1
+
+    def _session(self, session_id, now):
+        self._expire(now)
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = {'messages': [], 'tokens': [], 'total_tokens': 0, 'summary': '', 'updated': now}
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.counters['evicted_sessions'] += 1
+        else:
+            self.sessions.move_to_end(session_id)
+        session['updated'] = now
+        return session
+
+    def append(self, session_id, role, content):
+        with self.lock:
+            session = self._session(session_id, time.time())
+            tokens = estimate_tokens(content)
+            session['messages'].append({'role': role, 'content': content})
+            session['tokens'].append(tokens)
+            session['total_tokens'] += tokens
+
+            messages = session['messages']
+            dropped = _count_dropped([m['role'] for m in messages], session['tokens'],
+                                     session['total_tokens'], self.token_budget)
+            if not dropped:
+                return []
+            removed = messages[:dropped]
+            session['total_tokens'] -= sum(session['tokens'][:dropped])
+            del messages[:dropped]
+            del session['tokens'][:dropped]
+            self.counters['truncated_messages'] += dropped
+            return removed
+
+    def get_history(self, session_id):
+        with self.lock:
+            session = self._session(session_id, time.time())
+            return list(session['messages']), session['summary']
+
+    def has_history(self, session_id):
+        with self.lock:
+            self._expire(time.time())
+            session = self.sessions.get(session_id)
+            return bool(session and (session['messages'] or session['summary']))
+
+    def set_summary(self, session_id, summary):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session['summary'] = summary
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def stats(self):
+        with self.lock:
+            messages = sum(len(s['messages']) for s in self.sessions.values())
+            history_tokens = sum(s['total_tokens'] for s in self.sessions.values())
+            history_bytes = sum(
+                len(m['content'].encode('utf-8')) for s in self.sessions.values() for m in s['messages']
+            ) + sum(len(s['summary'].encode('utf-8')) for s in self.sessions.values())
+            return {
+                **self.counters,
+                'backend': 'memory',
+                'sessions': len(self.sessions),
+                'messages': messages,
+                'history_tokens': history_tokens,
+                'history_bytes': history_bytes
+            }
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite（WAL モード）に持つ会話履歴
+
+    同じファイルを開けば gunicorn の複数ワーカーで共有でき、再起動しても残る。
+    発言は追記するだけで、予算からあふれた分はセッションの window_start を進めて見えなくする。
+    有効期限切れ・上限超えのセッションと見えなくなった発言は、CLEANUP_INTERVAL 秒ごとにまとめて消す。
+    """
+
+    CLEANUP_INTERVAL = 60
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL DEFAULT '',
+            window_start INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+    '''
+
+    def __init__(self, max_sessions, ttl, token_budget, path=CHAT_SESSION_DB):
+        super().__init__(max_sessions, ttl, token_budget)
+        self.path = path
+        self.local = threading.local()
+        self.last_cleanup = 0
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        # 接続はスレッドごと（fork 後の子プロセスでは作り直す）
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def _live_session(self, connection, session_id, now):
+        return connection.execute(
+            'SELECT summary, window_start, total_tokens FROM sessions WHERE session_id = ? AND updated >= ?',
+            (session_id, now - self.ttl)
+        ).fetchone()
+
+    def append(self, session_id, role, content):
+        connection = self._connection()
+        now = time.time()
+        tokens = estimate_tokens(content)
+        # 書き込みはプロセスをまたいで直列化される
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            session = self._live_session(connection, session_id, now)
+            message_id = connection.execute(
+                'INSERT INTO messages (session_id, role, content, tokens) VALUES (?, ?, ?, ?)',
+                (session_id, role, content, tokens)
+            ).lastrowid
+
+            if session is None:
+                # 新規（または有効期限切れ）のセッションはこの発言から始める
+                summary, window_start, total_tokens = '', message_id, tokens
+            else:
+                summary, window_start, total_tokens = session
+                total_tokens += tokens
+
+            removed = []
+            if session is not None:
+                rows = connection.execute(
+                    'SELECT id, role, tokens FROM messages WHERE session_id = ? AND id >= ? ORDER BY id',
+                    (session_id, window_start)
+                ).fetchall()
+                dropped = _count_dropped([row[1] for row in rows], [row[2] for row in rows],
+                                         total_tokens, self.token_budget)
+                if dropped:
+                    removed = [
+                        {'role': r, 'content': c} for r, c in connection.execute(
+                            'SELECT role, content FROM messages WHERE session_id = ? AND id >= ? AND id < ? ORDER BY id',
+                            (session_id, window_start, rows[dropped][0])
+                        )
+                    ]
+                    total_tokens -= sum(row[2] for row in rows[:dropped])
+                    window_start = rows[dropped][0]
+
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (session_id, summary, window_start, total_tokens, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (session_id, summary, window_start, total_tokens, now)
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        if removed:
+            with self.lock:
+                self.counters['truncated_messages'] += len(removed)
+        if now - self.last_cleanup > self.CLEANUP_INTERVAL:
+            self.cleanup(now)
+        return removed
+
+    def get_history(self, session_id):
+        connection = self._connection()
+        session = self._live_session(connection, session_id, time.time())
+        if session is None:
+            return [], ''
+        summary, window_start, _ = session
+        messages = [
+            {'role': role, 'content': content} for role, content in connection.execute(
+                'SELECT role, content FROM messages WHERE session_id = ? AND id >= ? ORDER BY id',
+                (session_id, window_start)
+            )
+        ]
+        return messages, summary
+
+    def has_history(self, session_id):
+        # セッションの行があれば最新の発言は必ず残っている
+        return self._live_session(self._connection(), session_id, time.time()) is not None
+
+    def set_summary(self, session_id, summary):
+        self._connection().execute('UPDATE sessions SET summary = ? WHERE session_id = ?', (summary, session_id))
+
+    def cleanup(self, now=None):
+        """有効期限切れ・上限超えのセッションと、履歴から外れた発言を消す"""
+        now = now or time.time()
+        self.last_cleanup = now
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            expired = connection.execute('DELETE FROM sessions WHERE updated < ?', (now - self.ttl,)).rowcount
+            evicted = connection.execute(
+                'DELETE FROM sessions WHERE session_id IN '
+                '(SELECT session_id FROM sessions ORDER BY updated DESC LIMIT -1 OFFSET ?)',
+                (self.max_sessions,)
+            ).rowcount
+            connection.execute(
+                'DELETE FROM messages WHERE id < COALESCE('
+                '(SELECT window_start FROM sessions WHERE sessions.session_id = messages.session_id), '
+                '(SELECT MAX(id) + 1 FROM messages))'
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        with self.lock:
+            self.counters['expired_sessions'] += expired
+            self.counters['evicted_sessions'] += evicted
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM sessions WHERE updated >= ?', (time.time() - self.ttl,)
+        ).fetchone()[0]
+
+    def stats(self):
+        connection = self._connection()
+        sessions, history_tokens, summary_bytes = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(total_tokens), 0), COALESCE(SUM(LENGTH(CAST(summary AS BLOB))), 0) '
+            'FROM sessions WHERE updated >= ?',
+            (time.time() - self.ttl,)
+        ).fetchone()
+        messages, history_bytes = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(m.content AS BLOB))), 0) FROM messages m '
+            'JOIN sessions s ON s.session_id = m.session_id AND m.id >= s.window_start WHERE s.updated >= ?',
+            (time.time() - self.ttl,)
+        ).fetchone()
+        return {
+            **self.counters_snapshot(),
+            'backend': 'sqlite',
+            'path': self.path,
+            'sessions': sessions,
+            'messages': messages,
+            'history_tokens': history_tokens,
+            'history_bytes': history_bytes + summary_bytes
+        }
+
+SESSION_BACKENDS = {
+    'memory': MemorySessionStore,
+    'sqlite': SQLiteSessionStore
+}
+
+def create_session_store(backend=CHAT_SESSION_BACKEND):
+    store_class = SESSION_BACKENDS.get(backend)
+    if store_class is None:
+        raise ValueError(f'unknown session backend: {backend}')
+    return store_class(CHAT_MAX_SESSIONS, CHAT_SESSION_TTL, CHAT_HISTORY_TOKEN_BUDGET)
+
 # 会話履歴（セッション管理）
-conversation_history = {}
+conversation_history = create_session_store()
+
+# 要約などリクエストの外で行う処理用
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='background')
+
+# ブログ記事キャッシュの更新設定
+# poll: BLOG_REFRESH_INTERVAL 秒ごとに全件を読み直す / listen: Firestore のリスナーで差分を反映
+BLOG_SYNC_MODE = os.environ.get('BLOG_SYNC_MODE', 'poll')
+BLOG_REFRESH_INTERVAL = int(os.environ.get('BLOG_REFRESH_INTERVAL', 600))
+BLOG_RETRY_INTERVAL = int(os.environ.get('BLOG_RETRY_INTERVAL', 30))
+# まだ1度も読み込めていないときだけ、リクエスト側で待つ最大秒数
+BLOG_INITIAL_LOAD_TIMEOUT = float(os.environ.get('BLOG_INITIAL_LOAD_TIMEOUT', 5))
+
+class BlogCorpus:
+    """ある時点のブログ記事一覧（スナップショット）と、そこから作る検索用の構造
+
+    一度作ったら中身は変えない。更新時は新しいスナップショットを作って丸ごと差し替える。
+    """
+
+    def __init__(self, posts, version, digest=None, snapshot=None):
+        self.posts = posts
+        self.version = version
+        self.digest = digest or corpus_digest(posts)
+        self.indexes = {}
+        self.lock = threading.Lock()
+        # スナップショットファイルから読み込んだときは、検索構造もファイル上のものを使う
+        self.snapshot = snapshot
+        if snapshot is None:
+            self.loaded_at = time.time()
+        else:
+            self.loaded_at = snapshot.written_at
+            self.indexes.update(snapshot.indexes())
+
+    def index(self, name, builder):
+        """name の検索構造を返す（無ければ builder(posts) で作って覚えておく）"""
+        index = self.indexes.get(name)
+        if index is None:
+            with self.lock:
+                index = self.indexes.get(name)
+                if index is None:
+                    index = builder(self.posts)
+                    self.indexes[name] = index
+        return index
+
+    def warm(self):
+        """リクエストで使う検索構造を先に作っておく"""
+        get_search_index(self)
+        get_date_index(self)
+        self.index('recent', build_recent_posts)
+        if search_backend == 'bm25':
+            try:
+                get_bm25_index(self)
+            except ImportError as e:
+                print(f'BM25インデックスを作れません: {str(e)}')
+
+# ブログ記事スナップショットのファイル（正規化した記事・抜粋・検索構造を mmap で読める形で書き出す）
+# 新しいワーカーは Firestore を待たずにこれを読み込み、ファイルのページはワーカー間で共有される。空なら使わない
+# 既定はアプリのディレクトリ。Heroku ではビルド時に bin/post_compile が書き出して slug に含めるので、
+# 新しい dyno も Firestore を待たない（/tmp は dyno ごとに空から始まる）
+BLOG_SNAPSHOT_PATH = os.environ.get('BLOG_SNAPSHOT_PATH',
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blog-corpus.snapshot'))
+BLOG_SNAPSHOT_MAGIC = b'AIKBLOG\0'
+# ファイルの形式を変えたら上げる（違う形式のファイルは読まずに Firestore から作り直す）
+BLOG_SNAPSHOT_FORMAT = 1
+# 記事ごとに文字列表へこの順で並べるフィールド
+BLOG_SNAPSHOT_FIELDS = ('id', 'title', 'date', 'content', 'snippet')
+BLOG_SNAPSHOT_FIELD_INDEX = {field: i for i, field in enumerate(BLOG_SNAPSHOT_FIELDS)}
+# 部分文字列検索の対象（0: タイトル, 1: 本文）
+BLOG_SNAPSHOT_SEARCH_FIELDS = (BLOG_SNAPSHOT_FIELD_INDEX['title'], BLOG_SNAPSHOT_FIELD_INDEX['content'])
+# プロンプトに入れる本文の抜粋の長さ
+BLOG_SNIPPET_LENGTH = 500
+# 組み立てたポスティングを n-gram いくつ分まで覚えておくか（検索1回で同じ n-gram を何度も引くため）
+BLOG_SNAPSHOT_POSTINGS_CACHE_SIZE = int(os.environ.get('BLOG_SNAPSHOT_POSTINGS_CACHE_SIZE', 2048))
+
+def post_snippet(content):
+    """プロンプトに入れる本文の抜粋（長い記事は先頭だけ）"""
+    return f'{content[:BLOG_SNIPPET_LENGTH]}...' if len(content) > BLOG_SNIPPET_LENGTH else content
+
+def corpus_digest(posts):
+    """記事一覧の中身のハッシュ（同じならスナップショットを差し替えない・ファイルを書き直さない）"""
+    digest = hashlib.sha256()
+    for post in posts:
+        for field in ('id', 'title', 'date', 'content'):
+            digest.update(str(post[field]).encode('utf-8'))
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def _string_table(strings):
+    """文字列の並びを (終端オフセットの配列, UTF-8 を連結したバイト列) にする"""
+    offsets = array('q', [0])
+    blob = bytearray()
+    for text in strings:
+        blob += text
+        offsets.append(len(blob))
+    return offsets, blob
+
+class StringTable:
+    """オフセットの配列とバイト列で表した文字列の並び（ファイル上のまま読む）"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        # UTF-8 のバイト列の順は文字列の順と同じなので、そのまま二分探索に使える
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def text(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+class SnapshotPost(Mapping):
+    """スナップショットファイル上の記事1件（フィールドは参照するたびにファイルから取り出す）"""
+
+    __slots__ = ('strings', 'base')
+
+    def __init__(self, strings, doc_id):
+        self.strings = strings
+        self.base = doc_id * len(BLOG_SNAPSHOT_FIELDS)
+
+    def __getitem__(self, field):
+        return self.strings.text(self.base + BLOG_SNAPSHOT_FIELD_INDEX[field])
+
+    def __iter__(self):
+        return iter(BLOG_SNAPSHOT_FIELDS)
+
+    def __len__(self):
+        return len(BLOG_SNAPSHOT_FIELDS)
+
+class SnapshotPosts(Sequence):
+    """スナップショットファイル上の記事一覧（order を渡せばその並び順で見せる）"""
+
+    def __init__(self, strings, count, order=None):
+        self.strings = strings
+        self.count = count
+        self.order = order
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        positions = range(self.count)[i]
+        if isinstance(i, slice):
+            return [self._post(position) for position in positions]
+        return self._post(positions)
+
+    def _post(self, position):
+        return SnapshotPost(self.strings, position if self.order is None else self.order[position])
+
+class SnapshotPostings:
+    """n-gram → {記事番号: (タイトル出現数, 本文出現数)}（引いた n-gram の分だけファイルから組み立てる）
+
+    組み立てた dict は最近引いたものから BLOG_SNAPSHOT_POSTINGS_CACHE_SIZE 個まで覚えておく（呼び出し側は変更しない）。
+    """
+
+    def __init__(self, grams, offsets, doc_ids, title_hits, content_hits):
+        self.grams = grams
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.title_hits = title_hits
+        self.content_hits = content_hits
+        self.lock = threading.Lock()
+        self.decoded = OrderedDict()
+
+    def __len__(self):
+        return len(self.grams)
+
+    def get(self, gram, default=None):
+        with self.lock:
+            hits = self.decoded.get(gram)
+            if hits is not None:
+                self.decoded.move_to_end(gram)
+                return hits
+
+        key = gram.encode('utf-8')
+        i = bisect_left(self.grams, key)
+        if i == len(self.grams) or self.grams[i] != key:
+            return default
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        hits = dict(zip(self.doc_ids[start:stop].tolist(),
+                        zip(self.title_hits[start:stop].tolist(), self.content_hits[start:stop].tolist())))
+
+        with self.lock:
+            self.decoded[gram] = hits
+            while len(self.decoded) > BLOG_SNAPSHOT_POSTINGS_CACHE_SIZE:
+                self.decoded.popitem(last=False)
+        return hits
+
+def read_blog_snapshot_header(f):
+    """ファイル先頭のヘッダーを読んで検証する（別の形式・別の設定で書かれたファイルは ValueError）"""
+    if f.read(len(BLOG_SNAPSHOT_MAGIC)) != BLOG_SNAPSHOT_MAGIC:
+        raise ValueError('ブログ記事スナップショットのファイルではありません')
+    length = int.from_bytes(f.read(4), 'little')
+    header = json.loads(f.read(length).decode('utf-8'))
+    expected = {
+        'format': BLOG_SNAPSHOT_FORMAT,
+        'ngram': SEARCH_NGRAM,
+        'snippet_length': BLOG_SNIPPET_LENGTH,
+        'byteorder': sys.byteorder
+    }
+    for key, value in expected.items():
+        if header.get(key) != value:
+            raise ValueError(f'スナップショットの {key} が違います: {header.get(key)} != {value}')
+    header['data_offset'] = _align(len(BLOG_SNAPSHOT_MAGIC) + 4 + length)
+    return header
+
+class BlogSnapshotFile:
+    """mmap したスナップショットファイル
+
+    記事の文字列・n-gram のポスティング・日付・新しい順の並びを配列のまま持ち、Python のオブジェクトには展開しない。
+    読み込みはヘッダーの検証と日付の辞書づくりだけで済み、ページは同じファイルを開いた全ワーカーで共有される。
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.header = read_blog_snapshot_header(f)
+            self.written_at = os.fstat(f.fileno()).st_mtime
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.digest = self.header['digest']
+        self.size = len(self.map)
+
+        view = memoryview(self.map)
+        base = self.header['data_offset']
+        sections = {}
+        for name, (offset, length, typecode) in self.header['sections'].items():
+            section = view[base + offset:base + offset + length]
+            sections[name] = section if typecode == 'B' else section.cast(typecode)
+        self.sections = sections
+        self.strings = StringTable(sections['field_offsets'], sections['fields'])
+        self.posts = SnapshotPosts(self.strings, self.header['posts'])
+        self.contains = self._text_matcher()
+
+    def _text_matcher(self):
+        """記事のタイトル（field=0）か本文（field=1）に text が含まれるかを調べる関数
+
+        照合する文字列は、検索で参照された記事の分だけこのワーカーで展開して覚えておく
+        （起動時に全件を展開しない。ポスティングと記事一覧はファイル上のまま共有する）。
+        """
+        strings = self.strings
+        stride = len(BLOG_SNAPSHOT_FIELDS)
+        search_fields = BLOG_SNAPSHOT_SEARCH_FIELDS
+        decoded = ([None] * len(self.posts), [None] * len(self.posts))
+
+        def contains(doc_id, field, text):
+            texts = decoded[field]
+            value = texts[doc_id]
+            if value is None:
+                value = texts[doc_id] = strings.text(doc_id * stride + search_fields[field])
+            return text in value
+        return contains
+
+    def indexes(self):
+        """BlogCorpus.indexes に入れる検索構造（build_* で作るものと同じ形）"""
+        sections = self.sections
+        postings = SnapshotPostings(StringTable(sections['gram_offsets'], sections['grams']),
+                                    sections['posting_offsets'], sections['posting_doc_ids'],
+                                    sections['posting_title_hits'], sections['posting_content_hits'])
+        return {
+            'search': {
+                'posts': self.posts,
+                'postings': postings,
+                'contains': self.contains,
+                'stats': {'posts': len(self.posts), 'ngrams': len(postings),
+                          'postings': len(sections['posting_doc_ids']), 'source': 'snapshot'}
+            },
+            'date': build_date_index(self.posts, sections['dates'].tolist()),
+            'recent': {
+                'posts': SnapshotPosts(self.strings, len(self.posts), sections['recent']),
+                'stats': {'posts': len(self.posts), 'source': 'snapshot'}
+            }
+        }
 
-# ブログ記事キャッシュ
-blog_posts_cache = None
+def write_blog_snapshot(corpus, path=BLOG_SNAPSHOT_PATH):
+    """記事一覧と検索構造をスナップショットファイルに書き出す（一時ファイルに書いてから置き換える）"""
+    posts = corpus.posts
+    postings = get_search_index(corpus)['postings']
+
+    field_offsets, fields = _string_table(
+        str(post[field] if field != 'snippet' else post_snippet(post['content'])).encode('utf-8')
+        for post in posts for field in BLOG_SNAPSHOT_FIELDS
+    )
+    grams = sorted(gram.encode('utf-8') for gram in postings)
+    gram_offsets, gram_blob = _string_table(grams)
+    posting_offsets = array('q', [0])
+    doc_ids, title_hits, content_hits = array('i'), array('i'), array('i')
+    for gram in grams:
+        hits = postings[gram.decode('utf-8')]
+        doc_ids.extend(hits.keys())
+        title_hits.extend(title for title, _ in hits.values())
+        content_hits.extend(content for _, content in hits.values())
+        posting_offsets.append(len(doc_ids))
+
+    # 日付は (年, 月, 日) を記事ごとに並べる（解析できない記事は年を -1 にする）
+    dates = array('i')
+    for post in posts:
+        match = POST_DATE_PATTERN.search(post.get('date', '') or '')
+        if match:
+            dates.extend(int(part) for part in match.groups())
+        else:
+            dates.extend((-1, 0, 0))
+    recent = array('i', sorted(range(len(posts)), key=lambda doc_id: posts[doc_id].get('date', ''), reverse=True))
+
+    sections = [
+        ('field_offsets', field_offsets), ('fields', fields),
+        ('gram_offsets', gram_offsets), ('grams', gram_blob),
+        ('posting_offsets', posting_offsets), ('posting_doc_ids', doc_ids),
+        ('posting_title_hits', title_hits), ('posting_content_hits', content_hits),
+        ('dates', dates), ('recent', recent)
+    ]
+    layout = {}
+    offset = 0
+    for name, data in sections:
+        length = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        layout[name] = (offset, length, data.typecode if isinstance(data, array) else 'B')
+        offset = _align(offset + length)
+    header = json.dumps({
+        'format': BLOG_SNAPSHOT_FORMAT,
+        'ngram': SEARCH_NGRAM,
+        'snippet_length': BLOG_SNIPPET_LENGTH,
+        'byteorder': sys.byteorder,
+        'digest': corpus.digest,
+        'posts': len(posts),
+        'sections': layout
+    }).encode('utf-8')
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(BLOG_SNAPSHOT_MAGIC)
+        f.write(len(header).to_bytes(4, 'little'))
+        f.write(header)
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        base = f.tell()
+        for name, data in sections:
+            f.write(b'\0' * (base + layout[name][0] - f.tell()))
+            f.write(data)
+    os.replace(temp_path, path)
+    return base + offset
+
+@contextmanager
+def blog_snapshot_lock():
+    """スナップショットファイルの更新をワーカー間で1つずつにする（Firestore を読むのは1ワーカーで済む）"""
+    if fcntl is None or not BLOG_SNAPSHOT_PATH:
+        yield
+        return
+    with open(f'{BLOG_SNAPSHOT_PATH}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# ブログ記事キャッシュ（最後に読み込めたスナップショット）
+blog_corpus = None
+blog_corpus_version = 0
+blog_sync_state = {'started_pid': None, 'last_error': None, 'last_refresh': None, 'refresh_ms': None}
+blog_sync_lock = threading.Lock()
+blog_loaded = threading.Event()
+# このプロセスで最初の読み込みが（成否にかかわらず）終わった。以降のリクエストは読み込みを待たない
+blog_load_attempted = threading.Event()
+
+def _post_from_document(doc_id, data):
+    """Firestore のドキュメントを記事の dict に変換"""
+    content = ''
+    if 'paragraphs' in data and isinstance(data['paragraphs'], list):
+        content = '\n'.join(data['paragraphs'])
+
+    return {
+        'id': doc_id,
+        'title': data.get('title', ''),
+        'content': content,
+        'date': data.get('date', ''),
+        'snippet': post_snippet(content)
+    }
+
+def publish_blog_posts(posts, snapshot=None):
+    """新しい記事一覧から検索構造まで作ってから、スナップショットを差し替える
+
+    snapshot（スナップショットファイル）を渡せば検索構造はファイルのものを使う。中身が今と同じなら差し替えない。
+    """
+    global blog_corpus, blog_corpus_version
+    start = time.perf_counter()
+    digest = snapshot.digest if snapshot is not None else corpus_digest(posts)
+    corpus = blog_corpus
+    if corpus is None or corpus.digest != digest:
+        with blog_sync_lock:
+            blog_corpus_version += 1
+            corpus = BlogCorpus(posts, blog_corpus_version, digest, snapshot)
+        corpus.warm()
+        metrics.observe('blog_publish_seconds', time.perf_counter() - start)
+
+        # 参照の代入だけで切り替わるので、リクエスト側は古いか新しいかどちらか一方を見る
+        blog_corpus = corpus
+        clear_blog_context_memo()
+    blog_sync_state['last_error'] = None
+    blog_sync_state['last_refresh'] = snapshot.written_at if snapshot is not None else time.time()
+    blog_sync_state['refresh_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    blog_loaded.set()
+    blog_load_attempted.set()
+    return corpus
+
+def load_blog_posts():
+    """Firestoreから全ブログ記事を読み込んでスナップショットを差し替える"""
+    db = get_firestore_db()
+    posts_ref = db.collection('posts')
+    with metrics.time('blog_fetch_seconds'):
+        posts = [_post_from_document(doc.id, doc.to_dict()) for doc in posts_ref.stream()]
+    return publish_blog_posts(posts)
+
+def load_blog_snapshot(max_age=None):
+    """スナップショットファイルを読み込んで差し替える（無い・壊れている・max_age 秒より古いときは None）"""
+    if not BLOG_SNAPSHOT_PATH:
+        return None
+    try:
+        start = time.perf_counter()
+        snapshot = BlogSnapshotFile(BLOG_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f'ブログ記事スナップショット読み込みエラー: {str(e)}')
+        metrics.inc('errors_total', stage='blog_snapshot')
+        return None
+    if max_age is not None and time.time() - snapshot.written_at > max_age:
+        return None
+    corpus = publish_blog_posts(snapshot.posts, snapshot)
+    blog_sync_state['snapshot_load_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    return corpus
+
+def save_blog_snapshot(corpus):
+    """スナップショットファイルを書き出す（中身が同じならファイルの時刻だけ進めて、他のワーカーに新しいと知らせる）"""
+    if not BLOG_SNAPSHOT_PATH:
+        return
+    try:
+        try:
+            with open(BLOG_SNAPSHOT_PATH, 'rb') as f:
+                unchanged = read_blog_snapshot_header(f)['digest'] == corpus.digest
+        except (OSError, ValueError):
+            unchanged = False
+        if unchanged:
+            os.utime(BLOG_SNAPSHOT_PATH)
+            return
+        if corpus.snapshot is not None:
+            # 読み込んだファイルとディスク上のファイルが食い違うときだけ（検索構造を作り直して書く）
+            corpus = BlogCorpus([dict(post) for post in corpus.posts], corpus.version, corpus.digest)
+        start = time.perf_counter()
+        size = write_blog_snapshot(corpus)
+        blog_sync_state['snapshot_write_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        blog_sync_state['snapshot_bytes'] = size
+    except Exception as e:
+        print(f'ブログ記事スナップショット書き出しエラー: {str(e)}')
+        metrics.inc('errors_total', stage='blog_snapshot')
+
+def refresh_blog_posts():
+    """Firestore から読み直してスナップショットファイルも更新する
+
+    ロックを待つ間に他のワーカーが更新していれば、Firestore は読まずにそのファイルを使う。
+    """
+    with blog_snapshot_lock():
+        corpus = load_blog_snapshot(max_age=BLOG_REFRESH_INTERVAL)
+        if corpus is None:
+            corpus = load_blog_posts()
+            save_blog_snapshot(corpus)
+    return corpus
+
+def load_blog_corpus():
+    """起動時の読み込み（スナップショットファイルがあれば古くてもそれを使い、更新はバックグラウンドに任せる）"""
+    return load_blog_snapshot() or refresh_blog_posts()
+
+def _poll_blog_posts():
+    """一定間隔で全件を読み直す（失敗したら前のスナップショットのまま再試行）"""
+    # 起動準備（や fork 前の親プロセス）で読み込み済みなら、次の更新時刻まで待つ
+    corpus = blog_corpus or load_blog_snapshot()
+    if corpus is not None:
+        time.sleep(max(corpus.loaded_at + BLOG_REFRESH_INTERVAL - time.time(), 0))
+
+    while True:
+        try:
+            refresh_blog_posts()
+            delay = BLOG_REFRESH_INTERVAL
+        except Exception as e:
+            print(f'ブログ記事取得エラー: {str(e)}')
+            metrics.inc('errors_total', stage='blog_fetch')
+            blog_sync_state['last_error'] = str(e)
+            blog_load_attempted.set()
+            delay = BLOG_RETRY_INTERVAL
+        time.sleep(delay)
+
+def _listen_blog_posts():
+    """Firestore のスナップショットリスナーで追加・更新・削除だけを反映する"""
+    posts_by_id = {}
+
+    def on_snapshot(collection_snapshot, changes, read_time):
+        try:
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    posts_by_id.pop(doc.id, None)
+                else:
+                    posts_by_id[doc.id] = _post_from_document(doc.id, doc.to_dict())
+            # stream() と同じくドキュメント ID 順に並べる
+            corpus = publish_blog_posts([posts_by_id[doc_id] for doc_id in sorted(posts_by_id)])
+            with blog_snapshot_lock():
+                save_blog_snapshot(corpus)
+        except Exception as e:
+            print(f'ブログ記事同期エラー: {str(e)}')
+            metrics.inc('errors_total', stage='blog_sync')
+            blog_sync_state['last_error'] = str(e)
+            blog_load_attempted.set()
+
+    while True:
+        try:
+            get_firestore_db().collection('posts').on_snapshot(on_snapshot)
+            return
+        except Exception as e:
+            print(f'ブログ記事リスナー登録エラー: {str(e)}')
+            metrics.inc('errors_total', stage='blog_sync')
+            blog_sync_state['last_error'] = str(e)
+            blog_load_attempted.set()
+            time.sleep(BLOG_RETRY_INTERVAL)
+
+def start_blog_sync():
+    """ブログ記事の読み込み・更新スレッドをこのプロセスで1度だけ起動"""
+    with blog_sync_lock:
+        if blog_sync_state['started_pid'] == os.getpid():
+            return
+        blog_sync_state['started_pid'] = os.getpid()
+
+    target = _listen_blog_posts if BLOG_SYNC_MODE == 'listen' else _poll_blog_posts
+    threading.Thread(target=target, name='blog-sync', daemon=True).start()
+
+def get_blog_corpus():
+    """現在のブログ記事スナップショットを取得（Firestore の読み込みは待たない）"""
+    start_blog_sync()
+    if blog_corpus is None:
+        # このプロセスの最初の読み込みが終わるまでだけ少し待つ
+        # （失敗した後や待ちきれなかった後は、Firestore が落ちていてもすぐ空で返す）
+        if not blog_load_attempted.wait(BLOG_INITIAL_LOAD_TIMEOUT):
+            blog_load_attempted.set()
+        if blog_corpus is None:
+            return BlogCorpus([], 0)
+    return blog_corpus
 
 def get_all_blog_posts():
-    """Firestoreから全ブログ記事を取得（キャッシュ付き）"""
-    global blog_posts_cache
-    if blog_posts_cache is not None:
-        return blog_posts_cache
+    """全ブログ記事を取得（バックグラウンドで更新されるキャッシュから）"""
+    return get_blog_corpus().posts
+
+def get_blog_stats():
+    corpus = blog_corpus
+    return {
+        'mode': BLOG_SYNC_MODE,
+        'version': corpus.version if corpus else 0,
+        'posts': len(corpus.posts) if corpus else 0,
+        'loaded_at': corpus.loaded_at if corpus else None,
+        'source': ('snapshot' if corpus.snapshot is not None else 'firestore') if corpus else None,
+        'snapshot_path': BLOG_SNAPSHOT_PATH or None,
+        'indexes': {name: index['stats'] for name, index in corpus.indexes.items()} if corpus else {},
+        'context_memo': {**blog_context_memo_stats, 'size': len(blog_context_memo)},
+        **{key: value for key, value in blog_sync_state.items() if key != 'started_pid'}
+    }
+
+# 部分文字列スコアリングで無視する語（記号や助詞）
+# （NFKC 正規化後の半角の ? も含める）
+SEARCH_STOPWORDS = {'って', 'what', 'って何', '何？', '何?', 'とは', 'について', 'ですか', 'って何？', 'って何?'}
+
+# 転置インデックスの n-gram 長（スコア対象の部分文字列は3文字以上）
+SEARCH_NGRAM = 3
+
+def build_search_index(posts):
+    """記事のタイトル・本文から文字 n-gram の転置インデックスを構築
+
+    n-gram → {記事番号: (タイトル出現数, 本文出現数)} のポスティングリスト
+    """
+    start = time.perf_counter()
+    postings = {}
+
+    for doc_id, post in enumerate(posts):
+        counts = {}
+        for field, text in enumerate((post['title'], post['content'])):
+            for i in range(len(text) - SEARCH_NGRAM + 1):
+                gram = text[i:i + SEARCH_NGRAM]
+                if gram not in counts:
+                    counts[gram] = [0, 0]
+                counts[gram][field] += 1
+
+        for gram, (title_hits, content_hits) in counts.items():
+            postings.setdefault(gram, {})[doc_id] = (title_hits, content_hits)
+
+    texts = ([post['title'] for post in posts], [post['content'] for post in posts])
+
+    def contains(doc_id, field, text):
+        return text in texts[field][doc_id]
+
+    build_ms = (time.perf_counter() - start) * 1000
+    stats = {
+        'posts': len(posts),
+        'ngrams': len(postings),
+        'postings': sum(len(p) for p in postings.values()),
+        'build_ms': round(build_ms, 2)
+    }
+    print(f"検索インデックス構築: {stats['posts']}件, {stats['ngrams']} n-gram, "
+          f"{stats['postings']} ポスティング, {stats['build_ms']}ms")
+
+    return {'posts': posts, 'postings': postings, 'contains': contains, 'stats': stats}
+
+def get_search_index(corpus=None):
+    """ブログ記事スナップショットに対応する検索インデックスを取得（スナップショットごとに1度だけ構築）"""
+    return (corpus or get_blog_corpus()).index('search', build_search_index)
+
+def _find_containing(index, query):
+    """クエリ全体をタイトルか本文に含む記事番号を返す"""
+    contains = index['contains']
+    postings = index['postings']
+    candidates = None
+
+    for i in range(len(query) - SEARCH_NGRAM + 1):
+        hits = postings.get(query[i:i + SEARCH_NGRAM])
+        if not hits:
+            return []
+        candidates = set(hits) if candidates is None else candidates & hits.keys()
+        if not candidates:
+            return []
+
+    return [
+        doc_id for doc_id in sorted(candidates)
+        if contains(doc_id, 0, query) or contains(doc_id, 1, query)
+    ]
+
+def _add_substring_hits(index, query, field, weight, scores):
+    """クエリの3文字以上の部分文字列がフィールドに含まれる記事へ加点
+
+    ある位置から始まる部分文字列が含まれなければ、それを伸ばした文字列も含まれない。
+    そこで開始位置ごとに候補記事を n-gram のポスティングで絞り込みながら伸ばし、
+    候補が尽きたら打ち切る。
+    """
+    contains = index['contains']
+    postings = index['postings']
+
+    for i in range(len(query) - SEARCH_NGRAM + 1):
+        first = postings.get(query[i:i + SEARCH_NGRAM])
+        if not first:
+            continue
+        candidates = [doc_id for doc_id, hits in first.items() if hits[field]]
 
-    try:
-        db = get_firestore_db()
-        posts_ref = db.collection('posts')
-        docs = posts_ref.stream()
-
-        posts = []
-        for doc in docs:
-            data = doc.to_dict()
-            content = ''
-            if 'paragraphs' in data and isinstance(data['paragraphs'], list):
-                content = '\n'.join(data['paragraphs'])
-
-            posts.append({
-                'id': doc.id,
-                'title': data.get('title', ''),
-                'content': content,
-                'date': data.get('date', '')
-            })
+        for j in range(i + SEARCH_NGRAM, len(query) + 1):
+            if j > i + SEARCH_NGRAM:
+                # 末尾の n-gram を持たない記事を除外してから実際の包含を確認
+                last = postings.get(query[j - SEARCH_NGRAM:j], {})
+                substring = query[i:j]
+                candidates = [
+                    doc_id for doc_id in candidates
+                    if doc_id in last and last[doc_id][field] and contains(doc_id, field, substring)
+                ]
+                if not candidates:
+                    break
+            if query[i:j] in SEARCH_STOPWORDS:
+                continue
+            for doc_id in candidates:
+                scores[doc_id] = scores.get(doc_id, 0) + weight
+
+def _search_substring(corpus, query, max_results):
+    """部分文字列の一致数によるスコアリング（従来方式）"""
+    posts = corpus.posts
+    index = get_search_index(corpus)
+    scores = {}
+
+    # クエリ全体が含まれているかチェック
+    if len(query) >= SEARCH_NGRAM:
+        for doc_id in _find_containing(index, query):
+            scores[doc_id] = 5
+    else:
+        # n-gram より短いクエリは直接照合
+        contains = index['contains']
+        for doc_id in range(len(posts)):
+            if contains(doc_id, 0, query) or contains(doc_id, 1, query):
+                scores[doc_id] = 5
+
+    # クエリの部分文字列でもチェック（日本語対応）
+    # タイトルは +3、本文は +1
+    _add_substring_hits(index, query, 0, 3, scores)
+    _add_substring_hits(index, query, 1, 1, scores)
+
+    # スコア順にソートして上位を返す（同点は記事順。記事を取り出すのは上位だけ）
+    ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+    return [posts[doc_id] for doc_id in ranked[:max_results]]
+
+# BM25 パラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# タイトル中の語は本文の何回分として数えるか
+BM25_TITLE_WEIGHT = 3
+
+# 記号・空白を区切りとして文字の連続を取り出す
+TOKEN_RUN_PATTERN = re.compile(r'\w+')
+
+def tokenize_bigrams(text):
+    """日本語向けに文字 bigram へ分割（1文字だけの語はそのまま1語）"""
+    tokens = []
+    for run in TOKEN_RUN_PATTERN.findall(unicodedata.normalize('NFKC', text).lower()):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
 
-        blog_posts_cache = posts
-        return posts
-    except Exception as e:
-        print(f'ブログ記事取得エラー: {str(e)}')
-        return []
+def build_bm25_index(posts):
+    """記事×語の疎行列に BM25 の重みを前計算して保持"""
+    import numpy as np
+    from scipy import sparse
 
-def search_relevant_posts(query, max_results=3):
-    """ユーザーの質問に関連するブログ記事を検索"""
-    posts = get_all_blog_posts()
-    if not posts:
+    start = time.perf_counter()
+    vocab = {}
+    indptr = [0]
+    indices = []
+    term_freqs = []
+
+    for post in posts:
+        counts = {}
+        for token in tokenize_bigrams(post['title']):
+            counts[token] = counts.get(token, 0) + BM25_TITLE_WEIGHT
+        for token in tokenize_bigrams(post['content']):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            indices.append(vocab.setdefault(token, len(vocab)))
+            term_freqs.append(count)
+        indptr.append(len(indices))
+
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    tf = np.asarray(term_freqs, dtype=np.float32)
+
+    # 文書長の正規化と IDF をまとめて各要素の重みにする
+    rows = np.repeat(np.arange(len(posts)), np.diff(indptr))
+    doc_len = np.bincount(rows, weights=tf, minlength=len(posts))
+    avg_len = doc_len.mean() if len(posts) and doc_len.mean() > 0 else 1.0
+    doc_freq = np.bincount(indices, minlength=len(vocab))
+    idf = np.log1p((len(posts) - doc_freq + 0.5) / (doc_freq + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[rows] / avg_len)
+    weights = (idf[indices] * tf * (BM25_K1 + 1) / (tf + norm)).astype(np.float32)
+
+    matrix = sparse.csr_matrix((weights, indices, indptr), shape=(len(posts), len(vocab)))
+
+    build_ms = (time.perf_counter() - start) * 1000
+    stats = {
+        'posts': len(posts),
+        'terms': len(vocab),
+        'nonzeros': int(matrix.nnz),
+        'build_ms': round(build_ms, 2)
+    }
+    print(f"BM25インデックス構築: {stats['posts']}件, {stats['terms']}語, "
+          f"{stats['nonzeros']} 要素, {stats['build_ms']}ms")
+
+    return {'posts': posts, 'vocab': vocab, 'matrix': matrix, 'stats': stats}
+
+def get_bm25_index(corpus=None):
+    """ブログ記事スナップショットに対応する BM25 インデックスを取得（検索バックエンドが bm25 のときだけ構築）"""
+    return (corpus or get_blog_corpus()).index('bm25', build_bm25_index)
+
+def _search_bm25(corpus, query, max_results):
+    """BM25 で全記事を一度の疎行列積でスコアリング"""
+    import numpy as np
+
+    posts = corpus.posts
+    index = get_bm25_index(corpus)
+    vocab = index['vocab']
+
+    query_vector = np.zeros(len(vocab), dtype=np.float32)
+    for token in tokenize_bigrams(query):
+        term_id = vocab.get(token)
+        if term_id is not None:
+            query_vector[term_id] += 1
+    if not query_vector.any():
         return []
 
-    scored_posts = []
+    scores = index['matrix'] @ query_vector
+    top = np.argsort(-scores, kind='stable')[:max_results]
+    return [posts[doc_id] for doc_id in top if scores[doc_id] > 0]
 
-    for post in posts:
-        score = 0
-        title = post['title']
-        content = post['content']
-
-        # クエリ全体が含まれているかチェック
-        if query in title or query in content:
-            score += 5
-
-        # クエリの部分文字列でもチェック（日本語対応）
-        # 2文字以上の連続する部分でマッチング
-        for i in range(len(query)):
-            for j in range(i + 2, len(query) + 1):
-                substring = query[i:j]
-                # 記号や助詞を除外
-                if substring in ['って', 'what', 'what', 'って何', '何？', 'とは', 'について', 'ですか', 'って何？']:
-                    continue
-                if len(substring) >= 3:
-                    if substring in title:
-                        score += 3
-                    if substring in content:
-                        score += 1
-
-        if score > 0:
-            scored_posts.append((score, post))
-
-    # スコア順にソートして上位を返す
-    scored_posts.sort(key=lambda x: x[0], reverse=True)
-    return [post for score, post in scored_posts[:max_results]]
-
-def get_recent_posts(max_results=2):
-    """最新のブログ記事を取得"""
-    posts = get_all_blog_posts()
-    if not posts:
+# 検索バックエンド（BLOG_SEARCH_BACKEND で切り替え）
+SEARCH_BACKENDS = {
+    'substring': _search_substring,
+    'bm25': _search_bm25
+}
+search_backend = os.environ.get('BLOG_SEARCH_BACKEND', 'substring')
+
+def search_relevant_posts(query, max_results=3, corpus=None):
+    """ユーザーの質問に関連するブログ記事を検索"""
+    corpus = corpus or get_blog_corpus()
+    if not corpus.posts:
         return []
 
-    # 日付でソート（新しい順）
-    sorted_posts = sorted(posts, key=lambda x: x.get('date', ''), reverse=True)
-    return sorted_posts[:max_results]
+    backend = SEARCH_BACKENDS.get(search_backend, _search_substring)
+    try:
+        return backend(corpus, query, max_results)
+    except ImportError as e:
+        # numpy / scipy が無い環境では従来方式で検索
+        print(f'検索バックエンド {search_backend} が使えません: {str(e)}')
+        return _search_substring(corpus, query, max_results)
+
+def build_recent_posts(posts):
+    """記事を日付の新しい順に並べておく"""
+    return {
+        'posts': sorted(posts, key=lambda x: x.get('date', ''), reverse=True),
+        'stats': {'posts': len(posts)}
+    }
+
+def get_recent_posts(max_results=2, corpus=None):
+    """最新のブログ記事を取得（並べ替えはスナップショットごとに1度だけ）"""
+    corpus = corpus or get_blog_corpus()
+    if not corpus.posts:
+        return []
 
-def search_posts_by_date(query, max_results=3):
+    return corpus.index('recent', build_recent_posts)['posts'][:max_results]
+
+# 日付検索のパターン（例: "10月29日", "10/29", "2025年10月", "10月中旬", "先週"）
+DATE_MONTH_PATTERN = re.compile(r'(\d{1,2})月')
+DATE_DAY_PATTERN = re.compile(r'(\d{1,2})日')
+DATE_YEAR_PATTERN = re.compile(r'(20\d{2})年')
+DATE_SLASH_PATTERN = re.compile(r'(\d{1,2})/(\d{1,2})')
+DATE_PERIOD_PATTERN = re.compile(r'(\d{1,2})月(上旬|中旬|下旬)')
+# 記事の日付（例: "2025.10.29"）
+POST_DATE_PATTERN = re.compile(r'(\d{4})\D(\d{1,2})\D(\d{1,2})')
+
+# 上旬・中旬・下旬の日の範囲
+DATE_PERIOD_DAYS = {'上旬': (1, 10), '中旬': (11, 20), '下旬': (21, 31)}
+
+# 相対的な日付表現は日本時間で解釈する
+JST = timezone(timedelta(hours=9))
+
+def build_date_index(posts, dates=None):
+    """記事の日付を (年, 月, 日) に解析し、日付で引ける辞書と日付順の一覧を作る
+
+    dates（スナップショットファイルの解析済みの (年, 月, 日) の並び）を渡せば解析は省く。
+    """
+    start = time.perf_counter()
+    by_ymd, by_ym, by_md, by_m = {}, {}, {}, {}
+    dated = []
+
+    for doc_id in range(len(posts)):
+        if dates is None:
+            match = POST_DATE_PATTERN.search(posts[doc_id].get('date', '') or '')
+            if not match:
+                continue
+            year, month, day = (int(part) for part in match.groups())
+        else:
+            year, month, day = dates[doc_id * 3:doc_id * 3 + 3]
+            if year < 0:
+                continue
+        by_ymd.setdefault((year, month, day), []).append(doc_id)
+        by_ym.setdefault((year, month), []).append(doc_id)
+        by_md.setdefault((month, day), []).append(doc_id)
+        by_m.setdefault(month, []).append(doc_id)
+        dated.append(((year, month, day), doc_id))
+
+    dated.sort()
+    return {
+        'posts': posts,
+        'by_ymd': by_ymd,
+        'by_ym': by_ym,
+        'by_md': by_md,
+        'by_m': by_m,
+        'dates': [date for date, _ in dated],
+        'doc_ids': [doc_id for _, doc_id in dated],
+        'stats': {
+            'posts': len(posts),
+            'dated_posts': len(dated),
+            'build_ms': round((time.perf_counter() - start) * 1000, 2)
+        }
+    }
+
+def get_date_index(corpus=None):
+    """ブログ記事スナップショットに対応する日付インデックスを取得"""
+    return (corpus or get_blog_corpus()).index('date', build_date_index)
+
+def _posts_between(index, first, last):
+    """first〜last（(年, 月, 日)、両端を含む）の記事番号を新しい順に返す"""
+    lo = bisect_left(index['dates'], first)
+    hi = bisect_right(index['dates'], last)
+    return index['doc_ids'][lo:hi][::-1]
+
+def _relative_date_range(query, today):
+    """「今日」「先週」「先月」などを (最初の日, 最後の日) に変換"""
+    if '一昨日' in query or 'おととい' in query:
+        day = today - timedelta(days=2)
+        return day, day
+    if '昨日' in query:
+        day = today - timedelta(days=1)
+        return day, day
+    if '今日' in query:
+        return today, today
+    if '先週' in query:
+        monday = today - timedelta(days=today.weekday() + 7)
+        return monday, monday + timedelta(days=6)
+    if '今週' in query:
+        return today - timedelta(days=today.weekday()), today
+    if '先月' in query:
+        last_day = today.replace(day=1) - timedelta(days=1)
+        return last_day.replace(day=1), last_day
+    if '今月' in query:
+        return today.replace(day=1), today
+    return None
+
+def search_posts_by_date(query, max_results=3, corpus=None):
     """日付に関連する記事を検索"""
-    posts = get_all_blog_posts()
-    if not posts:
+    corpus = corpus or get_blog_corpus()
+    if not corpus.posts:
         return []
 
-    import re
-
-    # クエリから日付パターンを抽出
-    # 例: "10月29日", "10/29", "2025年10月", "2025.10.29", "11月"
-    matched_posts = []
+    index = get_date_index(corpus)
 
     # 月と日を抽出
-    month_match = re.search(r'(\d{1,2})月', query)
-    day_match = re.search(r'(\d{1,2})日', query)
-    year_match = re.search(r'(202\d)年', query)
+    month_match = DATE_MONTH_PATTERN.search(query)
+    day_match = DATE_DAY_PATTERN.search(query)
+    year_match = DATE_YEAR_PATTERN.search(query)
 
     # スラッシュ形式 (10/29)
-    slash_match = re.search(r'(\d{1,2})/(\d{1,2})', query)
-
-    for post in posts:
-        date_str = post.get('date', '')  # 例: "2025.10.29"
-
-        if not date_str:
-            continue
-
-        matched = False
-
-        # 年月日すべて指定された場合
-        if year_match and month_match and day_match:
-            year = year_match.group(1)
-            month = month_match.group(1).zfill(2)
-            day = day_match.group(1).zfill(2)
-            if f"{year}.{month}.{day}" in date_str:
-                matched = True
-
-        # 月日が指定された場合
-        elif month_match and day_match:
-            month = month_match.group(1).zfill(2)
-            day = day_match.group(1).zfill(2)
-            if f".{month}.{day}" in date_str:
-                matched = True
-
-        # スラッシュ形式
-        elif slash_match:
-            month = slash_match.group(1).zfill(2)
-            day = slash_match.group(2).zfill(2)
-            if f".{month}.{day}" in date_str:
-                matched = True
-
-        # 月だけ指定された場合
-        elif month_match:
-            month = month_match.group(1).zfill(2)
-            if f".{month}." in date_str:
-                matched = True
-
-        if matched:
-            matched_posts.append(post)
-
-    return matched_posts[:max_results]
+    slash_match = DATE_SLASH_PATTERN.search(query)
+
+    # 上旬・中旬・下旬 (10月中旬)
+    period_match = DATE_PERIOD_PATTERN.search(query)
+
+    # 年月日すべて指定された場合
+    if year_match and month_match and day_match:
+        doc_ids = index['by_ymd'].get((int(year_match.group(1)), int(month_match.group(1)), int(day_match.group(1))), [])
+
+    # 月日が指定された場合
+    elif month_match and day_match:
+        doc_ids = index['by_md'].get((int(month_match.group(1)), int(day_match.group(1))), [])
+
+    # スラッシュ形式
+    elif slash_match:
+        doc_ids = index['by_md'].get((int(slash_match.group(1)), int(slash_match.group(2))), [])
+
+    # 月の上旬・中旬・下旬
+    elif period_match:
+        month = int(period_match.group(1))
+        first_day, last_day = DATE_PERIOD_DAYS[period_match.group(2)]
+        doc_ids = [
+            doc_id
+            for day in range(first_day, last_day + 1)
+            for doc_id in index['by_md'].get((month, day), [])
+        ]
+
+    # 年月が指定された場合
+    elif year_match and month_match:
+        doc_ids = index['by_ym'].get((int(year_match.group(1)), int(month_match.group(1))), [])
+
+    # 月だけ指定された場合
+    elif month_match:
+        doc_ids = index['by_m'].get(int(month_match.group(1)), [])
+
+    # 「先週」「昨日」などの相対的な指定
+    else:
+        date_range = _relative_date_range(query, datetime.now(JST).date())
+        if date_range is None:
+            return []
+        first, last = date_range
+        doc_ids = _posts_between(index, (first.year, first.month, first.day), (last.year, last.month, last.day))
+
+    return [corpus.posts[doc_id] for doc_id in doc_ids[:max_results]]
+
+# ブログコンテキストのメモ（正規化したクエリとスナップショットの版ごと。「昨日」などを含むクエリは日付ごと）
+BLOG_CONTEXT_MEMO_SIZE = int(os.environ.get('BLOG_CONTEXT_MEMO_SIZE', 512))
+blog_context_memo = OrderedDict()
+blog_context_memo_lock = threading.Lock()
+blog_context_memo_stats = {'hits': 0, 'misses': 0}
+
+# 末尾の記号（「こんにちは！」と「こんにちは」を同じクエリとして扱う）
+QUERY_TRAILING_PATTERN = re.compile(r'[\s!?。、,.…〜~]+$')
+QUERY_SPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_query(query):
+    """検索用にクエリを正規化（NFKC・前後の空白と末尾の記号を除去・空白をまとめる）"""
+    query = unicodedata.normalize('NFKC', query).strip()
+    query = QUERY_TRAILING_PATTERN.sub('', query)
+    return QUERY_SPACE_PATTERN.sub(' ', query)
+
+def clear_blog_context_memo():
+    with blog_context_memo_lock:
+        blog_context_memo.clear()
 
 def build_context_with_blog(query):
-    """関連ブログ記事をコンテキストとして構築"""
+    """関連ブログ記事をコンテキストとして構築（同じクエリは記事が更新されるまで使い回す）"""
+    corpus = get_blog_corpus()
+    query = normalize_query(query)
+    # 「昨日」「先週」などは今日の日付で指す記事が変わるので、日付が変わったら作り直す
+    today = datetime.now(JST).date()
+    key = (query, corpus.version, today if _relative_date_range(query, today) else None)
+
+    with blog_context_memo_lock:
+        context = blog_context_memo.get(key)
+        if context is not None:
+            blog_context_memo.move_to_end(key)
+            blog_context_memo_stats['hits'] += 1
+            return context
+        blog_context_memo_stats['misses'] += 1
+
+    context = _build_context(corpus, query)
+
+    with blog_context_memo_lock:
+        blog_context_memo[key] = context
+        while len(blog_context_memo) > BLOG_CONTEXT_MEMO_SIZE:
+            blog_context_memo.popitem(last=False)
+    return context
+
+def _build_context(corpus, query):
     # 日付検索
-    date_posts = search_posts_by_date(query)
+    with metrics.time('retrieval_seconds', function='search_posts_by_date'):
+        date_posts = search_posts_by_date(query, corpus=corpus)
 
     # キーワードマッチで関連記事を検索
-    relevant_posts = search_relevant_posts(query, max_results=2)
+    with metrics.time('retrieval_seconds', function='search_relevant_posts'):
+        relevant_posts = search_relevant_posts(query, max_results=2, corpus=corpus)
 
     # 最新記事を取得
-    recent_posts = get_recent_posts(max_results=2)
+    with metrics.time('retrieval_seconds', function='get_recent_posts'):
+        recent_posts = get_recent_posts(max_results=2, corpus=corpus)
 
     # 重複を除いて結合（日付検索を優先）
     all_posts = date_posts.copy()
@@ -211,11 +1891,11 @@ def build_context_with_blog(query):
     if not all_posts:
         return ""
 
-    context = "\n\n【参考：康揮のブログ記事】\n"
+    parts = ["\n\n【参考：康揮のブログ記事】\n"]
     for post in all_posts:
-        context += f"\n■ {post['title']} ({post['date']})\n{post['content'][:500]}...\n" if len(post['content']) > 500 else f"\n■ {post['title']} ({post['date']})\n{post['content']}\n"
+        parts.append(f"\n■ {post['title']} ({post['date']})\n{post['snippet']}\n")
 
-    return context
+    return ''.join(parts)
 
 # システムプロンプト（丹羽康揮）
 system_prompt = """あなたは丹羽康揮（にわこうき）というAIアバターです。
@@ -349,6 +2029,168 @@ system_prompt = """あなたは丹羽康揮（にわこうき）というAIア
 
 短めの返答を心がけてください。"""
 
+# Claude のモデル
+CLAUDE_MODEL = 'claude-3-5-haiku-20241022'
+
+def summarize_history(session_id, dropped):
+    """トークン予算からあふれた発言を、これまでの要約に織り込んで要約し直す"""
+    try:
+        _, summary = conversation_history.get_history(session_id)
+        transcript = '\n'.join(
+            f"{'ユーザー' if m['role'] == 'user' else '康揮'}: {m['content']}" for m in dropped
+        )
+
+        def create():
+            with metrics.time('upstream_seconds', service='claude', call='summarize'):
+                return get_client().messages.create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=300,
+                    system='会話の要約係です。後で会話を続けるのに必要な事実（相手の名前・話題・約束など）だけを箇条書きで簡潔にまとめてください。',
+                    messages=[{
+                        'role': 'user',
+                        'content': f"これまでの要約:\n{summary or '（なし）'}\n\n追加の会話:\n{transcript}"
+                    }]
+                )
+
+        response = claude_limiter.call(create, claude_retry_after)
+        conversation_history.set_summary(session_id, response.content[0].text)
+    except Exception as e:
+        print(f'会話要約エラー: {str(e)}')
+        metrics.inc('errors_total', stage='summarize')
+
+# プロンプトの版（変わったら返答キャッシュは使わない）
+PERSONA_VERSION = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:12]
+
+# 初回の質問に対する返答キャッシュ（よくあるプロフィールの質問向け）
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60 * 60))
+# 文字 bigram の Jaccard 係数がこれ以上なら同じ質問とみなす
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get('RESPONSE_CACHE_THRESHOLD', 0.75))
+
+# 質問の正規化で取り除くもの（記号・空白、漢字/カタカナ直後の助詞、文末の言い回し）
+QUESTION_SYMBOL_PATTERN = re.compile(r'[\W_]+')
+QUESTION_PARTICLE_PATTERN = re.compile(r'(?<=[一-鿿゠-ヿ])(?:って|は|が|を|も)')
+QUESTION_ENDING_PATTERN = re.compile(r'(?:ですか|ますか|なんですか|なの|かな|ですね|だよね|って|は|か|の|よ|ね)+$')
+
+def normalize_question(text):
+    """質問を比較用に正規化（「誕生日はいつですか？」→「誕生日いつ」）"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = QUESTION_SYMBOL_PATTERN.sub('', text)
+    text = QUESTION_PARTICLE_PATTERN.sub('', text)
+    return QUESTION_ENDING_PATTERN.sub('', text) or text
+
+def _char_bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+class ResponseCache:
+    """正規化した質問 → 返答のキャッシュ
+
+    ペルソナの版とブログ記事スナップショットの版（scope）ごとに分け、完全一致が無ければ
+    文字 bigram の類似度が閾値以上のもののうち最も近いものを返す。
+    """
+
+    def __init__(self, max_entries, ttl, threshold):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'similar_hits': 0, 'misses': 0}
+
+    def get(self, scope, question):
+        normalized = normalize_question(question)
+        now = time.time()
+        with self.lock:
+            key = (scope, normalized)
+            entry = self.entries.get(key)
+            if entry is None:
+                # 完全一致が無ければ同じ scope の中で最も近い質問を探す
+                bigrams = _char_bigrams(normalized)
+                best_score = self.threshold
+                for candidate_key, candidate in self.entries.items():
+                    if candidate_key[0] != scope or now - candidate['created'] > self.ttl:
+                        continue
+                    score = len(bigrams & candidate['bigrams']) / len(bigrams | candidate['bigrams'])
+                    if score >= best_score:
+                        key, entry, best_score = candidate_key, candidate, score
+                if entry is not None:
+                    self.counters['similar_hits'] += 1
+
+            if entry is None or now - entry['created'] > self.ttl:
+                self.counters['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry['reply']
+
+    def put(self, scope, question, reply):
+        normalized = normalize_question(question)
+        with self.lock:
+            self.entries[(scope, normalized)] = {
+                'reply': reply,
+                'bigrams': _char_bigrams(normalized),
+                'created': time.time()
+            }
+            self.entries.move_to_end((scope, normalized))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'entries': len(self.entries)}
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_THRESHOLD)
+
+def cached_first_reply(session_id, user_message):
+    """初回の質問ならキャッシュ済みの返答を探す
+
+    (返答, scope) を返す。初回でなければ scope は None（キャッシュに入れない）。
+    見つかった場合は、後の会話がつながるよう履歴にも質問と返答を追加しておく。
+    """
+    if conversation_history.has_history(session_id):
+        return None, None
+
+    scope = (PERSONA_VERSION, get_blog_corpus().version)
+    reply = response_cache.get(scope, user_message)
+    if reply is not None:
+        append_history(session_id, 'user', user_message)
+        append_history(session_id, 'assistant', reply)
+    return reply, scope
+
+def prepare_chat(session_id, user_message):
+    """ユーザーの発言を履歴に追加し、Claude に渡す system と messages を作る"""
+    # ユーザーメッセージを履歴に追加（セッション ID ごとに管理）
+    append_history(session_id, 'user', user_message)
+    messages, summary = conversation_history.get_history(session_id)
+
+    # 固定のペルソナ部分はプロンプトキャッシュに載せ、毎回変わる部分は後ろに別ブロックで付ける
+    enhanced_system_prompt = [
+        {'type': 'text', 'text': system_prompt, 'cache_control': {'type': 'ephemeral'}}
+    ]
+    if summary:
+        enhanced_system_prompt.append({
+            'type': 'text',
+            'text': f"以下はこのユーザーとのこれまでの会話の要約です。\n{summary}"
+        })
+
+    # 関連ブログ記事をコンテキストとして追加
+    blog_context = build_context_with_blog(user_message)
+    metrics.observe('blog_context_chars', len(blog_context))
+    if blog_context:
+        enhanced_system_prompt.append({
+            'type': 'text',
+            'text': f"以下はあなた（康揮）が書いたブログ記事の内容です。質問に関連する場合は、この情報を参考にして回答してください。ただし、話し方のスタイルは崩さないでください。{blog_context}"
+        })
+
+    return enhanced_system_prompt, messages
+
+def append_history(session_id, role, content):
+    """履歴に発言を追加（あふれた古い発言は設定に応じて要約に回す）"""
+    dropped = conversation_history.append(session_id, role, content)
+    if dropped and CHAT_HISTORY_SUMMARIZE:
+        background_executor.submit(summarize_history, session_id, dropped)
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
@@ -359,82 +2201,209 @@ def chat():
         if not user_message:
             return jsonify({'error': 'メッセージが空です'}), 400
         
-        # セッション ID ごとに会話履歴を管理
-        if session_id not in conversation_history:
-            conversation_history[session_id] = []
+        # よくある初回の質問はキャッシュから返す
+        cached_reply, cache_scope = cached_first_reply(session_id, user_message)
+        if cached_reply is not None:
+            return jsonify({'reply': cached_reply})
         
-        # ユーザーメッセージを履歴に追加
-        conversation_history[session_id].append({
-            'role': 'user',
-            'content': user_message
-        })
-        
-        # 関連ブログ記事をコンテキストとして追加
-        blog_context = build_context_with_blog(user_message)
-        enhanced_system_prompt = system_prompt
-        if blog_context:
-            enhanced_system_prompt += f"\n\n以下はあなた（康揮）が書いたブログ記事の内容です。質問に関連する場合は、この情報を参考にして回答してください。ただし、話し方のスタイルは崩さないでください。{blog_context}"
+        enhanced_system_prompt, messages = prepare_chat(session_id, user_message)
 
         # Claude API に送信
-        response = get_client().messages.create(
-            model='claude-3-5-haiku-20241022',
-            max_tokens=200,
-            system=enhanced_system_prompt,
-            messages=conversation_history[session_id]
-        )
+        def create():
+            # 枠の待ち時間（upstream_wait_seconds）と再試行の待ちは含めず、API 呼び出しだけを計る
+            with metrics.time('upstream_seconds', service='claude', call='messages'):
+                return get_client().messages.create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=200,
+                    system=enhanced_system_prompt,
+                    messages=messages
+                )
+
+        response = claude_limiter.call(create, claude_retry_after)
+        conversation_history.record_usage(response.usage)
         
         # AI の返答
         ai_reply = response.content[0].text
         
         # AI の返答を履歴に追加
-        conversation_history[session_id].append({
-            'role': 'assistant',
-            'content': ai_reply
-        })
+        append_history(session_id, 'assistant', ai_reply)
+        if cache_scope is not None:
+            response_cache.put(cache_scope, user_message, ai_reply)
         
         return jsonify({'reply': ai_reply})
     
+    except UpstreamOverloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         print(f'エラー: {str(e)}')
+        metrics.inc('errors_total', stage='chat')
         return jsonify({'error': str(e)}), 500
 
-def split_text(text, max_length=100):
-    """テキストを句読点で分割（最大文字数を考慮）"""
-    if len(text) <= max_length:
-        return [text]
+def sse_event(event, data):
+    """Server-Sent Events の1イベント分の文字列"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    chunks = []
-    current_chunk = ""
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """返答を Server-Sent Events で少しずつ返すエンドポイント
 
-    # 句点・読点で分割
-    sentences = text.replace('。', '。\n').replace('、', '、\n').replace('！', '！\n').replace('？', '？\n').split('\n')
+    delta イベントで返答の断片を送り、最後に done イベントで全文・usage・所要時間を送る。
+    """
+    try:
+        data = request.json
+        user_message = data.get('message')
+        session_id = request.remote_addr
 
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence:
-            continue
+        if not user_message:
+            return jsonify({'error': 'メッセージが空です'}), 400
 
-        # 現在のチャンクに追加できるか確認
-        if len(current_chunk) + len(sentence) <= max_length:
-            current_chunk += sentence
-        else:
-            # 現在のチャンクを保存
-            if current_chunk:
-                chunks.append(current_chunk)
-
-            # 1文が長すぎる場合は強制分割
-            if len(sentence) > max_length:
-                for i in range(0, len(sentence), max_length):
-                    chunks.append(sentence[i:i+max_length])
-                current_chunk = ""
+        start = time.perf_counter()
+        cached_reply, cache_scope = cached_first_reply(session_id, user_message)
+        if cached_reply is None:
+            enhanced_system_prompt, messages = prepare_chat(session_id, user_message)
+    except Exception as e:
+        print(f'エラー: {str(e)}')
+        metrics.inc('errors_total', stage='chat')
+        return jsonify({'error': str(e)}), 500
+
+    def generate_cached():
+        yield sse_event('delta', {'text': cached_reply})
+        yield sse_event('done', {
+            'reply': cached_reply,
+            'usage': {key: 0 for key in USAGE_KEYS},
+            'cached': True,
+            'timing': {
+                'first_token_ms': round((time.perf_counter() - start) * 1000, 1),
+                'total_ms': round((time.perf_counter() - start) * 1000, 1)
+            }
+        })
+
+    def generate():
+        first_token_ms = None
+        try:
+            with claude_limiter.slot():
+                # 枠の待ち時間は含めず、枠を取ってから最初のトークンまでを計る
+                upstream_start = time.perf_counter()
+                with get_client().messages.stream(
+                    model=CLAUDE_MODEL,
+                    max_tokens=200,
+                    system=enhanced_system_prompt,
+                    messages=messages
+                ) as stream:
+                    for text in stream.text_stream:
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - start) * 1000
+                            metrics.observe('upstream_seconds', time.perf_counter() - upstream_start,
+                                            service='claude', call='stream')
+                        yield sse_event('delta', {'text': text})
+                    final_message = stream.get_final_message()
+
+            usage = conversation_history.record_usage(final_message.usage)
+            ai_reply = ''.join(block.text for block in final_message.content if block.type == 'text')
+
+            # 返答が最後まで届いたら履歴に追加
+            append_history(session_id, 'assistant', ai_reply)
+            if cache_scope is not None:
+                response_cache.put(cache_scope, user_message, ai_reply)
+
+            yield sse_event('done', {
+                'reply': ai_reply,
+                'usage': usage,
+                'timing': {
+                    'first_token_ms': round(first_token_ms or 0, 1),
+                    'total_ms': round((time.perf_counter() - start) * 1000, 1)
+                }
+            })
+        except UpstreamOverloaded as e:
+            yield sse_event('error', {'error': str(e), 'overloaded': True})
+        except Exception as e:
+            print(f'ストリーミングエラー: {str(e)}')
+            metrics.inc('errors_total', stage='chat_stream')
+            yield sse_event('error', {'error': str(e)})
+
+    response = Response(generate() if cached_reply is None else generate_cached(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# 音声合成のチャンク分割
+# 先頭チャンクは最初の短い句（「いやー、」など）だけにして最初の音声を早く返し、
+# 以降はチャンクを TTS_CHUNK_GROWTH 倍ずつ TTS_CHUNK_MAX_LENGTH 文字まで大きくしてリクエスト数を減らす
+# （2つ目は先頭と並列に合成するので、先頭の再生が終わるまでに間に合う大きさならよい）
+TTS_FIRST_CHUNK_LENGTH = int(os.environ.get('TTS_FIRST_CHUNK_LENGTH', 20))
+TTS_FIRST_CHUNK_MIN_LENGTH = int(os.environ.get('TTS_FIRST_CHUNK_MIN_LENGTH', 4))
+TTS_CHUNK_MAX_LENGTH = int(os.environ.get('TTS_CHUNK_MAX_LENGTH', 200))
+TTS_CHUNK_GROWTH = float(os.environ.get('TTS_CHUNK_GROWTH', 6))
+
+# 区切ってよい位置（直後で切る）と、その区切りの強さ（大きいほど抑揚が崩れにくい）
+# 文末 > 読点 > かっこ閉じ・空白・中点 > 助詞の後で漢字・カタカナ・英数字が始まる所
+# （助詞に限るのは、お金・ご飯・お父さんのような接頭辞や、その時・この前のような語の途中で切らないため）
+CHUNK_BOUNDARY_PATTERNS = (
+    (3, re.compile(r'[。．！？!?\n…]+[」』）)】〕]*')),
+    (2, re.compile(r'[、，,；;：:]+[」』）)】〕]*')),
+    (1, re.compile(r'[」』）)】〕]+|[\s　・]+')),
+    (0, re.compile(r'(?<![おご])(?:から|まで|より|(?<![こそあど])の|[はがをにでともへ])(?=[一-鿿々〆ァ-ヺＡ-Ｚａ-ｚ０-９A-Za-z0-9])'))
+)
+
+def chunk_boundaries(text):
+    """text の区切り候補 [(区切る位置, 強さ), ...]（位置の昇順）"""
+    boundaries = {}
+    for rank, pattern in CHUNK_BOUNDARY_PATTERNS:
+        for match in pattern.finditer(text):
+            end = match.end()
+            if 0 < end < len(text) and end not in boundaries:
+                boundaries[end] = rank
+    return sorted(boundaries.items())
+
+def plan_chunks(text, max_length=None, first_length=None, growth=None):
+    """テキストを音声合成のチャンクに分けるジェネレータ
+
+    先頭チャンクは first_length 文字以内で、最初の句読点までの短い句を優先する（0 なら先頭も大きく取る）。
+    以降のチャンクの上限は前の上限の growth 倍ずつ増やし、max_length で頭打ちにする。
+    どのチャンクも上限の後半にある一番強い区切り（文末 > 読点 > …）で切り、区切りが無いときだけ文字数で切る。
+    """
+    max_length = max_length or TTS_CHUNK_MAX_LENGTH
+    first_length = TTS_FIRST_CHUNK_LENGTH if first_length is None else first_length
+    growth = growth or TTS_CHUNK_GROWTH
+    text = text.strip()
+    boundaries = chunk_boundaries(text)
+    positions = [position for position, _ in boundaries]
+
+    start = 0
+    limit = min(first_length, max_length) if first_length else max_length
+    first = bool(first_length)
+    while start < len(text):
+        if len(text) - start <= limit:
+            yield text[start:]
+            return
+
+        window = boundaries[bisect_right(positions, start):bisect_right(positions, start + limit)]
+        end = None
+        if first:
+            # 最初の句読点（短すぎる句は次の句までつなげる）
+            end = next((position for position, rank in window
+                        if rank >= 2 and position - start >= TTS_FIRST_CHUNK_MIN_LENGTH), None)
+        if end is None:
+            # 後半にある区切りを優先し、強さが同じなら遠い方（チャンクを大きく）
+            back_half = [boundary for boundary in window if boundary[0] - start > limit // 2]
+            candidates = back_half if any(rank >= 2 for _, rank in back_half) else window
+            if candidates:
+                end = max(candidates, key=lambda boundary: (boundary[1], boundary[0]))[0]
             else:
-                current_chunk = sentence
+                end = start + limit
 
-    # 残りを追加
-    if current_chunk:
-        chunks.append(current_chunk)
+        chunk = text[start:end].strip()
+        if chunk:
+            yield chunk
+        start = end
+        while start < len(text) and text[start].isspace():
+            start += 1
+        limit = min(max(int(limit * growth), limit + 1), max_length)
+        first = False
 
-    return chunks
+def split_text(text, max_length=None, first_length=None):
+    """テキストを句読点で分割（plan_chunks の結果をリストで返す）"""
+    return list(plan_chunks(text, max_length, first_length))
 
 # 読み仮名辞書（TTS用）
 reading_corrections = {
@@ -519,83 +2488,1342 @@ reading_corrections = {
     # その他追加したい読み間違い修正をここに追加
 }
 
+def compile_reading_pattern(corrections):
+    """読み仮名辞書の見出し語を1つの正規表現にまとめる
+
+    見出し語を長い順に並べておくと、同じ位置から始まる候補のうち最長のものが一致する。
+    テキストを左から1回走査するだけで最長一致の置き換え位置が決まる
+    （「海沿い」は「海」より、「丹羽康揮」は「丹羽」より優先される）。
+    """
+    words = sorted((wrong for wrong in corrections if wrong), key=len, reverse=True)
+    if not words:
+        return None
+    return re.compile('(' + '|'.join(re.escape(wrong) for wrong in words) + ')')
+
+reading_pattern = compile_reading_pattern(reading_corrections)
+
+def reload_reading_corrections(corrections=None):
+    """読み仮名辞書を差し替えてパターンを作り直す"""
+    global reading_corrections, reading_pattern
+    if corrections is not None:
+        reading_corrections = corrections
+    reading_pattern = compile_reading_pattern(reading_corrections)
+
 def correct_reading(text):
     """テキストの読み間違いを修正"""
-    corrected_text = text
-    for wrong, correct in reading_corrections.items():
-        corrected_text = corrected_text.replace(wrong, correct)
-    return corrected_text
+    if reading_pattern is None:
+        return text
+
+    # split の結果は奇数番目が一致した見出し語になる
+    parts = reading_pattern.split(text)
+    if len(parts) == 1:
+        return text
+    parts[1::2] = [reading_corrections[wrong] for wrong in parts[1::2]]
+    return ''.join(parts)
+
+# ElevenLabs 設定
+ELEVENLABS_MODEL_ID = 'eleven_multilingual_v2'
+ELEVENLABS_VOICE_SETTINGS = {
+    "stability": 0.7,
+    "similarity_boost": 0.85,
+    "style": 0.0,
+    "use_speaker_boost": True
+}
+
+# 音声合成の並列数（プロセス全体の上限と1リクエストあたりの上限）
+TTS_MAX_WORKERS = int(os.environ.get('TTS_MAX_WORKERS', 8))
+TTS_REQUEST_FANOUT = int(os.environ.get('TTS_REQUEST_FANOUT', 4))
+
+tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix='tts')
+
+# ElevenLabs への接続はプロセス内で使い回す（チャンクごとに TLS 接続を張り直さない）
+ELEVENLABS_API_BASE = os.environ.get('ELEVENLABS_API_BASE', 'https://api.elevenlabs.io')
+elevenlabs_session = requests.Session()
+elevenlabs_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=TTS_MAX_WORKERS))
+elevenlabs_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=TTS_MAX_WORKERS))
+
+# 音声キャッシュ設定（メモリ上の LRU とディスク上の LRU の2段）
+TTS_CACHE_MEMORY_BYTES = int(os.environ.get('TTS_CACHE_MEMORY_BYTES', 32 * 1024 * 1024))
+TTS_CACHE_DISK_BYTES = int(os.environ.get('TTS_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+TTS_CACHE_DIR = os.environ.get('TTS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ai-kouki-tts-cache'))
+# ディレクトリは全ワーカーで共有するので、上限のこの割合を書き込むごとに実際の大きさを数え直す
+TTS_CACHE_RESCAN_RATIO = 1 / 16
+
+# 音声の出力形式（ElevenLabs の output_format）。format パラメータか Accept ヘッダーで選ぶ
+# bitrate は形式ごとの目安のビットレート（節約できたバイト数の見積もりに使う）
+AUDIO_FORMATS = {
+    'mp3_44100_128': {'mimetype': 'audio/mpeg', 'container': 'mp3', 'bitrate': 128000},
+    'mp3_44100_64': {'mimetype': 'audio/mpeg', 'container': 'mp3', 'bitrate': 64000},
+    'mp3_22050_32': {'mimetype': 'audio/mpeg', 'container': 'mp3', 'bitrate': 32000},
+    'opus_48000_32': {'mimetype': 'audio/ogg', 'container': 'ogg', 'bitrate': 32000},
+    'opus_48000_64': {'mimetype': 'audio/ogg', 'container': 'ogg', 'bitrate': 64000}
+}
+AUDIO_FORMAT_ALIASES = {'mp3': 'mp3_44100_128', 'mp3-low': 'mp3_22050_32', 'opus': 'opus_48000_32', 'ogg': 'opus_48000_32'}
+# Accept ヘッダーに明示された MIME タイプから選ぶ形式（*/* なら TTS_OUTPUT_FORMAT）
+AUDIO_ACCEPT_FORMATS = {'audio/mpeg': 'mp3_44100_128', 'audio/ogg': 'opus_48000_32', 'audio/opus': 'opus_48000_32'}
+# 既定の出力形式（短い名前も使える。知らない名前なら起動時に止める）
+TTS_OUTPUT_FORMAT = os.environ.get('TTS_OUTPUT_FORMAT', 'mp3_44100_128')
+TTS_OUTPUT_FORMAT = AUDIO_FORMAT_ALIASES.get(TTS_OUTPUT_FORMAT, TTS_OUTPUT_FORMAT)
+if TTS_OUTPUT_FORMAT not in AUDIO_FORMATS:
+    raise ValueError(f'TTS_OUTPUT_FORMAT が不明な音声形式です: {TTS_OUTPUT_FORMAT}')
+# 節約できたバイト数の比較基準（ElevenLabs の既定の形式）
+AUDIO_BASELINE_FORMAT = 'mp3_44100_128'
+
+def negotiate_audio_format(requested=None, accept_header=None):
+    """format パラメータ（形式名か短い名前）と Accept ヘッダーから出力形式を決める（知らない名前は ValueError）"""
+    if requested:
+        name = AUDIO_FORMAT_ALIASES.get(requested, requested)
+        if name not in AUDIO_FORMATS:
+            raise ValueError(f'不明な音声形式です: {requested}')
+        return name
+    if not accept_header:
+        return TTS_OUTPUT_FORMAT
+    default = AUDIO_FORMATS[TTS_OUTPUT_FORMAT]['mimetype']
+    mimetypes = [default] + [mimetype for mimetype in AUDIO_ACCEPT_FORMATS if mimetype != default]
+    match = parse_accept_header(accept_header, MIMEAccept).best_match(mimetypes)
+    if match is None or match == default:
+        return TTS_OUTPUT_FORMAT
+    return AUDIO_ACCEPT_FORMATS[match]
+
+def tts_cache_key(text, voice_id, model_id=ELEVENLABS_MODEL_ID, voice_settings=ELEVENLABS_VOICE_SETTINGS,
+                  output_format=TTS_OUTPUT_FORMAT):
+    """音声の内容を決める要素からキャッシュキー（SHA-256）を作る"""
+    source = json.dumps([text, voice_id, model_id, voice_settings, output_format], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+class TTSCache:
+    """チャンク単位の音声キャッシュ
+
+    メモリ側・ディスク側それぞれバイト数の上限を持ち、超えたら最も古く使われたものから捨てる。
+    ディスク側に見つかったものはメモリ側にも載せる。
+    ディスク側のディレクトリは gunicorn の全ワーカーで共有するので、上限を超えそうになったら
+    （と、ある程度書き込むごとに）ディレクトリを数え直し、他のワーカーの分も含めて古いものから捨てる。
+    """
+
+    def __init__(self, memory_limit, disk_limit, directory):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        # 最後に数え直してからこのプロセスが書き込んだバイト数
+        self.disk_written = 0
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'hit_bytes': 0,
+            'stored_bytes': 0,
+            'evictions': 0
+        }
+        if disk_limit > 0:
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        """起動時に既存のキャッシュファイルを最終利用時刻順に読み込む"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = self._scan_disk()
+        except OSError as e:
+            print(f'音声キャッシュ読み込みエラー: {str(e)}')
+            self.disk_limit = 0
+            return
+        with self.lock:
+            self._index_disk(entries)
+
+    def _scan_disk(self):
+        """ディレクトリのキャッシュファイルを (最終利用時刻, 名前, サイズ) の古い順で返す"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # 数えている間に他のワーカーが捨てた
+                    continue
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        return sorted(entries)
+
+    def _index_disk(self, entries):
+        """数え直した結果でディスク側の一覧を作り直し、上限を超えていれば捨てる"""
+        self.disk = OrderedDict((name, size) for _, name, size in entries)
+        self.disk_bytes = sum(self.disk.values())
+        self.disk_written = 0
+        self._evict_disk()
+
+    def _rescan_disk(self):
+        try:
+            entries = self._scan_disk()
+        except OSError as e:
+            print(f'音声キャッシュ読み込みエラー: {str(e)}')
+            return
+        with self.lock:
+            self._index_disk(entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                self.counters['hit_bytes'] += len(data)
+                return data
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+
+        if on_disk:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                data = None
+            if data is not None:
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                    self.counters['hit_bytes'] += len(data)
+                    self._put_memory(key, data)
+                return data
+
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key, data):
+        with self.lock:
+            self.counters['stored_bytes'] += len(data)
+            self._put_memory(key, data)
+            if self.disk_limit <= 0 or len(data) > self.disk_limit or key in self.disk:
+                return
+
+        try:
+            tmp_path = f'{self._path(key)}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f'音声キャッシュ書き込みエラー: {str(e)}')
+            return
+
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = len(data)
+                self.disk_bytes += len(data)
+                self.disk_written += len(data)
+            # 他のワーカーが書き込んだ分はここでは分からないので、捨てる前に実際の大きさを数え直す
+            rescan = (self.disk_bytes > self.disk_limit
+                      or self.disk_written >= self.disk_limit * TTS_CACHE_RESCAN_RATIO)
+        if rescan:
+            self._rescan_disk()
+
+    def _put_memory(self, key, data):
+        if len(data) > self.memory_limit:
+            return
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_limit:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.counters['evictions'] += 1
+
+    def _evict_disk(self):
+        while self.disk_bytes > self.disk_limit and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            self.counters['evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                'memory_items': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'disk_items': len(self.disk),
+                'disk_bytes': self.disk_bytes
+            }
+
+tts_cache = TTSCache(TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES, TTS_CACHE_DIR)
+
+def get_elevenlabs_settings():
+    """ElevenLabs の API キーと声の ID"""
+    return os.environ.get('ELEVENLABS_API_KEY'), os.environ.get('ELEVENLABS_VOICE_ID', 'nqkmNHx4hSecnBDJh39A')
+
+class TTSError(Exception):
+    """ElevenLabs が音声を返さなかった"""
+
+class AudioJoiner:
+    """チャンクごとの音声ファイルを1本のストリームにつなぐ（この基底クラスはそのままつなぐ）
+
+    チャンクごとに start() を呼んでから feed() でバイト列を渡し、返ったバイト列を順に出力する。
+    最後に finish() の分を出す。stripped は取り除いたヘッダーのバイト数。
+    """
+
+    def __init__(self, audio_format):
+        self.audio_format = audio_format
+        self.stripped = 0
+        self.chunks = 0
+
+    def start(self):
+        self.chunks += 1
+
+    def feed(self, data):
+        return data
+
+    def finish(self):
+        return b''
+
+    def duration(self, output_bytes):
+        """出力した音声の長さ（秒）。この基底クラスでは形式の目安のビットレートから見積もる"""
+        return output_bytes * 8 / AUDIO_FORMATS[self.audio_format]['bitrate']
+
+    def join(self, chunks):
+        parts = []
+        for chunk in chunks:
+            self.start()
+            parts.append(self.feed(chunk))
+        parts.append(self.finish())
+        return b''.join(parts)
+
+    def report(self, output_bytes):
+        """応答1件分の大きさと、既定の形式のチャンクをそのままつないだ場合より減ったバイト数（見積もり）"""
+        duration = self.duration(output_bytes)
+        baseline = round(duration * AUDIO_FORMATS[AUDIO_BASELINE_FORMAT]['bitrate'] / 8)
+        return {
+            'format': self.audio_format,
+            'chunks': self.chunks,
+            'bytes': output_bytes,
+            'duration_ms': round(duration * 1000),
+            'header_bytes_stripped': self.stripped,
+            'bytes_saved': max(baseline - output_bytes, 0) + self.stripped
+        }
 
-@app.route('/api/tts', methods=['POST'])
+# MPEG-1 / MPEG-2・2.5 Layer III のビットレート（kbps）とサンプリング周波数
+MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+MP3_INFO_TAGS = (b'Xing', b'Info')
+
+def parse_mp3_frame_header(header):
+    """MP3（Layer III）のフレームヘッダー4バイトから (フレーム長, サイド情報の長さ, ビットレート) を返す（違えば None）"""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = (header[1] >> 1) & 3
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[3 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    mono = header[3] >> 6 == 3
+    if version == 3:
+        return 144 * bitrate // sample_rate + padding, 17 if mono else 32, bitrate
+    return 72 * bitrate // sample_rate + padding, 9 if mono else 17, bitrate
+
+def id3v2_length(data):
+    """先頭の ID3v2 タグの長さ（ヘッダーが揃っていなければ None、タグが無ければ 0）"""
+    if len(data) < 10:
+        return None if b'ID3'.startswith(bytes(data[:3])) else 0
+    if data[:3] != b'ID3':
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    # フッター付きならさらに10バイト
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+class MP3Joiner(AudioJoiner):
+    """MP3 のチャンクをつなぐ
+
+    2つ目以降のチャンクの ID3v2 タグと、各チャンク先頭の Xing/Info/VBRI フレーム（そのチャンクだけの
+    フレーム数・長さが入っていて、つないだ後は再生時間やシークを狂わせる）、末尾の ID3v1 タグを取り除く。
+    出力はフレーム単位で、途中で打ち切られたときは揃わなかった最後のフレームを捨てる。
+    """
+
+    # 末尾の ID3v1 タグの長さ（チャンクの最後まで来るまでこの分は出さずに持っておく）
+    ID3V1_LENGTH = 128
+
+    def __init__(self, audio_format):
+        super().__init__(audio_format)
+        self.head = None
+        self.tail = b''
+        # フレームに関係なくそのまま出すバイト列（先頭のチャンクのタグ・前のチャンクの残り）
+        self.ready = b''
+        self.passthrough = False
+        self.bitrate = None
+
+    def start(self):
+        super().start()
+        if self.head:
+            # 判定できないほど短かったチャンクはそのまま流す
+            self.tail += bytes(self.head)
+        self._drop_id3v1()
+        self.ready += self.tail
+        self.tail = b''
+        self.head = bytearray()
+        self.skip = 0
+        self.passthrough = False
+
+    def feed(self, data):
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            self.stripped += skipped
+            data = data[skipped:]
+        if self.head is not None:
+            self.head += data
+            data = self._strip_head()
+            if data is None:
+                return b''
+        data = self._hold_tail(data) if self.passthrough else self._hold_frames(data)
+        if self.ready:
+            data, self.ready = self.ready + data, b''
+        return data
+
+    def _strip_head(self):
+        """チャンク先頭のタグと情報フレームを判定して取り除く（判定に足りなければ None）"""
+        head = self.head
+        tag_length = id3v2_length(head)
+        if tag_length is None:
+            return None
+        if tag_length and self.chunks > 1:
+            # 先頭のチャンク以外のタグは捨てる（まだ届いていない分は次の feed で捨てる）
+            self.stripped += min(tag_length, len(head))
+            self.skip = max(tag_length - len(head), 0)
+            del head[:tag_length]
+            if self.skip:
+                return b''
+            tag_length = 0
+        elif len(head) < tag_length:
+            # 先頭のチャンクのタグは残す（揃うまで待つ）
+            return None
+        frame = parse_mp3_frame_header(head[tag_length:tag_length + 4])
+        if frame is None:
+            if len(head) - tag_length < 4:
+                return None
+            # MP3 のフレームで始まっていなければそのまま流す
+            self.head = None
+            self.passthrough = True
+            return bytes(head)
+        length, side_info, bitrate = frame
+        self.bitrate = self.bitrate or bitrate
+        if len(head) < tag_length + max(length, 40):
+            return None
+        info_offset = tag_length + 4 + side_info
+        if (bytes(head[info_offset:info_offset + 4]) in MP3_INFO_TAGS
+                or head[tag_length + 36:tag_length + 40] == b'VBRI'):
+            self.stripped += length
+            del head[tag_length:tag_length + length]
+        self.head = None
+        # 先頭のチャンクのタグはフレームではないので、フレームとは別に出す
+        self.ready += bytes(head[:tag_length])
+        return bytes(head[tag_length:])
+
+    def _hold_frames(self, data):
+        """揃ったフレームだけを出し、途中のフレームと末尾の ID3v1 タグは持っておく"""
+        data = self.tail + data
+        offset = 0
+        while True:
+            frame = parse_mp3_frame_header(data[offset:offset + 4])
+            if frame is None:
+                if len(data) - offset >= 4 and data[offset:offset + 3] != b'TAG':
+                    # フレームでもタグでもなければ、以降は末尾だけ持ってそのまま流す
+                    self.passthrough = True
+                    self.tail = b''
+                    return data[:offset] + self._hold_tail(data[offset:])
+                break
+            if offset + frame[0] > len(data):
+                break
+            offset += frame[0]
+        self.tail = data[offset:]
+        return data[:offset]
+
+    def _hold_tail(self, data):
+        data = self.tail + data
+        self.tail = data[-self.ID3V1_LENGTH:]
+        return data[:-self.ID3V1_LENGTH]
+
+    def _drop_id3v1(self):
+        if len(self.tail) >= self.ID3V1_LENGTH and self.tail[-self.ID3V1_LENGTH:][:3] == b'TAG':
+            self.tail = self.tail[:-self.ID3V1_LENGTH]
+            self.stripped += self.ID3V1_LENGTH
+
+    def finish(self):
+        if self.head:
+            self.tail += bytes(self.head)
+        self.head = None
+        self._drop_id3v1()
+        data, self.tail = self.tail, b''
+        if not self.passthrough and data[:3] != b'TAG':
+            frame = parse_mp3_frame_header(data[:4])
+            if (frame is None and len(data) < 4) or (frame is not None and frame[0] > len(data)):
+                # 途中で打ち切られて揃わなかったフレームは捨てる
+                data = b''
+        data, self.ready = self.ready + data, b''
+        return data
+
+    def duration(self, output_bytes):
+        # ElevenLabs の MP3 は固定ビットレートなので、先頭フレームのビットレートから長さが決まる
+        bitrate = self.bitrate or AUDIO_FORMATS[self.audio_format]['bitrate']
+        return output_bytes * 8 / bitrate
+
+def _ogg_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+OGG_CRC_TABLE = _ogg_crc_table()
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+def ogg_crc(data):
+    """Ogg のページの CRC（多項式 0x04C11DB7、反転なし）"""
+    crc = 0
+    table = OGG_CRC_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ byte]
+    return crc
+
+class OggOpusJoiner(AudioJoiner):
+    """Ogg Opus のチャンクを1本の論理ストリームにつなぐ
+
+    2つ目以降のチャンクの OpusHead / OpusTags のページを捨て、シリアル番号・ページ番号を通しでふり直し、
+    グラニュール位置をそれまでのチャンクの長さだけずらす（CRC は計算し直す）。
+    最後のページにだけ EOS を立てるため、直近の1ページは次のページか finish() まで持っておく。
+    """
+
+    BOS = 0x02
+    EOS = 0x04
+    # 各チャンク先頭のヘッダーパケット（OpusHead と OpusTags）
+    HEADER_PACKETS = 2
+
+    def __init__(self, audio_format):
+        super().__init__(audio_format)
+        self.buffer = bytearray()
+        self.serial = None
+        self.sequence = 0
+        self.base_granule = 0
+        self.last_granule = 0
+        self.pre_skip = 0
+        self.header_packets = 0
+        self.held = None
+        self.passthrough = False
+
+    def feed(self, data):
+        if self.passthrough:
+            return data
+        self.buffer += data
+        out = []
+        while len(self.buffer) >= OGG_PAGE_HEADER.size:
+            if self.buffer[:4] != b'OggS':
+                # Ogg でなければ以降はそのまま流す
+                self.passthrough = True
+                out.append(self._release())
+                out.append(bytes(self.buffer))
+                self.buffer.clear()
+                break
+            segments = self.buffer[26]
+            header_length = OGG_PAGE_HEADER.size + segments
+            if len(self.buffer) < header_length:
+                break
+            lacing = self.buffer[OGG_PAGE_HEADER.size:header_length]
+            page_length = header_length + sum(lacing)
+            if len(self.buffer) < page_length:
+                break
+            page = bytes(self.buffer[:page_length])
+            del self.buffer[:page_length]
+            out.append(self._page(page, header_length, lacing))
+        return b''.join(out)
+
+    def _page(self, page, header_length, lacing):
+        _, version, flags, granule, serial, _, _, segments = OGG_PAGE_HEADER.unpack_from(page)
+        if flags & self.BOS:
+            if self.serial is None:
+                # 先頭のチャンクのヘッダーは残す（OpusHead の pre-skip は長さの計算に使う）
+                self.serial = serial
+                self.pre_skip = struct.unpack_from('<H', page, header_length + 10)[0]
+            else:
+                self.header_packets = self.HEADER_PACKETS
+                self.base_granule = self.last_granule
+        if self.header_packets:
+            # このページで終わるパケットの数（255 未満の lacing 値の数）だけ減らす
+            self.header_packets = max(self.header_packets - sum(1 for value in lacing if value < 255), 0)
+            self.stripped += len(page)
+            return b''
+
+        if granule != -1:
+            granule += self.base_granule
+            self.last_granule = granule
+        flags &= ~self.EOS
+        if self.sequence:
+            flags &= ~self.BOS
+        page = bytearray(page)
+        OGG_PAGE_HEADER.pack_into(page, 0, b'OggS', version, flags, granule, self.serial, self.sequence, 0, segments)
+        self.sequence += 1
+        struct.pack_into('<I', page, 22, ogg_crc(page))
+        out = self._release()
+        self.held = page
+        return out
+
+    def _release(self):
+        held, self.held = self.held, None
+        return bytes(held) if held else b''
+
+    def finish(self):
+        if self.serial is not None:
+            # 途中で打ち切られて揃わなかったページは捨てる（EOS のページの後ろに半端なデータを残さない）
+            self.buffer.clear()
+        if self.held is None:
+            return self._release() + bytes(self.buffer)
+        # 最後のページに EOS を立てて CRC を計算し直す
+        page = self.held
+        page[5] |= self.EOS
+        struct.pack_into('<I', page, 22, 0)
+        struct.pack_into('<I', page, 22, ogg_crc(page))
+        return self._release() + bytes(self.buffer)
+
+    def duration(self, output_bytes):
+        if self.passthrough or not self.last_granule:
+            return super().duration(output_bytes)
+        return max(self.last_granule - self.pre_skip, 0) / 48000
+
+# コンテナごとのつなぎ方
+AUDIO_JOINERS = {
+    'mp3': MP3Joiner,
+    'ogg': OggOpusJoiner
+}
+
+def create_audio_joiner(audio_format):
+    return AUDIO_JOINERS.get(AUDIO_FORMATS[audio_format]['container'], AudioJoiner)(audio_format)
+
+def record_audio_report(report):
+    metrics.inc('tts_response_bytes_total', report['bytes'], format=report['format'])
+    metrics.inc('tts_bytes_saved_total', report['bytes_saved'], format=report['format'])
+
+def elevenlabs_request(chunk, voice_id, api_key, stream=False, output_format=TTS_OUTPUT_FORMAT):
+    """ElevenLabs の音声合成 API を呼ぶための URL・ヘッダー・ペイロード"""
+    url = f"{ELEVENLABS_API_BASE}/v1/text-to-speech/{voice_id}"
+    if stream:
+        url += "/stream"
+    url += f"?output_format={output_format}"
+    headers = {
+        "Accept": AUDIO_FORMATS[output_format]['mimetype'],
+        "Content-Type": "application/json",
+        "xi-api-key": api_key
+    }
+    payload = {
+        "text": chunk,
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": ELEVENLABS_VOICE_SETTINGS
+    }
+    return url, headers, payload
+
+def _post_elevenlabs(chunk, voice_id, api_key, stream=False, output_format=TTS_OUTPUT_FORMAT):
+    """ElevenLabs の音声合成 API を呼ぶ（stream=True ならストリーミング API）"""
+    url, headers, payload = elevenlabs_request(chunk, voice_id, api_key, stream, output_format)
+
+    def post():
+        with metrics.time('upstream_seconds', service='elevenlabs', call='stream' if stream else 'convert'):
+            return elevenlabs_session.post(url, json=payload, headers=headers, stream=stream)
+
+    # 429・5xx はバックオフしてやり直す（ストリーミングは応答ヘッダーが届くまで枠を使う）
+    return elevenlabs_limiter.call(post, http_retry_after)
+
+def synthesize_chunk(chunk, voice_id, api_key, output_format=TTS_OUTPUT_FORMAT):
+    """1チャンク分のテキストを ElevenLabs で音声に変換（キャッシュ付き）"""
+    cache_key = tts_cache_key(chunk, voice_id, output_format=output_format)
+    audio = tts_cache.get(cache_key)
+    if audio is not None:
+        metrics.inc('tts_chunks_total', source='cache')
+        return audio
+
+    response = _post_elevenlabs(chunk, voice_id, api_key, output_format=output_format)
+
+    if response.status_code != 200:
+        metrics.inc('errors_total', stage='tts_upstream')
+        raise TTSError(response.text)
+
+    metrics.inc('tts_chunks_total', source='upstream')
+    metrics.observe('tts_chunk_bytes', len(response.content))
+    tts_cache.put(cache_key, response.content)
+    return response.content
+
+def synthesize_chunks(text_chunks, voice_id, api_key, fanout=TTS_REQUEST_FANOUT, output_format=TTS_OUTPUT_FORMAT):
+    """チャンクを並列に音声合成し、元の順番で返す
+
+    同時に投げるのは1リクエストあたり fanout 個まで（全体では TTS_MAX_WORKERS 個まで）。
+    どれか1つでも失敗したら、まだ始まっていないチャンクは取り消して例外を送出する。
+    """
+    if len(text_chunks) == 1:
+        return [synthesize_chunk(text_chunks[0], voice_id, api_key, output_format)]
+
+    audio_chunks = [None] * len(text_chunks)
+    pending = {}
+    next_index = 0
+
+    try:
+        while next_index < len(text_chunks) or pending:
+            while next_index < len(text_chunks) and len(pending) < fanout:
+                future = tts_executor.submit(synthesize_chunk, text_chunks[next_index], voice_id, api_key,
+                                             output_format)
+                pending[future] = next_index
+                next_index += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                audio_chunks[pending.pop(future)] = future.result()
+    except Exception:
+        for future in pending:
+            future.cancel()
+        raise
+
+    return audio_chunks
+
+def stream_synthesized_chunks(text_chunks, voice_id, api_key, fanout=TTS_REQUEST_FANOUT,
+                              output_format=TTS_OUTPUT_FORMAT):
+    """チャンクの音声を順番どおりに、揃ったものから逐次返すジェネレータを作る
+
+    先頭チャンクはストリーミング API で届いたそばから流し、残りのチャンクはその間に
+    並列に合成しておく。チャンクのつなぎ目のヘッダーは取り除いて1本のストリームにする。
+    text_chunks は plan_chunks のジェネレータでもよい。
+    先頭チャンクの失敗はここで TTSError として送出する（レスポンスを返す前なのでエラーを JSON で返せる）。
+    """
+    text_chunks = iter(text_chunks)
+    first_chunk = next(text_chunks, '')
+    rest = list(text_chunks)
+    # 先頭チャンクが1枠を使うので、残りは fanout - 1 個まで先行して合成
+    futures = {
+        index: tts_executor.submit(synthesize_chunk, chunk, voice_id, api_key, output_format)
+        for index, chunk in enumerate(rest[:max(fanout - 1, 0)])
+    }
+
+    # 先頭チャンクがキャッシュにあればそのまま返す
+    first_key = tts_cache_key(first_chunk, voice_id, output_format=output_format)
+    first = tts_cache.get(first_key)
+    if first is None:
+        try:
+            first = _post_elevenlabs(first_chunk, voice_id, api_key, stream=True, output_format=output_format)
+        except UpstreamOverloaded:
+            for future in futures.values():
+                future.cancel()
+            raise
+        if first.status_code != 200:
+            metrics.inc('errors_total', stage='tts_upstream')
+            error = first.text
+            first.close()
+            for future in futures.values():
+                future.cancel()
+            raise TTSError(error)
+
+    return _iter_streamed_audio(first, first_key, rest, futures, voice_id, api_key, fanout, output_format)
+
+def _iter_streamed_audio(first, first_key, rest, futures, voice_id, api_key, fanout, output_format):
+    next_index = len(futures)
+    joiner = create_audio_joiner(output_format)
+    sent = 0
+
+    try:
+        try:
+            joiner.start()
+            if isinstance(first, bytes):
+                metrics.inc('tts_chunks_total', source='cache')
+                pieces = [first]
+            else:
+                pieces = first.iter_content(chunk_size=4096)
+            # 流しながら溜めておき、最後まで届いたらキャッシュに入れる
+            received = []
+            for data in pieces:
+                received.append(data)
+                data = joiner.feed(data)
+                if data:
+                    sent += len(data)
+                    yield data
+            if not isinstance(first, bytes):
+                first.close()
+                audio = b''.join(received)
+                metrics.inc('tts_chunks_total', source='upstream')
+                metrics.observe('tts_chunk_bytes', len(audio))
+                tts_cache.put(first_key, audio)
+
+            for index in range(len(rest)):
+                while next_index < len(rest) and len(futures) < fanout:
+                    futures[next_index] = tts_executor.submit(synthesize_chunk, rest[next_index], voice_id,
+                                                              api_key, output_format)
+                    next_index += 1
+                audio = futures.pop(index).result()
+                joiner.start()
+                data = joiner.feed(audio)
+                if data:
+                    sent += len(data)
+                    yield data
+        except (TTSError, UpstreamOverloaded) as e:
+            # ヘッダー送信済みなのでステータスは変えられない。ここで打ち切る
+            print(f'音声ストリーミングエラー: {str(e)}')
+            metrics.inc('errors_total', stage='tts_stream')
+        # 途中で打ち切った場合も、届いた分で終わる1本のストリームにする
+        data = joiner.finish()
+        if data:
+            sent += len(data)
+            yield data
+        record_audio_report(joiner.report(sent))
+    finally:
+        if not isinstance(first, bytes):
+            first.close()
+        for future in futures.values():
+            future.cancel()
+
+# 発話（チャンクを結合した音声）単位の保存先
+# ID は読み修正後のテキストと声・モデル設定から決まるので、同じ発話への Range リクエストは何度来ても合成1回で済む
+UTTERANCE_CACHE_MEMORY_BYTES = int(os.environ.get('UTTERANCE_CACHE_MEMORY_BYTES', 16 * 1024 * 1024))
+UTTERANCE_CACHE_DISK_BYTES = int(os.environ.get('UTTERANCE_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+UTTERANCE_CACHE_DIR = os.environ.get('UTTERANCE_CACHE_DIR',
+                                     os.path.join(tempfile.gettempdir(), 'ai-kouki-tts-utterances'))
+UTTERANCE_ID_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+utterance_cache = TTSCache(UTTERANCE_CACHE_MEMORY_BYTES, UTTERANCE_CACHE_DISK_BYTES, UTTERANCE_CACHE_DIR)
+# 合成中の発話（同じ発話の同時リクエストは最初の1つの合成を待つ）
+utterance_inflight = {}
+utterance_inflight_lock = threading.Lock()
+# 発話ごとの大きさ・節約できたバイト数（X-Audio-Bytes-Saved 用。新しいものから UTTERANCE_REPORTS_SIZE 件）
+UTTERANCE_REPORTS_SIZE = int(os.environ.get('UTTERANCE_REPORTS_SIZE', 1024))
+utterance_reports = OrderedDict()
+utterance_reports_lock = threading.Lock()
+
+def get_utterance_report(audio_id):
+    with utterance_reports_lock:
+        report = utterance_reports.get(audio_id)
+        if report is not None:
+            utterance_reports.move_to_end(audio_id)
+        return report
+
+def put_utterance_report(audio_id, report):
+    with utterance_reports_lock:
+        utterance_reports[audio_id] = report
+        utterance_reports.move_to_end(audio_id)
+        while len(utterance_reports) > UTTERANCE_REPORTS_SIZE:
+            utterance_reports.popitem(last=False)
+
+def synthesize_utterance(text, voice_id, api_key, output_format=TTS_OUTPUT_FORMAT):
+    """読み修正済みのテキスト全体を音声にして (発話 ID, 音声) を返す（保存済みならそれを返す）"""
+    audio_id = tts_cache_key(text, voice_id, output_format=output_format)
+    audio = utterance_cache.get(audio_id)
+    if audio is not None:
+        return audio_id, audio
+
+    with utterance_inflight_lock:
+        future = utterance_inflight.get(audio_id)
+        owner = future is None
+        if owner:
+            future = utterance_inflight[audio_id] = Future()
+    if not owner:
+        return audio_id, future.result()
+
+    try:
+        # 全体を待ってから返すので、小さい先頭チャンクにせずリクエスト数を減らす
+        chunks = synthesize_chunks(split_text(text, first_length=0), voice_id, api_key,
+                                   output_format=output_format)
+        # チャンクごとのヘッダーを取り除いて1本の音声にする
+        joiner = create_audio_joiner(output_format)
+        audio = joiner.join(chunks)
+        put_utterance_report(audio_id, joiner.report(len(audio)))
+        utterance_cache.put(audio_id, audio)
+        future.set_result(audio)
+        return audio_id, audio
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with utterance_inflight_lock:
+            utterance_inflight.pop(audio_id, None)
+
+def audio_response_parts(audio, request_headers):
+    """ETag と Range から (ステータス, 本文, ヘッダー) を決める
+
+    If-None-Match が一致すれば 304、Range が1つならその範囲を 206（範囲外は 416）、それ以外は全体を 200。
+    ETag は音声のバイト列そのものから作る（強い ETag）。
+    """
+    etag = hashlib.sha256(audio).hexdigest()[:32]
+    headers = {'ETag': f'"{etag}"', 'Accept-Ranges': 'bytes'}
+    if parse_etags(request_headers.get('If-None-Match')).contains(etag):
+        return 304, b'', headers
+
+    byte_range = parse_range_header(request_headers.get('Range'))
+    if_range = request_headers.get('If-Range')
+    # If-Range が古い ETag なら範囲指定は無視して全体を返す（複数範囲も全体で返す）
+    if byte_range is not None and len(byte_range.ranges) == 1 and (not if_range or unquote_etag(if_range) == (etag, False)):
+        span = byte_range.range_for_length(len(audio))
+        if span is None:
+            return 416, b'', {**headers, 'Content-Range': f'bytes */{len(audio)}'}
+        start, stop = span
+        return 206, audio[start:stop], {**headers, 'Content-Range': f'bytes {start}-{stop - 1}/{len(audio)}'}
+    return 200, audio, headers
+
+def audio_mimetype(audio):
+    return 'audio/ogg' if audio[:4] == b'OggS' else 'audio/mpeg'
+
+def audio_headers(audio_id, status):
+    """発話を返すときの共通ヘッダー（全体を返すときは応答の大きさを記録する）"""
+    headers = {'Content-Location': f'/api/tts/{audio_id}', 'Vary': 'Accept'}
+    report = get_utterance_report(audio_id)
+    if report is not None:
+        headers['X-Audio-Format'] = report['format']
+        headers['X-Audio-Bytes-Saved'] = str(report['bytes_saved'])
+        if status == 200:
+            record_audio_report(report)
+    return headers
+
+def audio_response(audio_id, audio, cache_control):
+    status, body, headers = audio_response_parts(audio, request.headers)
+    response = Response(body, status=status, mimetype=audio_mimetype(audio))
+    response.headers.update(headers)
+    response.headers.update(audio_headers(audio_id, status))
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+@app.route('/api/tts', methods=['GET', 'POST'])
 def text_to_speech():
-    """テキストを音声に変換するエンドポイント"""
+    """テキストを音声に変換するエンドポイント
+
+    GET /api/tts?text=... なら <audio> の src にそのまま使える（Range・If-None-Match に対応）。
+    出力形式は format（mp3 / mp3-low / opus か ElevenLabs の形式名）か Accept ヘッダーで選ぶ。
+    """
     try:
-        data = request.json
-        text = data.get('text')
+        data = request.json if request.method == 'POST' else request.args
+        text = (data.get('text') or '').strip()
 
         if not text:
             return jsonify({'error': 'テキストが空です'}), 400
 
+        try:
+            output_format = negotiate_audio_format(data.get('format') or request.args.get('format'),
+                                                   request.headers.get('Accept'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         # 読み仮名を修正
         text = correct_reading(text)
 
         # ElevenLabs API設定
-        elevenlabs_api_key = os.environ.get('ELEVENLABS_API_KEY')
-        voice_id = os.environ.get('ELEVENLABS_VOICE_ID', 'nqkmNHx4hSecnBDJh39A')
+        elevenlabs_api_key, voice_id = get_elevenlabs_settings()
 
         if not elevenlabs_api_key:
             return jsonify({'error': 'ElevenLabs APIキーが設定されていません'}), 500
 
-        # テキストを分割
-        text_chunks = split_text(text, max_length=100)
-
-        # 各チャンクを音声に変換して結合
-        audio_chunks = []
+        # ストリーミングモード: 小さい先頭チャンクから順に、揃ったチャンクを送る
+        if (request.method == 'POST' and data.get('stream')) or request.args.get('stream') == '1':
+            try:
+                audio_stream = stream_synthesized_chunks(plan_chunks(text), voice_id, elevenlabs_api_key,
+                                                         output_format=output_format)
+            except UpstreamOverloaded as e:
+                return overloaded_response(e)
+            except TTSError as e:
+                return jsonify({'error': f'音声生成エラー: {str(e)}'}), 500
+
+            response = Response(audio_stream, mimetype=AUDIO_FORMATS[output_format]['mimetype'])
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['Vary'] = 'Accept'
+            response.headers['X-Audio-Format'] = output_format
+            return response
+
+        # 各チャンクを並列に音声に変換して結合（同じ発話は保存済みの音声を使う）
+        try:
+            audio_id, combined_audio = synthesize_utterance(text, voice_id, elevenlabs_api_key, output_format)
+        except UpstreamOverloaded as e:
+            return overloaded_response(e)
+        except TTSError as e:
+            return jsonify({'error': f'音声生成エラー: {str(e)}'}), 500
+
+        # 音声データを返す（スマホの Range リクエスト・再生し直しは保存済みの音声から返す）
+        return audio_response(audio_id, combined_audio, 'no-cache')
 
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": elevenlabs_api_key
-        }
-
-        for chunk in text_chunks:
-            payload = {
-                "text": chunk,
-                "model_id": "eleven_multilingual_v2",
-                "voice_settings": {
-                    "stability": 0.7,
-                    "similarity_boost": 0.85,
-                    "style": 0.0,
-                    "use_speaker_boost": True
-                }
-            }
-
-            response = requests.post(url, json=payload, headers=headers)
-
-            if response.status_code != 200:
-                return jsonify({'error': f'音声生成エラー: {response.text}'}), 500
+    except Exception as e:
+        print(f'TTSエラー: {str(e)}')
+        metrics.inc('errors_total', stage='tts')
+        return jsonify({'error': str(e)}), 500
 
-            audio_chunks.append(response.content)
+@app.route('/api/tts/<audio_id>', methods=['GET'])
+def stored_speech(audio_id):
+    """合成済みの発話を ID で返す（Range・If-None-Match に対応）"""
+    audio = utterance_cache.get(audio_id) if UTTERANCE_ID_PATTERN.fullmatch(audio_id) else None
+    if audio is None:
+        return jsonify({'error': '音声が見つかりません'}), 404
+    return audio_response(audio_id, audio, 'private, max-age=86400')
+
+# 文末（句点・感嘆符・疑問符・改行と、その後ろの閉じかっこ）
+SENTENCE_END_PATTERN = re.compile(r'[^。！？!?\n]*[。！？!?\n]+[」』）)]*')
+
+def pop_sentences(text):
+    """文末まで揃った文と、まだ途中の残りに分ける"""
+    sentences = []
+    end = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        if match.start() != end:
+            break
+        sentences.append(match.group())
+        end = match.end()
+    return sentences, text[end:]
+
+class SpeechPipeline:
+    """文を受け取りしだい読み修正・分割して音声合成に回し、できた音声を元の順番で取り出す
+
+    同時に合成するのは fanout 個まで（残りは順番待ち）。
+    """
+
+    def __init__(self, voice_id, api_key, fanout=TTS_REQUEST_FANOUT):
+        self.voice_id = voice_id
+        self.api_key = api_key
+        self.fanout = fanout
+        # [チャンクのテキスト, Future（未投入なら None）]
+        self.pending = deque()
+        self.in_flight = 0
+        self.emitted = 0
+        self.submitted = 0
+
+    def submit(self, sentence):
+        text = correct_reading(sentence).strip()
+        if not text:
+            return
+        # 小さい先頭チャンクにするのは返答の最初の文だけ（以降は大きく取ってリクエスト数を減らす）
+        for chunk in plan_chunks(text, first_length=0 if self.submitted else None):
+            self.pending.append([chunk, None])
+        self.submitted += 1
+        self._fill()
+
+    def _fill(self):
+        for entry in self.pending:
+            if self.in_flight >= self.fanout:
+                break
+            if entry[1] is None:
+                entry[1] = tts_executor.submit(synthesize_chunk, entry[0], self.voice_id, self.api_key)
+                self.in_flight += 1
+
+    def ready(self, block=False):
+        """先頭から順に、合成が終わったチャンクの (番号, テキスト, 音声) を返す
+
+        block=True なら残りすべてが終わるまで待つ。失敗したチャンクは音声を None にして返す。
+        """
+        while self.pending:
+            chunk, future = self.pending[0]
+            if future is None or (not block and not future.done()):
+                return
+            self.pending.popleft()
+            self.in_flight -= 1
+            try:
+                audio = future.result()
+            except (TTSError, UpstreamOverloaded) as e:
+                print(f'音声生成エラー: {str(e)}')
+                audio = None
+            self._fill()
+            yield self.emitted, chunk, audio
+            self.emitted += 1
+
+    def cancel(self):
+        for _, future in self.pending:
+            if future is not None:
+                future.cancel()
+        self.pending.clear()
+
+def speech_event(index, chunk, audio):
+    """音声チャンク1つ分のイベント（MP3 は base64 で送る）"""
+    if audio is None:
+        metrics.inc('errors_total', stage='chat_speech_tts')
+        return sse_event('audio_error', {'index': index, 'text': chunk})
+    return sse_event('audio', {'index': index, 'text': chunk, 'audio': base64.b64encode(audio).decode('ascii')})
+
+@app.route('/api/chat/speech', methods=['POST'])
+def chat_speech():
+    """返答の生成と音声合成を並行して Server-Sent Events で返すエンドポイント
+
+    Claude の返答を流しながら、文末まで揃った文から順に音声合成に回す。
+    delta イベントで返答の断片、audio イベントで音声（順番どおり）を送り、
+    最後に done イベントで全文・usage・所要時間を送る。
+    """
+    try:
+        data = request.json
+        user_message = data.get('message')
+        session_id = request.remote_addr
 
-        # 音声データを結合
-        combined_audio = b''.join(audio_chunks)
+        if not user_message:
+            return jsonify({'error': 'メッセージが空です'}), 400
 
-        # 音声データを返す（スマホ対応のヘッダー追加）
-        response = Response(combined_audio, mimetype='audio/mpeg')
-        response.headers['Content-Length'] = str(len(combined_audio))
-        response.headers['Accept-Ranges'] = 'bytes'
-        response.headers['Cache-Control'] = 'no-cache'
-        return response
+        elevenlabs_api_key, voice_id = get_elevenlabs_settings()
+        if not elevenlabs_api_key:
+            return jsonify({'error': 'ElevenLabs APIキーが設定されていません'}), 500
 
+        start = time.perf_counter()
+        cached_reply, cache_scope = cached_first_reply(session_id, user_message)
+        if cached_reply is None:
+            enhanced_system_prompt, messages = prepare_chat(session_id, user_message)
     except Exception as e:
-        print(f'TTSエラー: {str(e)}')
+        print(f'エラー: {str(e)}')
+        metrics.inc('errors_total', stage='chat')
         return jsonify({'error': str(e)}), 500
 
+    final = {}
+
+    def reply_stream():
+        if cached_reply is not None:
+            yield cached_reply
+            return
+        with claude_limiter.slot():
+            # 枠の待ち時間は含めず、枠を取ってから最初のトークンまでを計る
+            upstream_start = time.perf_counter()
+            with get_client().messages.stream(
+                model=CLAUDE_MODEL,
+                max_tokens=200,
+                system=enhanced_system_prompt,
+                messages=messages
+            ) as stream:
+                for text in stream.text_stream:
+                    if 'first_token' not in final:
+                        final['first_token'] = time.perf_counter()
+                        metrics.observe('upstream_seconds', final['first_token'] - upstream_start,
+                                        service='claude', call='stream')
+                    yield text
+                final['message'] = stream.get_final_message()
+
+    def generate():
+        speech = SpeechPipeline(voice_id, elevenlabs_api_key)
+        pending_text = ''
+        first_audio_ms = None
+        try:
+            for text in reply_stream():
+                yield sse_event('delta', {'text': text})
+                sentences, pending_text = pop_sentences(pending_text + text)
+                for sentence in sentences:
+                    speech.submit(sentence)
+                for index, chunk, audio in speech.ready():
+                    if first_audio_ms is None:
+                        first_audio_ms = (time.perf_counter() - start) * 1000
+                    yield speech_event(index, chunk, audio)
+
+            # 文末のない最後の文も合成して、残りの音声を順に待つ
+            speech.submit(pending_text)
+            for index, chunk, audio in speech.ready(block=True):
+                if first_audio_ms is None:
+                    first_audio_ms = (time.perf_counter() - start) * 1000
+                yield speech_event(index, chunk, audio)
+
+            if cached_reply is not None:
+                ai_reply = cached_reply
+                usage = {key: 0 for key in USAGE_KEYS}
+            else:
+                final_message = final['message']
+                usage = conversation_history.record_usage(final_message.usage)
+                ai_reply = ''.join(block.text for block in final_message.content if block.type == 'text')
+                append_history(session_id, 'assistant', ai_reply)
+                if cache_scope is not None:
+                    response_cache.put(cache_scope, user_message, ai_reply)
+
+            first_token = final.get('first_token', start)
+            yield sse_event('done', {
+                'reply': ai_reply,
+                'usage': usage,
+                'cached': cached_reply is not None,
+                'audio_chunks': speech.emitted,
+                'timing': {
+                    'first_token_ms': round((first_token - start) * 1000, 1),
+                    'first_audio_ms': round(first_audio_ms or 0, 1),
+                    'total_ms': round((time.perf_counter() - start) * 1000, 1)
+                }
+            })
+        except UpstreamOverloaded as e:
+            yield sse_event('error', {'error': str(e), 'overloaded': True})
+        except Exception as e:
+            print(f'ストリーミングエラー: {str(e)}')
+            metrics.inc('errors_total', stage='chat_speech')
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            speech.cancel()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def prewarm_tts_cache(phrases, voice_id, api_key):
+    """よく使うフレーズを先に合成してキャッシュに載せておく"""
+    for phrase in phrases:
+        phrase = phrase.strip()
+        if not phrase:
+            continue
+        try:
+            synthesize_chunks(split_text(correct_reading(phrase), first_length=0), voice_id, api_key)
+        except (TTSError, UpstreamOverloaded) as e:
+            print(f'音声キャッシュ事前生成エラー（{phrase}）: {str(e)}')
+    return tts_cache.stats()
+
+@app.cli.command('prewarm-tts')
+@click.argument('phrase_file', type=click.File('r', encoding='utf-8'))
+def prewarm_tts_command(phrase_file):
+    """フレーズ一覧（1行1フレーズ）から音声キャッシュを事前生成"""
+    api_key, voice_id = get_elevenlabs_settings()
+    if not api_key:
+        raise click.ClickException('ELEVENLABS_API_KEY is not set')
+    stats = prewarm_tts_cache(phrase_file, voice_id, api_key)
+    click.echo(json.dumps(stats, ensure_ascii=False))
+
+@app.cli.command('blog-snapshot')
+def blog_snapshot_command():
+    """Firestore から記事を読み込んでスナップショットファイルを書き出す（Heroku では bin/post_compile がビルド時に呼ぶ）"""
+    if not BLOG_SNAPSHOT_PATH:
+        raise click.ClickException('BLOG_SNAPSHOT_PATH is empty')
+    corpus = load_blog_posts()
+    size = write_blog_snapshot(corpus)
+    click.echo(json.dumps({'path': BLOG_SNAPSHOT_PATH, 'posts': len(corpus.posts), 'bytes': size}))
+
+# 起動準備（クライアント・ブログ記事のスナップショット・検索構造）の状態
+warmup_state = {'status': 'pending', 'started_at': None, 'finished_at': None, 'steps_ms': {}, 'errors': {}}
+warmup_lock = threading.Lock()
+
+def warmup(start_sync=True):
+    """最初のリクエストより前に、クライアント・ブログ記事・検索構造を用意する
+
+    何度呼んでもよく、済んだ準備はやり直さない（fork 後の子プロセスは親の結果をそのまま使う）。
+    start_sync=False なら記事の更新スレッドは起動しない（fork 前の親プロセス用）。
+    """
+    with warmup_lock:
+        if warmup_state['status'] == 'pending':
+            warmup_state['status'] = 'running'
+            warmup_state['started_at'] = time.time()
+            for name, step in (
+                ('anthropic_client', get_client),
+                ('firestore', get_firestore_db),
+                ('blog_corpus', load_blog_corpus)
+            ):
+                start = time.perf_counter()
+                try:
+                    step()
+                except Exception as e:
+                    print(f'起動準備エラー（{name}）: {str(e)}')
+                    metrics.inc('errors_total', stage='warmup')
+                    warmup_state['errors'][name] = str(e)
+                    if name == 'blog_corpus':
+                        blog_load_attempted.set()
+                warmup_state['steps_ms'][name] = round((time.perf_counter() - start) * 1000, 2)
+            # 失敗した準備があってもリクエストは受けられる（その部分は従来どおり遅延初期化）
+            warmup_state['status'] = 'degraded' if warmup_state['errors'] else 'ready'
+            warmup_state['finished_at'] = time.time()
+    if start_sync:
+        start_blog_sync()
+    return warmup_state
+
+def prepare_fork():
+    """gunicorn --preload で fork する前に、子プロセスに引き継げないものを片付ける"""
+    global db
+    with client_init_lock:
+        # gRPC のチャネルは fork をまたいで使えないので、ワーカーごとに作り直させる
+        if db is not None:
+            db.close()
+            db = None
+    elevenlabs_session.close()
+    # 準備したオブジェクトを GC の対象から外し、ワーカー間でコピーオンライトのまま共有させる
+    gc.collect()
+    gc.freeze()
+
+def readiness():
+    """起動準備の状態と、リクエストを受けられるか"""
+    corpus = blog_corpus
+    state = {
+        **warmup_state,
+        'pid': os.getpid(),
+        'blog_posts': len(corpus.posts) if corpus else 0,
+        'blog_version': corpus.version if corpus else 0
+    }
+    return state, warmup_state['status'] in ('ready', 'degraded')
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """起動準備が済んでいれば 200、まだなら 503"""
+    state, is_ready = readiness()
+    return jsonify(state), 200 if is_ready else 503
+
+def collect_stats():
+    """キャッシュなどの統計情報"""
+    return {
+        'warmup': readiness()[0],
+        'blog': get_blog_stats(),
+        'tts_cache': tts_cache.stats(),
+        'utterance_cache': utterance_cache.stats(),
+        'sessions': conversation_history.stats(),
+        'response_cache': response_cache.stats(),
+        'upstream': {service: limiter.stats() for service, limiter in upstream_limiters.items()}
+    }
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    return jsonify(collect_stats())
+
+def collect_metric_samples():
+    """セッション数やキャッシュのヒット数など、スクレイプ時に各所の統計から集める値"""
+    corpus = blog_corpus
+    tts = tts_cache.stats()
+    responses = response_cache.stats()
+    sessions = len(conversation_history)
+    session_counters = conversation_history.counters_snapshot()
+    return [
+        ('sessions', 'gauge', '保持している会話セッション数', [({}, sessions)]),
+        ('session_events_total', 'counter', '会話履歴の破棄・切り詰めの回数', [
+            ({'event': key}, session_counters[key])
+            for key in ('evicted_sessions', 'expired_sessions', 'truncated_messages')
+        ]),
+        ('claude_tokens_total', 'counter', 'Claude の usage の累計', [
+            ({'kind': key}, session_counters[key]) for key in USAGE_KEYS
+        ]),
+        ('cache_requests_total', 'counter', 'キャッシュの参照結果', [
+            ({'cache': 'tts', 'result': 'memory_hit'}, tts['memory_hits']),
+            ({'cache': 'tts', 'result': 'disk_hit'}, tts['disk_hits']),
+            ({'cache': 'tts', 'result': 'miss'}, tts['misses']),
+            ({'cache': 'response', 'result': 'hit'}, responses['hits']),
+            ({'cache': 'response', 'result': 'similar_hit'}, responses['similar_hits']),
+            ({'cache': 'response', 'result': 'miss'}, responses['misses']),
+            ({'cache': 'blog_context', 'result': 'hit'}, blog_context_memo_stats['hits']),
+            ({'cache': 'blog_context', 'result': 'miss'}, blog_context_memo_stats['misses'])
+        ]),
+        ('cache_bytes', 'gauge', 'キャッシュの使用量', [
+            ({'cache': 'tts', 'tier': 'memory'}, tts['memory_bytes']),
+            ({'cache': 'tts', 'tier': 'disk'}, tts['disk_bytes'])
+        ]),
+        ('upstream_in_flight', 'gauge', '上流 API の実行中のリクエスト数', [
+            ({'service': service}, limiter.in_flight) for service, limiter in upstream_limiters.items()
+        ]),
+        ('upstream_queue_depth', 'gauge', '上流 API の枠を待っているリクエスト数', [
+            ({'service': service}, limiter.queued) for service, limiter in upstream_limiters.items()
+        ]),
+        ('blog_posts', 'gauge', '読み込み済みのブログ記事数', [({}, len(corpus.posts) if corpus else 0)]),
+        ('blog_corpus_version', 'gauge', '記事スナップショットの版', [({}, corpus.version if corpus else 0)])
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 形式のメトリクス"""
+    return Response(metrics.render(collect_metric_samples()), mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({'message': 'AI こうき バックエンド API'})
 
 if __name__ == '__main__':
+    warmup()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
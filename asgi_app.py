@@ -0,0 +1,669 @@
+"""非同期（ASGI）版のサーバー
+
+    uvicorn asgi_app:app
+    gunicorn -k uvicorn.workers.UvicornWorker asgi_app:app
+
+/api/chat・/api/chat/stream・/api/chat/speech・/api/tts の入出力は app.py の Flask 版と同じ。
+Claude は非同期クライアント、ElevenLabs はプロセスで1つの keep-alive 接続プールで呼ぶので、
+上流の応答待ちでワーカーのスレッドを占有しない。会話履歴・ブログ検索・音声キャッシュは
+app.py のものをそのまま使う。
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import httpx
+from anthropic import AsyncAnthropic
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app import (
+    AUDIO_FORMATS,
+    CLAUDE_MODEL,
+    TTS_MAX_WORKERS,
+    TTS_OUTPUT_FORMAT,
+    TTS_REQUEST_FANOUT,
+    USAGE_KEYS,
+    UTTERANCE_ID_PATTERN,
+    TTSError,
+    UpstreamOverloaded,
+    append_history,
+    audio_headers,
+    audio_mimetype,
+    audio_response_parts,
+    cached_first_reply,
+    claude_limiter,
+    claude_retry_after,
+    collect_metric_samples,
+    collect_stats,
+    conversation_history,
+    correct_reading,
+    create_audio_joiner,
+    elevenlabs_limiter,
+    elevenlabs_request,
+    get_elevenlabs_settings,
+    http_retry_after,
+    metrics,
+    negotiate_audio_format,
+    plan_chunks,
+    pop_sentences,
+    put_utterance_report,
+    prepare_chat,
+    readiness,
+    record_audio_report,
+    response_cache,
+    speech_event,
+    split_text,
+    sse_event,
+    tts_cache,
+    tts_cache_key,
+    utterance_cache,
+    warmup,
+)
+
+# 上流クライアント（起動時に作成し、全リクエストで共有）
+clients = {}
+
+@asynccontextmanager
+async def lifespan(_):
+    clients['elevenlabs'] = httpx.AsyncClient(
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        limits=httpx.Limits(max_connections=TTS_MAX_WORKERS, max_keepalive_connections=TTS_MAX_WORKERS)
+    )
+    # クライアント・ブログ記事・検索構造を用意してから受け付ける
+    await run_in_threadpool(warmup)
+    if os.environ.get('ANTHROPIC_API_KEY'):
+        get_async_client()
+    yield
+    await clients['elevenlabs'].aclose()
+    if 'anthropic' in clients:
+        await clients['anthropic'].close()
+
+def get_async_client():
+    """Claude の非同期クライアント（遅延初期化）"""
+    if 'anthropic' not in clients:
+        api_key = os.environ.get('ANTHROPIC_API_KEY')
+        if not api_key:
+            raise ValueError("ANTHROPIC_API_KEY is not set")
+        # 再試行は claude_limiter で行うので SDK 側では行わない
+        clients['anthropic'] = AsyncAnthropic(api_key=api_key, max_retries=0)
+    return clients['anthropic']
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return {}
+
+def overloaded_response(e):
+    return JSONResponse({'error': str(e), 'service': e.service, 'reason': e.reason}, status_code=503,
+                        headers={'Retry-After': str(e.retry_after)})
+
+async def home(request):
+    return JSONResponse({'message': 'AI こうき バックエンド API'})
+
+async def chat(request):
+    try:
+        data = await read_json(request)
+        user_message = data.get('message')
+        session_id = request.client.host if request.client else None
+
+        if not user_message:
+            return JSONResponse({'error': 'メッセージが空です'}, status_code=400)
+
+        # よくある初回の質問はキャッシュから返す（履歴の確認・記事の読み込み待ちがあるのでスレッドで）
+        cached_reply, cache_scope = await run_in_threadpool(cached_first_reply, session_id, user_message)
+        if cached_reply is not None:
+            return JSONResponse({'reply': cached_reply})
+
+        # ブログ検索は CPU 処理なのでスレッドで
+        enhanced_system_prompt, messages = await run_in_threadpool(prepare_chat, session_id, user_message)
+
+        # Claude API に送信
+        async def create():
+            # 枠の待ち時間と再試行の待ちは含めず、API 呼び出しだけを計る
+            with metrics.time('upstream_seconds', service='claude', call='messages'):
+                return await get_async_client().messages.create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=200,
+                    system=enhanced_system_prompt,
+                    messages=messages
+                )
+
+        response = await claude_limiter.call_async(create, claude_retry_after)
+        await run_in_threadpool(conversation_history.record_usage, response.usage)
+
+        # AI の返答を履歴に追加（SQLite の保存先ではロック待ちがあるのでスレッドで）
+        ai_reply = response.content[0].text
+        await run_in_threadpool(append_history, session_id, 'assistant', ai_reply)
+        if cache_scope is not None:
+            response_cache.put(cache_scope, user_message, ai_reply)
+
+        return JSONResponse({'reply': ai_reply})
+
+    except UpstreamOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        print(f'エラー: {str(e)}')
+        metrics.inc('errors_total', stage='chat')
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def chat_stream(request):
+    """返答を Server-Sent Events で少しずつ返す（Flask 版の /api/chat/stream と同じイベント）"""
+    try:
+        data = await read_json(request)
+        user_message = data.get('message')
+        session_id = request.client.host if request.client else None
+
+        if not user_message:
+            return JSONResponse({'error': 'メッセージが空です'}, status_code=400)
+
+        start = time.perf_counter()
+        cached_reply, cache_scope = await run_in_threadpool(cached_first_reply, session_id, user_message)
+        if cached_reply is None:
+            enhanced_system_prompt, messages = await run_in_threadpool(prepare_chat, session_id, user_message)
+    except Exception as e:
+        print(f'エラー: {str(e)}')
+        metrics.inc('errors_total', stage='chat')
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    async def generate_cached():
+        yield sse_event('delta', {'text': cached_reply})
+        yield sse_event('done', {
+            'reply': cached_reply,
+            'usage': {key: 0 for key in USAGE_KEYS},
+            'cached': True,
+            'timing': {
+                'first_token_ms': round((time.perf_counter() - start) * 1000, 1),
+                'total_ms': round((time.perf_counter() - start) * 1000, 1)
+            }
+        })
+
+    async def generate():
+        first_token_ms = None
+        try:
+            async with claude_limiter.slot_async():
+                # 枠の待ち時間は含めず、枠を取ってから最初のトークンまでを計る
+                upstream_start = time.perf_counter()
+                async with get_async_client().messages.stream(
+                    model=CLAUDE_MODEL,
+                    max_tokens=200,
+                    system=enhanced_system_prompt,
+                    messages=messages
+                ) as stream:
+                    async for text in stream.text_stream:
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - start) * 1000
+                            metrics.observe('upstream_seconds', time.perf_counter() - upstream_start,
+                                            service='claude', call='stream')
+                        yield sse_event('delta', {'text': text})
+                    final_message = await stream.get_final_message()
+
+            usage = await run_in_threadpool(conversation_history.record_usage, final_message.usage)
+            ai_reply = ''.join(block.text for block in final_message.content if block.type == 'text')
+            await run_in_threadpool(append_history, session_id, 'assistant', ai_reply)
+            if cache_scope is not None:
+                response_cache.put(cache_scope, user_message, ai_reply)
+
+            yield sse_event('done', {
+                'reply': ai_reply,
+                'usage': usage,
+                'timing': {
+                    'first_token_ms': round(first_token_ms or 0, 1),
+                    'total_ms': round((time.perf_counter() - start) * 1000, 1)
+                }
+            })
+        except UpstreamOverloaded as e:
+            yield sse_event('error', {'error': str(e), 'overloaded': True})
+        except Exception as e:
+            print(f'ストリーミングエラー: {str(e)}')
+            metrics.inc('errors_total', stage='chat_stream')
+            yield sse_event('error', {'error': str(e)})
+
+    return StreamingResponse(generate() if cached_reply is None else generate_cached(),
+                             media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+async def synthesize_chunk(chunk, voice_id, api_key, output_format=TTS_OUTPUT_FORMAT):
+    """1チャンク分の音声合成（キャッシュ付き）"""
+    cache_key = tts_cache_key(chunk, voice_id, output_format=output_format)
+    # キャッシュはディスクを読み書きする（put はディレクトリを数え直すこともある）のでスレッドで
+    audio = await run_in_threadpool(tts_cache.get, cache_key)
+    if audio is not None:
+        metrics.inc('tts_chunks_total', source='cache')
+        return audio
+
+    url, headers, payload = elevenlabs_request(chunk, voice_id, api_key, output_format=output_format)
+
+    async def post():
+        with metrics.time('upstream_seconds', service='elevenlabs', call='convert'):
+            return await clients['elevenlabs'].post(url, json=payload, headers=headers)
+
+    response = await elevenlabs_limiter.call_async(post, http_retry_after)
+
+    if response.status_code != 200:
+        metrics.inc('errors_total', stage='tts_upstream')
+        raise TTSError(response.text)
+
+    metrics.inc('tts_chunks_total', source='upstream')
+    metrics.observe('tts_chunk_bytes', len(response.content))
+    await run_in_threadpool(tts_cache.put, cache_key, response.content)
+    return response.content
+
+async def synthesize_chunks(text_chunks, voice_id, api_key, fanout=TTS_REQUEST_FANOUT, output_format=TTS_OUTPUT_FORMAT):
+    """チャンクを並列に合成して元の順番で返す（どれかが失敗したら残りは取り消す）"""
+    request_semaphore = asyncio.Semaphore(fanout)
+
+    async def run(chunk):
+        async with request_semaphore:
+            return await synthesize_chunk(chunk, voice_id, api_key, output_format)
+
+    tasks = [asyncio.ensure_future(run(chunk)) for chunk in text_chunks]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def stream_chunks(text_chunks, voice_id, api_key, fanout=TTS_REQUEST_FANOUT, output_format=TTS_OUTPUT_FORMAT):
+    """揃ったチャンクから順番どおりに音声を流す
+
+    先頭チャンクはストリーミング API で届いたそばから流し、その間に残りを並列に合成しておく。
+    チャンクごとのヘッダーは取り除き、全体で1本の音声にする。text_chunks は plan_chunks のジェネレータでもよい。
+    """
+    text_chunks = iter(text_chunks)
+    first_chunk = next(text_chunks, '')
+    # 先頭チャンクが1枠を使うので、残りは fanout - 1 個ずつ
+    request_semaphore = asyncio.Semaphore(max(fanout - 1, 1))
+
+    async def run(chunk):
+        async with request_semaphore:
+            return await synthesize_chunk(chunk, voice_id, api_key, output_format)
+
+    tasks = [asyncio.ensure_future(run(chunk)) for chunk in text_chunks]
+    joiner = create_audio_joiner(output_format)
+    sent = 0
+    streaming = False
+    try:
+        joiner.start()
+        first_key = tts_cache_key(first_chunk, voice_id, output_format=output_format)
+        first = await run_in_threadpool(tts_cache.get, first_key)
+        if first is not None:
+            metrics.inc('tts_chunks_total', source='cache')
+            data = joiner.feed(first)
+            if data:
+                sent += len(data)
+                streaming = True
+                yield data
+        else:
+            url, headers, payload = elevenlabs_request(first_chunk, voice_id, api_key, stream=True,
+                                                       output_format=output_format)
+            client = clients['elevenlabs']
+
+            async def post():
+                with metrics.time('upstream_seconds', service='elevenlabs', call='stream'):
+                    request = client.build_request('POST', url, json=payload, headers=headers)
+                    return await client.send(request, stream=True)
+
+            # 429・5xx はバックオフしてやり直す（Flask 版と同じく応答ヘッダーが届くまで枠を使う）
+            response = await elevenlabs_limiter.call_async(post, http_retry_after)
+            try:
+                if response.status_code != 200:
+                    metrics.inc('errors_total', stage='tts_upstream')
+                    raise TTSError((await response.aread()).decode('utf-8', 'replace'))
+                # 流しながら溜めておき、最後まで届いたらキャッシュに入れる
+                received = []
+                async for data in response.aiter_bytes():
+                    received.append(data)
+                    data = joiner.feed(data)
+                    if data:
+                        sent += len(data)
+                        streaming = True
+                        yield data
+            finally:
+                await response.aclose()
+            audio = b''.join(received)
+            metrics.inc('tts_chunks_total', source='upstream')
+            metrics.observe('tts_chunk_bytes', len(audio))
+            await run_in_threadpool(tts_cache.put, first_key, audio)
+
+        for task in tasks:
+            audio = await task
+            joiner.start()
+            data = joiner.feed(audio)
+            if data:
+                sent += len(data)
+                streaming = True
+                yield data
+    except (TTSError, UpstreamOverloaded) as e:
+        # 先頭チャンクの失敗は呼び出し側でエラー応答にする
+        if not streaming:
+            raise
+        # ヘッダー送信済みなのでステータスは変えられない。ここで打ち切る
+        print(f'音声ストリーミングエラー: {str(e)}')
+        metrics.inc('errors_total', stage='tts_stream')
+    finally:
+        for task in tasks:
+            task.cancel()
+    # 途中で打ち切った場合も、届いた分で終わる1本のストリームにする
+    data = joiner.finish()
+    sent += len(data)
+    record_audio_report(joiner.report(sent))
+    if data:
+        yield data
+
+# 合成中の発話（同じ発話の同時リクエストは最初の1つの合成を待つ）
+utterance_tasks = {}
+
+async def synthesize_utterance(text, voice_id, api_key, output_format=TTS_OUTPUT_FORMAT):
+    """app.synthesize_utterance の非同期版（(発話 ID, 音声) を返す）"""
+    audio_id = tts_cache_key(text, voice_id, output_format=output_format)
+    audio = await run_in_threadpool(utterance_cache.get, audio_id)
+    if audio is not None:
+        return audio_id, audio
+
+    task = utterance_tasks.get(audio_id)
+    if task is None:
+        async def run():
+            try:
+                chunks = await synthesize_chunks(split_text(text, first_length=0), voice_id, api_key,
+                                                 output_format=output_format)
+                joiner = create_audio_joiner(output_format)
+                audio = joiner.join(chunks)
+                put_utterance_report(audio_id, joiner.report(len(audio)))
+                await run_in_threadpool(utterance_cache.put, audio_id, audio)
+                return audio
+            finally:
+                utterance_tasks.pop(audio_id, None)
+
+        task = utterance_tasks[audio_id] = asyncio.ensure_future(run())
+    # 待っている側が切断しても合成は止めない（他のリクエストも待っている）
+    return audio_id, await asyncio.shield(task)
+
+def audio_response(request, audio_id, audio, cache_control):
+    status, body, headers = audio_response_parts(audio, request.headers)
+    return Response(body, status_code=status, media_type=audio_mimetype(audio), headers={
+        **headers,
+        **audio_headers(audio_id, status),
+        'Cache-Control': cache_control
+    })
+
+class SpeechPipeline:
+    """app.SpeechPipeline の非同期版（文ごとに合成を始め、できた音声を元の順番で取り出す）"""
+
+    def __init__(self, voice_id, api_key, fanout=TTS_REQUEST_FANOUT):
+        self.voice_id = voice_id
+        self.api_key = api_key
+        self.semaphore = asyncio.Semaphore(fanout)
+        self.pending = deque()
+        self.emitted = 0
+        self.submitted = 0
+
+    async def _run(self, chunk):
+        async with self.semaphore:
+            return await synthesize_chunk(chunk, self.voice_id, self.api_key)
+
+    def submit(self, sentence):
+        text = correct_reading(sentence).strip()
+        if not text:
+            return
+        # 小さい先頭チャンクにするのは返答の最初の文だけ
+        for chunk in plan_chunks(text, first_length=0 if self.submitted else None):
+            self.pending.append((chunk, asyncio.ensure_future(self._run(chunk))))
+        self.submitted += 1
+
+    async def ready(self, block=False):
+        while self.pending:
+            chunk, task = self.pending[0]
+            if not block and not task.done():
+                return
+            self.pending.popleft()
+            try:
+                audio = await task
+            except (TTSError, UpstreamOverloaded) as e:
+                print(f'音声生成エラー: {str(e)}')
+                audio = None
+            yield self.emitted, chunk, audio
+            self.emitted += 1
+
+    def cancel(self):
+        for _, task in self.pending:
+            task.cancel()
+        self.pending.clear()
+
+async def chat_speech(request):
+    """返答の生成と音声合成を並行して Server-Sent Events で返す（Flask 版の /api/chat/speech と同じイベント）"""
+    try:
+        data = await read_json(request)
+        user_message = data.get('message')
+        session_id = request.client.host if request.client else None
+
+        if not user_message:
+            return JSONResponse({'error': 'メッセージが空です'}, status_code=400)
+
+        elevenlabs_api_key, voice_id = get_elevenlabs_settings()
+        if not elevenlabs_api_key:
+            return JSONResponse({'error': 'ElevenLabs APIキーが設定されていません'}, status_code=500)
+
+        start = time.perf_counter()
+        cached_reply, cache_scope = await run_in_threadpool(cached_first_reply, session_id, user_message)
+        if cached_reply is None:
+            enhanced_system_prompt, messages = await run_in_threadpool(prepare_chat, session_id, user_message)
+    except Exception as e:
+        print(f'エラー: {str(e)}')
+        metrics.inc('errors_total', stage='chat')
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    final = {}
+
+    async def reply_stream():
+        if cached_reply is not None:
+            yield cached_reply
+            return
+        async with claude_limiter.slot_async():
+            # 枠の待ち時間は含めず、枠を取ってから最初のトークンまでを計る
+            upstream_start = time.perf_counter()
+            async with get_async_client().messages.stream(
+                model=CLAUDE_MODEL,
+                max_tokens=200,
+                system=enhanced_system_prompt,
+                messages=messages
+            ) as stream:
+                async for text in stream.text_stream:
+                    if 'first_token' not in final:
+                        final['first_token'] = time.perf_counter()
+                        metrics.observe('upstream_seconds', final['first_token'] - upstream_start,
+                                        service='claude', call='stream')
+                    yield text
+                final['message'] = await stream.get_final_message()
+
+    async def generate():
+        speech = SpeechPipeline(voice_id, elevenlabs_api_key)
+        pending_text = ''
+        first_audio_ms = None
+        try:
+            async for text in reply_stream():
+                yield sse_event('delta', {'text': text})
+                sentences, pending_text = pop_sentences(pending_text + text)
+                for sentence in sentences:
+                    speech.submit(sentence)
+                async for index, chunk, audio in speech.ready():
+                    if first_audio_ms is None:
+                        first_audio_ms = (time.perf_counter() - start) * 1000
+                    yield speech_event(index, chunk, audio)
+
+            speech.submit(pending_text)
+            async for index, chunk, audio in speech.ready(block=True):
+                if first_audio_ms is None:
+                    first_audio_ms = (time.perf_counter() - start) * 1000
+                yield speech_event(index, chunk, audio)
+
+            if cached_reply is not None:
+                ai_reply = cached_reply
+                usage = {key: 0 for key in USAGE_KEYS}
+            else:
+                final_message = final['message']
+                usage = await run_in_threadpool(conversation_history.record_usage, final_message.usage)
+                ai_reply = ''.join(block.text for block in final_message.content if block.type == 'text')
+                await run_in_threadpool(append_history, session_id, 'assistant', ai_reply)
+                if cache_scope is not None:
+                    response_cache.put(cache_scope, user_message, ai_reply)
+
+            first_token = final.get('first_token', start)
+            yield sse_event('done', {
+                'reply': ai_reply,
+                'usage': usage,
+                'cached': cached_reply is not None,
+                'audio_chunks': speech.emitted,
+                'timing': {
+                    'first_token_ms': round((first_token - start) * 1000, 1),
+                    'first_audio_ms': round(first_audio_ms or 0, 1),
+                    'total_ms': round((time.perf_counter() - start) * 1000, 1)
+                }
+            })
+        except UpstreamOverloaded as e:
+            yield sse_event('error', {'error': str(e), 'overloaded': True})
+        except Exception as e:
+            print(f'ストリーミングエラー: {str(e)}')
+            metrics.inc('errors_total', stage='chat_speech')
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            speech.cancel()
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+async def text_to_speech(request):
+    """テキストを音声に変換するエンドポイント"""
+    try:
+        data = await read_json(request) if request.method == 'POST' else request.query_params
+        text = (data.get('text') or '').strip()
+
+        if not text:
+            return JSONResponse({'error': 'テキストが空です'}, status_code=400)
+
+        try:
+            output_format = negotiate_audio_format(data.get('format') or request.query_params.get('format'),
+                                                   request.headers.get('Accept'))
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+
+        # 読み仮名を修正
+        text = correct_reading(text)
+
+        # ElevenLabs API設定
+        elevenlabs_api_key, voice_id = get_elevenlabs_settings()
+        if not elevenlabs_api_key:
+            return JSONResponse({'error': 'ElevenLabs APIキーが設定されていません'}, status_code=500)
+
+        # ストリーミングモード: 小さい先頭チャンクから順に、揃ったチャンクを送る
+        if (request.method == 'POST' and data.get('stream')) or request.query_params.get('stream') == '1':
+            audio_stream = stream_chunks(plan_chunks(text), voice_id, elevenlabs_api_key, output_format=output_format)
+            try:
+                # 先頭チャンクの失敗はレスポンスを返す前に JSON で返す
+                first = await audio_stream.__anext__()
+            except UpstreamOverloaded as e:
+                await audio_stream.aclose()
+                return overloaded_response(e)
+            except TTSError as e:
+                await audio_stream.aclose()
+                return JSONResponse({'error': f'音声生成エラー: {str(e)}'}, status_code=500)
+
+            async def relay():
+                yield first
+                async for audio in audio_stream:
+                    yield audio
+
+            return StreamingResponse(relay(), media_type=AUDIO_FORMATS[output_format]['mimetype'], headers={
+                'Cache-Control': 'no-cache',
+                'Vary': 'Accept',
+                'X-Audio-Format': output_format
+            })
+
+        try:
+            audio_id, combined_audio = await synthesize_utterance(text, voice_id, elevenlabs_api_key, output_format)
+        except UpstreamOverloaded as e:
+            return overloaded_response(e)
+        except TTSError as e:
+            return JSONResponse({'error': f'音声生成エラー: {str(e)}'}, status_code=500)
+
+        return audio_response(request, audio_id, combined_audio, 'no-cache')
+
+    except Exception as e:
+        print(f'TTSエラー: {str(e)}')
+        metrics.inc('errors_total', stage='tts')
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def stored_speech(request):
+    audio_id = request.path_params['audio_id']
+    audio = None
+    if UTTERANCE_ID_PATTERN.fullmatch(audio_id):
+        audio = await run_in_threadpool(utterance_cache.get, audio_id)
+    if audio is None:
+        return JSONResponse({'error': '音声が見つかりません'}, status_code=404)
+    return audio_response(request, audio_id, audio, 'private, max-age=86400')
+
+async def stats(request):
+    return JSONResponse(collect_stats())
+
+async def ready(request):
+    state, is_ready = readiness()
+    return JSONResponse(state, status_code=200 if is_ready else 503)
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(collect_metric_samples()), media_type='text/plain; version=0.0.4')
+
+class RequestMetricsMiddleware:
+    """Flask 版の before_request / after_request と同じく、エンドポイントごとの処理時間と件数を記録する
+
+    時間はヘッダーを返すまで（ストリーミングの本文は含めない）。どのルートにも当たらなかったものは数えない。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message['type'] == 'http.response.start':
+                endpoint = scope.get('endpoint')
+                if endpoint is not None:
+                    metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=endpoint.__name__)
+                    metrics.inc('http_requests_total', endpoint=endpoint.__name__, status=message['status'])
+            await send(message)
+
+        await self.app(scope, receive, send_with_metrics)
+
+app = Starlette(
+    routes=[
+        Route('/', home, methods=['GET']),
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/stream', chat_stream, methods=['POST']),
+        Route('/api/chat/speech', chat_speech, methods=['POST']),
+        Route('/api/tts', text_to_speech, methods=['GET', 'POST']),
+        Route('/api/tts/{audio_id}', stored_speech, methods=['GET']),
+        Route('/api/stats', stats, methods=['GET']),
+        Route('/api/ready', ready, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(RequestMetricsMiddleware),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,169 @@
+"""/api/tts の出力形式ごとの音声の大きさと、チャンクのつなぎ目の正しさのベンチマーク
+
+    python bench/bench_audio_formats.py --formats mp3_44100_128,mp3_22050_32,opus_48000_32
+
+決まったフレーズ集を ElevenLabs のスタブ（bench/stubs.py）に向けた /api/tts に形式ごとに投げ、
+1応答あたりのバイト数・既定の形式（128kbps MP3）をそのままつないだ場合より減ったバイト数・
+最初のバイトまでと全体の時間を出す（一括と stream の両方）。
+返った音声は1本のストリームとして正しいかも調べる。
+  mp3 : ID3v2 タグが先頭に1つだけ、Xing/Info フレームが無い、フレームが途切れず最後まで続く
+  ogg : シリアル番号が1つ、ページ番号が連番、BOS/EOS が1つずつ、CRC が正しい、グラニュール位置が減らない
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from stubs import start_elevenlabs_stub
+
+# 実際の返答に近い長さのフレーズ（100文字を超えるものは複数チャンクに分かれる）
+PHRASES = [
+    'いやー、まぁねー。',
+    '高知の海はほんとにきれいだよ。天気いい日に海沿い歩くと気分転換になるし、けっこうおすすめ！',
+    '最近はロケットラボの作業が多くて、夜遅くまで大学に残ってることが多いかな。でも楽しいからいいんだよね。',
+    'テニスサークルは週に二回くらい。ゆるい感じだから初心者でも全然大丈夫だよ。君もやってみる？'
+    'ラケットは貸してもらえるし、終わったあとにみんなでご飯行くのが一番の楽しみだったりする。',
+    '10月中旬は実習でずっと高知にいたよ。朝早くて大変だったけど、地元の人がすごく優しくて、'
+    '毎日なにかしら差し入れをもらってた。カツオのたたきが本当においしくて、三日連続で食べたのはいい思い出。'
+    'また行きたいなって思ってる。',
+]
+
+def check_mp3(app, audio):
+    """MP3 が1本のストリームとしてつながっているか（問題があれば理由を返す）"""
+    if audio.count(b'ID3') != 1 or audio[:3] != b'ID3':
+        return f'ID3v2 タグが {audio.count(b"ID3")} 個'
+    offset = app.id3v2_length(audio)
+    frames = 0
+    while offset < len(audio):
+        frame = app.parse_mp3_frame_header(audio[offset:offset + 4])
+        if frame is None:
+            return f'{offset} バイト目でフレームが途切れた'
+        length, side_info, _ = frame
+        if audio[offset + 4 + side_info:offset + 8 + side_info] in app.MP3_INFO_TAGS:
+            return f'{frames} 番目のフレームが Xing/Info'
+        offset += length
+        frames += 1
+    return None if offset == len(audio) else '最後のフレームが途中で終わっている'
+
+def check_ogg(app, audio):
+    """Ogg Opus が1本の論理ストリームになっているか（問題があれば理由を返す）"""
+    offset = 0
+    serials, flags_seen, sequences = set(), [], []
+    last_granule = 0
+    while offset < len(audio):
+        if audio[offset:offset + 4] != b'OggS':
+            return f'{offset} バイト目がページの先頭ではない'
+        _, _, flags, granule, serial, sequence, crc, segments = app.OGG_PAGE_HEADER.unpack_from(audio, offset)
+        header_length = app.OGG_PAGE_HEADER.size + segments
+        length = header_length + sum(audio[offset + app.OGG_PAGE_HEADER.size:offset + header_length])
+        page = bytearray(audio[offset:offset + length])
+        struct.pack_into('<I', page, 22, 0)
+        if app.ogg_crc(page) != crc:
+            return f'ページ {sequence} の CRC が違う'
+        if granule != -1:
+            if granule < last_granule:
+                return f'ページ {sequence} でグラニュール位置が戻った'
+            last_granule = granule
+        serials.add(serial)
+        flags_seen.append(flags)
+        sequences.append(sequence)
+        offset += length
+    if len(serials) != 1:
+        return f'シリアル番号が {len(serials)} 個'
+    if sequences != list(range(len(sequences))):
+        return 'ページ番号が連番でない'
+    if sum(1 for flags in flags_seen if flags & 0x02) != 1 or not flags_seen[0] & 0x02:
+        return 'BOS が先頭の1ページだけではない'
+    if sum(1 for flags in flags_seen if flags & 0x04) != 1 or not flags_seen[-1] & 0x04:
+        return 'EOS が最後の1ページだけではない'
+    return None
+
+def bytes_saved_total(app, output_format):
+    """アプリが記録した、節約できたバイト数の累計（一括・stream どちらの応答も記録される）"""
+    with app.metrics.lock:
+        return app.metrics.counters.get(('tts_bytes_saved_total', (('format', output_format),)), 0)
+
+def bench(app, client, output_format, stream):
+    check = check_ogg if app.AUDIO_FORMATS[output_format]['container'] == 'ogg' else check_mp3
+    sizes, saved, first_byte, total, errors = [], [], [], [], []
+    for phrase in PHRASES:
+        saved_before = bytes_saved_total(app, output_format)
+        start = time.perf_counter()
+        if stream:
+            response = client.post('/api/tts', json={'text': phrase, 'stream': True, 'format': output_format},
+                                   buffered=False)
+            chunks = iter(response.response)
+            audio = next(chunks)
+            first_byte.append(time.perf_counter() - start)
+            audio += b''.join(chunks)
+            response.close()
+        else:
+            response = client.get('/api/tts', query_string={'text': phrase, 'format': output_format})
+            audio = response.data
+            first_byte.append(time.perf_counter() - start)
+        total.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors.append(f'HTTP {response.status_code}')
+            continue
+        problem = check(app, audio)
+        if problem:
+            errors.append(problem)
+        sizes.append(len(audio))
+        saved.append(bytes_saved_total(app, output_format) - saved_before)
+    return {
+        'format': output_format,
+        'mode': 'stream' if stream else 'buffered',
+        'responses': len(sizes),
+        'mean_bytes': round(sum(sizes) / max(len(sizes), 1)),
+        'mean_bytes_saved': round(sum(saved) / max(len(saved), 1)),
+        'ttfb_ms': round(sum(first_byte) / len(first_byte) * 1000, 1),
+        'total_ms': round(sum(total) / len(total) * 1000, 1),
+        'valid': not errors,
+        'errors': errors
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--formats', default='mp3_44100_128,mp3_44100_64,mp3_22050_32,opus_48000_32,opus_48000_64')
+    parser.add_argument('--tts-latency', type=float, default=0.05)
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    args = parser.parse_args()
+
+    stub = start_elevenlabs_stub(0, latency=args.tts_latency, latency_per_char=0)
+    os.environ.update(
+        ELEVENLABS_API_KEY='stub',
+        ELEVENLABS_API_BASE=f'http://127.0.0.1:{stub.server_address[1]}',
+        # キャッシュを使わず毎回スタブから合成する
+        TTS_CACHE_MEMORY_BYTES='0',
+        TTS_CACHE_DISK_BYTES='0',
+        UTTERANCE_CACHE_MEMORY_BYTES='0',
+        UTTERANCE_CACHE_DISK_BYTES='0',
+        TTS_CACHE_DIR=tempfile.mkdtemp(prefix='bench-audio-'),
+        UTTERANCE_CACHE_DIR=tempfile.mkdtemp(prefix='bench-audio-'),
+        BLOG_SNAPSHOT_PATH=''
+    )
+    import app
+    client = app.app.test_client()
+
+    results = [bench(app, client, output_format, stream)
+               for output_format in args.formats.split(',') for stream in (False, True)]
+
+    print(f'フレーズ {len(PHRASES)} 件（{sum(len(phrase) for phrase in PHRASES)} 文字）')
+    print(f"{'format':14} {'mode':8} {'bytes':>8} {'saved':>8} {'ttfb':>9} {'total':>9}  valid")
+    for r in results:
+        print(f"{r['format']:14} {r['mode']:8} {r['mean_bytes']:8d} {r['mean_bytes_saved']:8d} "
+              f"{r['ttfb_ms']:7.1f}ms {r['total_ms']:7.1f}ms  {'ok' if r['valid'] else '; '.join(r['errors'])}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'phrases': PHRASES, 'results': results}, f, ensure_ascii=False, indent=2)
+    return 0 if all(r['valid'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""音声合成のチャンク分割ごとの、最初の音声までの時間と上流リクエスト数のベンチマーク
+
+    python bench/bench_chunking.py --replies replies.txt --tts-latency 0.2 --latency-per-char 0.01
+
+記録した返答（--replies で1行1返答のファイルを渡す。省略時は同梱の返答集）を分割方法ごとに
+ElevenLabs のスタブ（bench/stubs.py）に向けて合成し、返答1件あたりの
+  chunks    : 上流へのリクエスト数
+  first     : 先頭チャンクの文字数
+  first_ms  : 先頭チャンクを一括 API で合成し終わるまで（チャット音声の最初の audio イベントまで）
+  ttfb_ms   : /api/tts の stream で最初の音声バイトが届くまで
+  total_ms  : /api/tts の stream で最後まで届くまで
+を出す。legacy は以前の split_text（100文字までの貪欲な詰め込み）。
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from stubs import start_elevenlabs_stub
+
+# 記録した返答（チャットの返答ログから選んだもの）
+REPLIES = [
+    'いやー、まぁねー。高知の海はほんとにきれいだよ。天気いい日に海沿い歩くと気分転換になるし、けっこうおすすめ！君はどこ出身なの？',
+    'あー、それね！最近はロケットラボの作業が多くて、夜遅くまで大学に残ってることが多いかな。でも楽しいからいいんだよね。',
+    'うん、テニスサークルは週に二回くらい。ゆるい感じだから初心者でも全然大丈夫だよ。ラケットは貸してもらえるし、'
+    '終わったあとにみんなでご飯行くのが一番の楽しみだったりする。君もやってみる？',
+    'そうそう、10月中旬は実習でずっと高知にいたよ。朝早くて大変だったけど、地元の人がすごく優しくて、'
+    '毎日なにかしら差し入れをもらってた。カツオのたたきが本当においしくて、三日連続で食べたのはいい思い出。'
+    'また行きたいなって思ってる。',
+    'ラーメンは丸源ラーメンの肉そばが好き！',
+    'えっと、ブログにも書いたんだけど、先週は研究室の先輩と一緒に学会の準備をしてて、ポスターを三回くらい作り直したんだよね。'
+    '最初は文字ばっかりで全然伝わらなくて、図を増やしたらだいぶ見やすくなった。発表当日はけっこう緊張したけど、'
+    '質問もたくさんもらえて、次の研究のヒントになりそうなこともいろいろ聞けたから、やってよかったなって思う。',
+    'まぁ、ぼちぼちかな。',
+    'おー、いいね！高知に来るなら、ひろめ市場は絶対行ったほうがいいよ。昼から賑わってて、いろんなお店のものを'
+    'ちょっとずつ食べられるから楽しい。',
+]
+
+def legacy_split(text, max_length=100):
+    """以前の split_text（句読点で分けて max_length 文字まで貪欲に詰め、長すぎる文は文字数で切る）"""
+    if len(text) <= max_length:
+        return [text]
+    chunks = []
+    current_chunk = ''
+    sentences = text.replace('。', '。\n').replace('、', '、\n').replace('！', '！\n').replace('？', '？\n').split('\n')
+    for sentence in sentences:
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(current_chunk) + len(sentence) <= max_length:
+            current_chunk += sentence
+        else:
+            if current_chunk:
+                chunks.append(current_chunk)
+            if len(sentence) > max_length:
+                for i in range(0, len(sentence), max_length):
+                    chunks.append(sentence[i:i + max_length])
+                current_chunk = ''
+            else:
+                current_chunk = sentence
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+def planners(app):
+    """ベンチマークする分割方法（名前 -> text を受け取ってチャンクを返す関数）"""
+    plan_chunks = app.plan_chunks
+    return {
+        'legacy': legacy_split,
+        'fixed100': lambda text: plan_chunks(text, max_length=100, first_length=0),
+        'adaptive': lambda text: plan_chunks(text),
+        'first12': lambda text: plan_chunks(text, first_length=12),
+        'first30': lambda text: plan_chunks(text, first_length=30),
+        'growth2.5': lambda text: plan_chunks(text, growth=2.5),
+        'max100': lambda text: plan_chunks(text, max_length=100)
+    }
+
+def bench(app, client, stub, name, planner, replies):
+    # /api/tts の stream はこの分割方法を使う
+    app.plan_chunks, original = (lambda text, *a, **kw: iter(planner(text))), app.plan_chunks
+    try:
+        rows = []
+        for text in replies:
+            chunks = list(planner(text))
+
+            start = time.perf_counter()
+            app.synthesize_chunk(chunks[0], 'bench', 'stub')
+            first_ms = (time.perf_counter() - start) * 1000
+
+            requests_before = stub.requests_served
+            start = time.perf_counter()
+            response = client.post('/api/tts', json={'text': text, 'stream': True}, buffered=False)
+            pieces = iter(response.response)
+            next(pieces)
+            ttfb_ms = (time.perf_counter() - start) * 1000
+            for _ in pieces:
+                pass
+            response.close()
+            rows.append({
+                'chunks': stub.requests_served - requests_before,
+                'first_chars': len(chunks[0]),
+                'first_ms': first_ms,
+                'ttfb_ms': ttfb_ms,
+                'total_ms': (time.perf_counter() - start) * 1000
+            })
+    finally:
+        app.plan_chunks = original
+
+    def mean(key):
+        return round(sum(row[key] for row in rows) / len(rows), 1)
+
+    return {
+        'planner': name,
+        'replies': len(rows),
+        'requests': sum(row['chunks'] for row in rows),
+        'chunks_per_reply': mean('chunks'),
+        'first_chars': mean('first_chars'),
+        'first_ms': mean('first_ms'),
+        'ttfb_ms': mean('ttfb_ms'),
+        'total_ms': mean('total_ms')
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--replies', type=argparse.FileType('r', encoding='utf-8'), help='1行1返答のファイル')
+    parser.add_argument('--planners', help='分割方法（カンマ区切り、省略時はすべて）')
+    parser.add_argument('--tts-latency', type=float, default=0.2, help='ElevenLabs の固定の遅延（秒）')
+    parser.add_argument('--latency-per-char', type=float, default=0.01, help='1文字あたりの合成時間（秒）')
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    args = parser.parse_args()
+
+    replies = [line.strip() for line in args.replies if line.strip()] if args.replies else REPLIES
+    stub = start_elevenlabs_stub(0, latency=args.tts_latency, latency_per_char=args.latency_per_char)
+    os.environ.update(
+        ELEVENLABS_API_KEY='stub',
+        ELEVENLABS_API_BASE=f'http://127.0.0.1:{stub.server_address[1]}',
+        TTS_CACHE_MEMORY_BYTES='0',
+        TTS_CACHE_DISK_BYTES='0',
+        UTTERANCE_CACHE_MEMORY_BYTES='0',
+        UTTERANCE_CACHE_DISK_BYTES='0',
+        TTS_CACHE_DIR=tempfile.mkdtemp(prefix='bench-chunking-'),
+        UTTERANCE_CACHE_DIR=tempfile.mkdtemp(prefix='bench-chunking-'),
+        BLOG_SNAPSHOT_PATH=''
+    )
+    import app
+    client = app.app.test_client()
+
+    selected = planners(app)
+    if args.planners:
+        selected = {name: selected[name] for name in args.planners.split(',')}
+    results = [bench(app, client, stub, name, planner, replies) for name, planner in selected.items()]
+
+    print(f'返答 {len(replies)} 件（平均 {sum(len(reply) for reply in replies) / len(replies):.0f} 文字）, '
+          f'遅延 {args.tts_latency}s + {args.latency_per_char}s/文字')
+    print(f"{'planner':10} {'requests':>8} {'chunks':>7} {'first':>6} {'first_ms':>9} {'ttfb':>9} {'total':>9}")
+    for r in results:
+        print(f"{r['planner']:10} {r['requests']:8d} {r['chunks_per_reply']:7.1f} {r['first_chars']:6.1f} "
+              f"{r['first_ms']:7.1f}ms {r['ttfb_ms']:7.1f}ms {r['total_ms']:7.1f}ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': {key: value for key, value in vars(args).items() if key != 'replies'},
+                       'replies': replies, 'results': results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
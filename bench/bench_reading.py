@@ -0,0 +1,55 @@
+"""correct_reading のベンチマーク
+
+    python bench/bench_reading.py
+
+従来の str.replace 連鎖版と最長一致版（1回走査）の処理時間を比べる。
+置き換え結果の正しさは tests/test_reading.py で確かめる。
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import correct_reading, reading_corrections
+
+# 辞書語を含む短い文
+CORPUS = [
+    '海沿いを散歩した',
+    '海がきれい',
+    '農林海洋科学部に通う',
+    '丹羽康揮です',
+    '丹羽です、庭園の庭',
+    '高知大学は高知にある',
+    '丸源ラーメンと丸源',
+    '仕方なくないけど仕方ない',
+    '岐阜県の岐阜',
+    'Rocket Lab を応援してる',
+    'いやー、まぁねー',
+]
+
+# 典型的な返答文（辞書語は少なめ）
+REPLY = ('いやー、まぁねー。最近は高知の海沿いをよく散歩してるんだよね。天気がいい日は本当に気持ちいいし、'
+         '気分転換にもなるし。そういえば昨日は友達とラーメン食べに行ったんだけど、めっちゃ混んでて'
+         '結構待ったわ笑。でも美味しかったから満足！君は最近どこか出かけた？')
+
+def legacy_correct_reading(text):
+    """辞書順に str.replace を繰り返す従来の実装"""
+    corrected_text = text
+    for wrong, correct in reading_corrections.items():
+        corrected_text = corrected_text.replace(wrong, correct)
+    return corrected_text
+
+def main():
+    samples = (
+        ('短文', CORPUS[0], 20000),
+        ('返答', REPLY, 5000),
+        ('辞書語だらけ', ''.join(CORPUS) * 20, 500),
+    )
+    for label, fn in (('従来 str.replace', legacy_correct_reading), ('最長一致', correct_reading)):
+        for name, sample, number in samples:
+            seconds = min(timeit.repeat(lambda: fn(sample), number=number, repeat=3))
+            print(f'{label:16} {name}（{len(sample)}文字） {seconds / number * 1e6:9.2f} µs/回')
+
+if __name__ == '__main__':
+    sys.exit(main())
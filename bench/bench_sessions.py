@@ -0,0 +1,123 @@
+"""会話履歴の保存先（memory / sqlite）ごとの追記・読み出しのベンチマーク
+
+    python bench/bench_sessions.py --workers 1,4,8 --ops 2000 --sessions 200
+
+gunicorn のワーカーと同じく別プロセス（--mode threads ならスレッド）を並べ、
+それぞれが「user の発言を追記 → 履歴の窓を読む → assistant の発言を追記」を繰り返す。
+追記と読み出しのレイテンシ（p50/p95/p99）と、全体のスループット（1秒あたりの操作数）を出す。
+memory はワーカーごとに別々の履歴になる点に注意（共有されるのは sqlite だけ）。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import CHAT_HISTORY_TOKEN_BUDGET, CHAT_SESSION_TTL, SESSION_BACKENDS
+
+MESSAGES = ['海って好き？', '最近ラーメン食べた？', '10月中旬は何してた？', 'テニスサークルってどんな感じ？',
+            '高知大学の実習について教えて', 'ロケットラボのどこが好き？']
+REPLY = 'いやー、まぁねー。高知の海はほんとにきれいだよ。天気いい日に海沿い歩くと気分転換になるし、けっこうおすすめ！'
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def run_worker(backend, path, worker, ops, sessions, results):
+    kwargs = {'path': path} if backend == 'sqlite' else {}
+    store = SESSION_BACKENDS[backend](max(sessions, 1000), CHAT_SESSION_TTL, CHAT_HISTORY_TOKEN_BUDGET, **kwargs)
+    rng = random.Random(worker)
+    appends, reads = [], []
+    for i in range(ops):
+        session_id = f'session{rng.randrange(sessions)}'
+
+        start = time.perf_counter()
+        store.append(session_id, 'user', f'{rng.choice(MESSAGES)}{i}')
+        appends.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        store.get_history(session_id)
+        reads.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        store.append(session_id, 'assistant', REPLY)
+        appends.append(time.perf_counter() - start)
+    results.put((appends, reads))
+
+def bench(backend, workers, ops, sessions, mode):
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-sessions-'), 'sessions.sqlite3')
+    if backend == 'sqlite':
+        # スキーマを先に作っておく
+        SESSION_BACKENDS['sqlite'](1000, CHAT_SESSION_TTL, CHAT_HISTORY_TOKEN_BUDGET, path=path)
+
+    if mode == 'processes':
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        runners = [context.Process(target=run_worker, args=(backend, path, w, ops, sessions, results))
+                   for w in range(workers)]
+    else:
+        import queue
+        results = queue.Queue()
+        runners = [threading.Thread(target=run_worker, args=(backend, path, w, ops, sessions, results))
+                   for w in range(workers)]
+
+    start = time.perf_counter()
+    for runner in runners:
+        runner.start()
+    collected = [results.get() for _ in runners]
+    elapsed = time.perf_counter() - start
+    for runner in runners:
+        runner.join()
+
+    appends = [value for a, _ in collected for value in a]
+    reads = [value for _, r in collected for value in r]
+    return {
+        'backend': backend,
+        'workers': workers,
+        'operations': len(appends) + len(reads),
+        'ops_per_s': round((len(appends) + len(reads)) / elapsed, 1),
+        'append_p50_ms': round(percentile(appends, 0.50) * 1000, 3),
+        'append_p95_ms': round(percentile(appends, 0.95) * 1000, 3),
+        'append_p99_ms': round(percentile(appends, 0.99) * 1000, 3),
+        'read_p50_ms': round(percentile(reads, 0.50) * 1000, 3),
+        'read_p95_ms': round(percentile(reads, 0.95) * 1000, 3),
+        'read_p99_ms': round(percentile(reads, 0.99) * 1000, 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backends', default='memory,sqlite')
+    parser.add_argument('--workers', default='1,4,8', help='並列ワーカー数（カンマ区切り）')
+    parser.add_argument('--ops', type=int, default=2000, help='ワーカーごとの往復数')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--mode', choices=('processes', 'threads'), default='processes')
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    args = parser.parse_args()
+
+    results = [
+        bench(backend, int(workers), args.ops, args.sessions, args.mode)
+        for backend in args.backends.split(',')
+        for workers in args.workers.split(',')
+    ]
+
+    print(f"{'backend':8} {'workers':>7} {'ops/s':>10} {'append p50':>11} {'p95':>8} {'p99':>8} "
+          f"{'read p50':>9} {'p95':>8} {'p99':>8}")
+    for r in results:
+        print(f"{r['backend']:8} {r['workers']:7d} {r['ops_per_s']:10.1f} {r['append_p50_ms']:9.3f}ms "
+              f"{r['append_p95_ms']:6.3f}ms {r['append_p99_ms']:6.3f}ms {r['read_p50_ms']:7.3f}ms "
+              f"{r['read_p95_ms']:6.3f}ms {r['read_p99_ms']:6.3f}ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
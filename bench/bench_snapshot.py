@@ -0,0 +1,125 @@
+"""ブログ記事スナップショットファイルの起動時間・メモリ・検索速度のベンチマーク
+
+    python bench/bench_snapshot.py --posts 3000 --workers 4
+
+新しいプロセスで記事を用意するまでの時間と、その後の RSS / PSS（共有ページを按分した実メモリ）を比べる。
+  build    : Firestore の代役から読み込んで検索構造を作る（従来の起動）
+  snapshot : 書き出し済みのスナップショットファイルを mmap する
+--workers 個のプロセスを同時に起動し、PSS の合計でワーカー間の共有の効き具合を見る。
+最後に同じクエリでのブログコンテキスト組み立ての時間も比べる。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from corpus import FakeFirestore, generate_posts
+
+QUERIES = ['ラーメン', '高知の海', '10月中旬は何してた？', '先週', 'テニスサークルってどんな感じ？', 'ロケットラボ',
+           '海', 'カフェでバイト', 'note', '5月']
+
+def read_memory_kb(pid='self'):
+    """(RSS, PSS) を KB で返す"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    values[key] = int(rest.split()[0])
+    except OSError:
+        pass
+    return values.get('Rss'), values.get('Pss')
+
+def start_worker(mode, posts, firestore_latency, ready, done):
+    import app
+    app.get_firestore_db = lambda: FakeFirestore(generate_posts(posts), latency=firestore_latency)
+    rss_before, _ = read_memory_kb()
+    start = time.perf_counter()
+    corpus = app.load_blog_snapshot() if mode == 'snapshot' else app.load_blog_posts()
+    startup_ms = (time.perf_counter() - start) * 1000
+    # 最初のクエリまで（snapshot は参照した記事の文字列を展開する）
+    start = time.perf_counter()
+    for query in QUERIES:
+        app._build_context(corpus, app.normalize_query(query))
+    first_queries_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    for query in QUERIES:
+        app._build_context(corpus, app.normalize_query(query))
+    warm_queries_ms = (time.perf_counter() - start) * 1000
+    rss, pss = read_memory_kb()
+    ready.put({
+        'startup_ms': startup_ms,
+        'first_query_ms': first_queries_ms / len(QUERIES),
+        'warm_query_ms': warm_queries_ms / len(QUERIES),
+        'rss_delta_mb': (rss - rss_before) / 1024 if rss and rss_before else None,
+        'pss_mb': pss / 1024 if pss else None
+    })
+    # 他のワーカーが揃うまでページを持ったまま待つ（PSS を同時に測る）
+    done.wait()
+
+def bench(mode, workers, posts, firestore_latency):
+    context = multiprocessing.get_context('spawn')
+    ready, done = context.Queue(), context.Event()
+    processes = [context.Process(target=start_worker, args=(mode, posts, firestore_latency, ready, done))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    results = [ready.get() for _ in processes]
+    pss_total = sum(read_memory_kb(process.pid)[1] or 0 for process in processes) / 1024
+    done.set()
+    for process in processes:
+        process.join()
+
+    def mean(key):
+        values = [r[key] for r in results if r[key] is not None]
+        return round(sum(values) / len(values), 2) if values else None
+
+    return {
+        'mode': mode,
+        'workers': workers,
+        'startup_ms': mean('startup_ms'),
+        'first_query_ms': mean('first_query_ms'),
+        'warm_query_ms': mean('warm_query_ms'),
+        'rss_delta_mb': mean('rss_delta_mb'),
+        'pss_total_mb': round(pss_total, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--firestore-latency', type=float, default=0.5)
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    args = parser.parse_args()
+
+    # ベンチマーク用のスナップショットファイルを先に書き出しておく
+    os.environ['BLOG_SNAPSHOT_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bench-snapshot-'), 'blog.snapshot')
+    import app
+    app.get_firestore_db = lambda: FakeFirestore(generate_posts(args.posts), latency=0)
+    corpus = app.load_blog_posts()
+    start = time.perf_counter()
+    size = app.write_blog_snapshot(corpus)
+    write_ms = round((time.perf_counter() - start) * 1000, 2)
+
+    results = [bench(mode, args.workers, args.posts, args.firestore_latency) for mode in ('build', 'snapshot')]
+
+    print(f'記事 {args.posts} 件, スナップショット {size / 1024 / 1024:.1f} MB（書き出し {write_ms}ms）')
+    print(f"{'mode':9} {'workers':>7} {'startup':>10} {'1st query':>10} {'query':>9} {'rss/worker':>11} {'pss total':>10}")
+    for r in results:
+        print(f"{r['mode']:9} {r['workers']:7d} {r['startup_ms']:8.1f}ms {r['first_query_ms']:8.2f}ms "
+              f"{r['warm_query_ms']:7.2f}ms {r['rss_delta_mb'] or 0:9.1f}MB {r['pss_total_mb']:8.1f}MB")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'snapshot_bytes': size, 'write_ms': write_ms, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
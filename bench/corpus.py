@@ -0,0 +1,79 @@
+"""ベンチマーク用の合成ブログ記事と Firestore の代役
+
+    python bench/corpus.py --posts 3000 > posts.json
+
+実際の記事に近い語彙・長さ（段落数・文字数）・日付の分布で記事を作る。
+FakeFirestore は get_firestore_db() の代わりに使える最小限の実装
+（collection('posts').stream() と doc.id / doc.to_dict() だけ）。
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+TOPICS = ['ラーメン', 'ハンバーガー', '高知', '海沿い', '四万十川', 'テニスサークル', '実習', '植物', '栽培',
+          'ロケットラボ', '宇宙', 'ヤフーニュース', 'note', 'モナカ', 'トイプードル', '正月', 'クリスマス',
+          '岐阜', '地理', '双子', '庭園', '松屋', '丸源ラーメン', '気分転換', '大学', 'バイト', 'カフェ']
+SUBJECTS = ['今日は', '最近', '昨日', '週末は', 'この前', 'ひさしぶりに', '朝から', '授業のあと']
+PREDICATES = ['に行ってきた', 'について考えてた', 'がめっちゃよかった', 'をやってみた', 'の話を聞いた',
+              'が気になってる', 'で友達と話した', 'を調べてみた']
+TAILS = ['笑', '。', '！', 'けど、まぁいっか。', 'んだよね。', 'と思う。', 'かもしれない。', 'って感じ。']
+
+def _sentence(rng):
+    return f"{rng.choice(SUBJECTS)}{rng.choice(TOPICS)}{rng.choice(PREDICATES)}{rng.choice(TAILS)}"
+
+def generate_posts(count, seed=0, start=date(2023, 4, 1), days=1000):
+    """count 件の記事（Firestore のドキュメントと同じ形の dict）を作る"""
+    rng = random.Random(seed)
+    posts = []
+    for i in range(count):
+        paragraphs = [''.join(_sentence(rng) for _ in range(rng.randint(2, 6))) for _ in range(rng.randint(2, 8))]
+        day = start + timedelta(days=rng.randrange(days))
+        posts.append({
+            'id': f'post{i:05d}',
+            'title': f"{rng.choice(TOPICS)}{rng.choice(['の話', 'について', '日記', 'に行った', 'のこと'])}",
+            'paragraphs': paragraphs,
+            'date': day.strftime('%Y.%m.%d')
+        })
+    return posts
+
+class FakeDocument:
+    def __init__(self, post):
+        self.id = post['id']
+        self._data = {key: value for key, value in post.items() if key != 'id'}
+
+    def to_dict(self):
+        return dict(self._data)
+
+class FakeCollection:
+    def __init__(self, posts, latency):
+        self.posts = posts
+        self.latency = latency
+
+    def stream(self):
+        # 全件読み込みの遅延（件数に比例する分も含める）
+        time.sleep(self.latency + len(self.posts) * 0.00005)
+        for post in self.posts:
+            yield FakeDocument(post)
+
+class FakeFirestore:
+    """get_firestore_db() の代役"""
+
+    def __init__(self, posts, latency=0.5):
+        self.posts = posts
+        self.latency = latency
+
+    def collection(self, name):
+        return FakeCollection(self.posts if name == 'posts' else [], self.latency)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    json.dump(generate_posts(args.posts, args.seed), sys.stdout, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
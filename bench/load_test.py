@@ -0,0 +1,169 @@
+"""同期版（Flask + gunicorn）と非同期版（ASGI + uvicorn）の負荷試験
+
+    python bench/load_test.py --concurrency 50 --requests 200
+
+ローカルのスタブ上流（bench/stubs.py）に向けて両方のサーバーを起動し、
+/api/chat と /api/tts に同じ並列度でリクエストを投げて、レイテンシとスループットを比べる。
+音声キャッシュは無効にして、毎回上流を呼ぶ条件で測る。
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+TTS_TEXT = ('いやー、まぁねー。高知の海はほんとにきれいだよ。天気いい日に海沿い歩くと気分転換になるし、'
+            'けっこうおすすめ！君はどこ出身なの？最近は実習が忙しくて、なかなか遊びに行けてないんだよね。'
+            'でも週末はテニスサークルで体動かしてるよ。')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def wait_until_up(url):
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not start')
+
+def start_server(kind, port, env, args):
+    if kind == 'sync':
+        command = ['gunicorn', 'app:app', '-b', f'127.0.0.1:{port}',
+                   '--workers', str(args.sync_workers), '--threads', str(args.sync_threads)]
+    else:
+        command = ['uvicorn', 'asgi_app:app', '--port', str(port), '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(f'http://127.0.0.1:{port}/')
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+async def drive(base_url, path, payload, concurrency, total):
+    """concurrency 並列で total 件リクエストを投げ、各レイテンシと失敗数を返す"""
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                i = queue.get_nowait()
+                body = {key: (value.format(i=i) if isinstance(value, str) else value) for key, value in payload.items()}
+                start = time.perf_counter()
+                try:
+                    response = await client.post(path, json=body)
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'throughput_rps': round(len(latencies) / elapsed, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--sync-workers', type=int, default=2)
+    parser.add_argument('--sync-threads', type=int, default=8)
+    parser.add_argument('--claude-latency', type=float, default=0.8)
+    parser.add_argument('--tts-latency', type=float, default=0.3)
+    parser.add_argument('--tts-max-workers', type=int, default=32)
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    args = parser.parse_args()
+
+    # スタブは負荷をかける側と GIL を取り合わないよう別プロセスで動かす
+    anthropic_port, elevenlabs_port = free_port(), free_port()
+    stubs = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'bench', 'stubs.py'),
+        '--anthropic-port', str(anthropic_port), '--elevenlabs-port', str(elevenlabs_port),
+        '--claude-latency', str(args.claude_latency), '--tts-latency', str(args.tts_latency)
+    ], stdout=subprocess.DEVNULL)
+    wait_until_up(f'http://127.0.0.1:{elevenlabs_port}/')
+
+    env = dict(
+        os.environ,
+        ANTHROPIC_API_KEY='stub',
+        ANTHROPIC_BASE_URL=f'http://127.0.0.1:{anthropic_port}',
+        ELEVENLABS_API_KEY='stub',
+        ELEVENLABS_API_BASE=f'http://127.0.0.1:{elevenlabs_port}',
+        # キャッシュで上流呼び出しが消えないようにする（前回の実行の音声も読まない）
+        TTS_CACHE_MEMORY_BYTES='0',
+        TTS_CACHE_DISK_BYTES='0',
+        UTTERANCE_CACHE_MEMORY_BYTES='0',
+        UTTERANCE_CACHE_DISK_BYTES='0',
+        TTS_CACHE_DIR=tempfile.mkdtemp(prefix='load-test-'),
+        UTTERANCE_CACHE_DIR=tempfile.mkdtemp(prefix='load-test-'),
+        TTS_MAX_WORKERS=str(args.tts_max_workers),
+        BLOG_INITIAL_LOAD_TIMEOUT='0'
+    )
+
+    results = {}
+    try:
+        for kind in ('sync', 'async'):
+            port = free_port()
+            process = start_server(kind, port, env, args)
+            try:
+                base_url = f'http://127.0.0.1:{port}'
+                results[kind] = {
+                    'chat': asyncio.run(drive(base_url, '/api/chat', {'message': '海って好き？{i}'},
+                                              args.concurrency, args.requests)),
+                    'tts': asyncio.run(drive(base_url, '/api/tts', {'text': TTS_TEXT},
+                                             args.concurrency, args.requests))
+                }
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        stubs.terminate()
+
+    print(f"{'server':8} {'endpoint':10} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>8} {'errors':>7}")
+    for kind, endpoints in results.items():
+        for endpoint, r in endpoints.items():
+            print(f"{kind:8} {endpoint:10} {r['p50_ms']:7.1f}ms {r['p95_ms']:7.1f}ms {r['p99_ms']:7.1f}ms "
+                  f"{r['throughput_rps']:8.2f} {r['errors']:7d}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""オフラインのベンチマーク（上流・Firestore はすべてローカルの代役）
+
+    python bench/run_bench.py --posts 3000 --levels 1,8,32 --requests 100 --json bench_output.json
+
+bench/stubs.py の Anthropic / ElevenLabs スタブと、bench/corpus.py の合成記事を返す
+Firestore の代役に向けて Flask アプリを別プロセスで起動し、/api/chat と /api/tts に
+並列度ごとにリクエストを投げる。レイテンシ（p50/p95/p99）・スループット・サーバーの RSS と、
+処理段階（ブログ検索・プロンプト組み立て・上流呼び出し・読み修正・TTS 分割）ごとの所要時間を出す。
+--json で結果を機械可読な形で書き出せるので、前回の結果と比べて劣化を検出できる。
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import wraps
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, ROOT)
+
+from load_test import TTS_TEXT, drive, free_port, percentile, wait_until_up
+
+CHAT_MESSAGES = ['海って好き？{i}', '最近ラーメン食べた？{i}', '10月中旬は何してた？{i}', 'テニスサークルってどんな感じ？{i}',
+                 '高知大学の実習について教えて{i}', 'ロケットラボのどこが好き？{i}']
+
+def read_rss_mb(pid):
+    """プロセスの現在の RSS（MB）"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def serve(args):
+    """ベンチマーク対象のサーバー（代役を差し込み、段階ごとの時間を記録する）"""
+    import app
+    from corpus import FakeFirestore, generate_posts
+    from flask import jsonify
+
+    stages = {}
+    stages_lock = threading.Lock()
+    local = threading.local()
+
+    def record(stage, seconds):
+        with stages_lock:
+            stages.setdefault(stage, []).append(seconds)
+
+    def timed(stage, fn, exclude=None):
+        """fn の所要時間を stage として記録（exclude の段階の時間は差し引く）"""
+        @wraps(fn)
+        def wrapper(*a, **kw):
+            nested = getattr(local, 'nested', None)
+            local.nested = {}
+            start = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                elapsed = time.perf_counter() - start
+                inner = local.nested.get(exclude, 0) if exclude else 0
+                record(stage, elapsed - inner)
+                local.nested = nested
+                if nested is not None:
+                    nested[stage] = nested.get(stage, 0) + elapsed
+        return wrapper
+
+    posts = generate_posts(args.posts, args.seed)
+    fake_db = FakeFirestore(posts, latency=args.firestore_latency)
+    app.get_firestore_db = lambda: fake_db
+
+    client = SimpleNamespace(messages=SimpleNamespace(create=timed('upstream_claude', app.get_client().messages.create)))
+    app.get_client = lambda: client
+
+    app.build_context_with_blog = timed('retrieval', app.build_context_with_blog)
+    app.prepare_chat = timed('prompt_build', app.prepare_chat, exclude='retrieval')
+    app._post_elevenlabs = timed('upstream_elevenlabs', app._post_elevenlabs)
+    app.correct_reading = timed('reading_correction', app.correct_reading)
+    app.split_text = timed('tts_chunking', app.split_text)
+
+    @app.app.route('/__bench/stages', methods=['GET'])
+    def bench_stages():
+        with stages_lock:
+            return jsonify({
+                stage: {
+                    'count': len(values),
+                    'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                    'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+                    'p95_ms': round(percentile(values, 0.95) * 1000, 3)
+                }
+                for stage, values in stages.items() if values
+            })
+
+    @app.app.route('/__bench/reset', methods=['POST'])
+    def bench_reset():
+        with stages_lock:
+            stages.clear()
+        return jsonify({'ok': True})
+
+    # 記事の読み込みが終わってから受け付ける
+    app.get_blog_corpus()
+    app.blog_loaded.wait(60)
+
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', args.port, app.app, threaded=True).serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--levels', default='1,8,32', help='並列度（カンマ区切り）')
+    parser.add_argument('--requests', type=int, default=100, help='並列度ごと・エンドポイントごとのリクエスト数')
+    parser.add_argument('--claude-latency', type=float, default=0.8)
+    parser.add_argument('--tts-latency', type=float, default=0.3)
+    parser.add_argument('--firestore-latency', type=float, default=0.5)
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    anthropic_port, elevenlabs_port, app_port = free_port(), free_port(), free_port()
+    stubs = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'stubs.py'),
+        '--anthropic-port', str(anthropic_port), '--elevenlabs-port', str(elevenlabs_port),
+        '--claude-latency', str(args.claude_latency), '--tts-latency', str(args.tts_latency)
+    ], stdout=subprocess.DEVNULL)
+
+    env = dict(
+        os.environ,
+        ANTHROPIC_API_KEY='stub',
+        ANTHROPIC_BASE_URL=f'http://127.0.0.1:{anthropic_port}',
+        ELEVENLABS_API_KEY='stub',
+        ELEVENLABS_API_BASE=f'http://127.0.0.1:{elevenlabs_port}',
+        # キャッシュで上流呼び出しが消えないようにする
+        TTS_CACHE_MEMORY_BYTES='0',
+        TTS_CACHE_DISK_BYTES='0',
+        UTTERANCE_CACHE_MEMORY_BYTES='0',
+        UTTERANCE_CACHE_DISK_BYTES='0',
+        TTS_CACHE_DIR=tempfile.mkdtemp(prefix='run-bench-'),
+        UTTERANCE_CACHE_DIR=tempfile.mkdtemp(prefix='run-bench-'),
+        RESPONSE_CACHE_SIZE='0',
+        BLOG_CONTEXT_MEMO_SIZE='0',
+        # 前回の実行で書き出した記事スナップショットを読まない（--posts の件数で作り直す）
+        BLOG_SNAPSHOT_PATH=''
+    )
+    started = time.perf_counter()
+    server = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), '--serve', '--port', str(app_port),
+        '--posts', str(args.posts), '--seed', str(args.seed), '--firestore-latency', str(args.firestore_latency)
+    ], cwd=BENCH_DIR, env=env, stdout=subprocess.DEVNULL)
+
+    results = []
+    try:
+        base_url = f'http://127.0.0.1:{app_port}'
+        wait_until_up(f'http://127.0.0.1:{elevenlabs_port}/')
+        wait_until_up(f'{base_url}/')
+        startup_s = round(time.perf_counter() - started, 2)
+        idle_rss_mb = read_rss_mb(server.pid)
+
+        import httpx
+        for level in (int(level) for level in args.levels.split(',')):
+            for endpoint, path, payload in (
+                ('chat', '/api/chat', {'message': CHAT_MESSAGES[level % len(CHAT_MESSAGES)]}),
+                ('tts', '/api/tts', {'text': TTS_TEXT})
+            ):
+                httpx.post(f'{base_url}/__bench/reset')
+                result = asyncio.run(drive(base_url, path, payload, level, args.requests))
+                result.update({
+                    'endpoint': endpoint,
+                    'concurrency': level,
+                    'rss_mb': read_rss_mb(server.pid),
+                    'stages': httpx.get(f'{base_url}/__bench/stages').json()
+                })
+                results.append(result)
+    finally:
+        server.terminate()
+        stubs.terminate()
+
+    print(f'起動まで {startup_s}s, 待機時 RSS {idle_rss_mb} MB, 記事 {args.posts} 件')
+    print(f"{'endpoint':8} {'conc':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>7} {'err':>4} {'rss':>7}  stages (p50)")
+    for r in results:
+        stages = ', '.join(f"{name}={s['p50_ms']:.2f}ms" for name, s in sorted(r['stages'].items()))
+        print(f"{r['endpoint']:8} {r['concurrency']:4d} {r['p50_ms']:7.1f}ms {r['p95_ms']:7.1f}ms "
+              f"{r['p99_ms']:7.1f}ms {r['throughput_rps']:7.2f} {r['errors']:4d} {r['rss_mb'] or 0:5.1f}MB  {stages}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'config': {key: value for key, value in vars(args).items() if key not in ('serve', 'port', 'json')},
+                'startup_s': startup_s,
+                'idle_rss_mb': idle_rss_mb,
+                'results': results
+            }, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
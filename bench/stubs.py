@@ -0,0 +1,250 @@
+"""ベンチマーク用の上流スタブ（Anthropic Messages API と ElevenLabs TTS API）
+
+    python bench/stubs.py --anthropic-port 18001 --elevenlabs-port 18002
+
+アプリ側は ANTHROPIC_BASE_URL=http://127.0.0.1:18001 と
+ELEVENLABS_API_BASE=http://127.0.0.1:18002 を設定すると本物の代わりにこちらを呼ぶ。
+遅延と返すデータの大きさは引数で変えられる。
+ElevenLabs は output_format を付けて呼ばれると、その形式の合成音声（中身は無音相当のダミー）を返す。
+MP3 は本物と同じく先頭に ID3v2 タグと Xing フレームが付き、Ogg Opus は OpusHead / OpusTags から始まる。
+"""
+import argparse
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# 返答の文面（実際の返答に近い長さ・句読点の入り方）
+REPLY_TEXT = ('いやー、まぁねー。高知の海はほんとにきれいだよ。'
+              '天気いい日に海沿い歩くと気分転換になるし、けっこうおすすめ！君はどこ出身なの？')
+
+# 既定の形式（128kbps MP3）での1文字あたりのバイト数から発話の長さを決める
+BASELINE_BITRATE = 128000
+# MP3 のビットレートのインデックス（MPEG-1 と MPEG-2 の Layer III）
+MP3_BITRATE_INDEX = {
+    1: {32: 1, 40: 2, 48: 3, 56: 4, 64: 5, 80: 6, 96: 7, 112: 8, 128: 9, 160: 10, 192: 11, 224: 12, 256: 13, 320: 14},
+    2: {8: 1, 16: 2, 24: 3, 32: 4, 40: 5, 48: 6, 56: 7, 64: 8, 80: 9, 96: 10, 112: 11, 128: 12, 144: 13, 160: 14}
+}
+MP3_RATE_INDEX = {44100: (1, 0), 48000: (1, 1), 32000: (1, 2), 22050: (2, 0), 24000: (2, 1), 16000: (2, 2)}
+OPUS_PRE_SKIP = 312
+
+def fake_mp3(seconds, sample_rate, kbps):
+    """ID3v2 タグ + Xing フレーム + 固定ビットレートのフレーム（モノラル）"""
+    version, rate_index = MP3_RATE_INDEX[sample_rate]
+    header = bytes([
+        0xFF, 0xFB if version == 1 else 0xF3,
+        MP3_BITRATE_INDEX[version][kbps] << 4 | rate_index << 2, 0xC0
+    ])
+    frame_length = (144 if version == 1 else 72) * kbps * 1000 // sample_rate
+    samples = 1152 if version == 1 else 576
+    frames = max(math.ceil(seconds * sample_rate / samples), 1)
+    side_info = 17 if version == 1 else 9
+    xing = header + bytes(side_info) + b'Xing' + struct.pack('>II', 3, frames)
+    tag_body = bytes(32)
+    tag = b'ID3\x04\x00\x00' + bytes([0, 0, 0, len(tag_body)]) + tag_body
+    frame = header + b'\x55' * (frame_length - 4)
+    return tag + xing.ljust(frame_length, b'\x00') + frame * frames
+
+def ogg_crc(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1) & 0xFFFFFFFF
+    return crc
+
+def ogg_page(packets, flags, granule, serial, sequence):
+    lacing = []
+    for packet in packets:
+        lacing += [255] * (len(packet) // 255) + [len(packet) % 255]
+    page = bytearray(struct.pack('<4sBBqIIIB', b'OggS', 0, flags, granule, serial, sequence, 0, len(lacing)))
+    page += bytes(lacing) + b''.join(packets)
+    struct.pack_into('<I', page, 22, ogg_crc(page))
+    return bytes(page)
+
+def fake_ogg_opus(seconds, kbps, serial):
+    """OpusHead・OpusTags のページと、20ms のパケットを1秒分ずつ入れたページ（モノラル）"""
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, OPUS_PRE_SKIP, 48000, 0, 0)
+    vendor = b'stub'
+    tags = b'OpusTags' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0)
+    pages = [ogg_page([head], 0x02, 0, serial, 0), ogg_page([tags], 0, 0, serial, 1)]
+    packet = b'\x55' * (kbps * 1000 // 8 // 50)
+    packets = max(math.ceil(seconds * 50), 1)
+    for start in range(0, packets, 50):
+        count = min(50, packets - start)
+        flags = 0x04 if start + count == packets else 0
+        granule = OPUS_PRE_SKIP + (start + count) * 960
+        pages.append(ogg_page([packet] * count, flags, granule, serial, len(pages)))
+    return b''.join(pages)
+
+def fake_audio(output_format, seconds, serial):
+    """ElevenLabs の output_format（例: mp3_44100_128、opus_48000_32）の音声と Content-Type"""
+    codec, sample_rate, kbps = output_format.split('_')
+    if codec == 'opus':
+        return fake_ogg_opus(seconds, int(kbps), serial), 'audio/ogg'
+    return fake_mp3(seconds, int(sample_rate), int(kbps)), 'audio/mpeg'
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, handler, options):
+        super().__init__(address, handler)
+        self.options = options
+        self.requests_served = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.requests_served += 1
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_bytes(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+class AnthropicHandler(StubHandler):
+    """POST /v1/messages（stream=true なら SSE）"""
+
+    def do_POST(self):
+        body = self.read_json()
+        self.server.count()
+        options = self.server.options
+        reply = (REPLY_TEXT * (options['reply_chars'] // len(REPLY_TEXT) + 1))[:options['reply_chars']]
+        usage = {
+            'input_tokens': 1200,
+            'output_tokens': len(reply),
+            'cache_read_input_tokens': 0,
+            'cache_creation_input_tokens': 0
+        }
+        message = {
+            'id': 'msg_stub',
+            'type': 'message',
+            'role': 'assistant',
+            'model': body.get('model', 'stub'),
+            'content': [],
+            'stop_reason': None,
+            'stop_sequence': None,
+            'usage': usage
+        }
+
+        if not body.get('stream'):
+            time.sleep(options['latency'])
+            message['content'] = [{'type': 'text', 'text': reply}]
+            message['stop_reason'] = 'end_turn'
+            self.send_bytes(200, 'application/json', json.dumps(message).encode())
+            return
+
+        def event(name, data):
+            self.send_chunk(f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode())
+
+        # 最初のトークンまで first_token_latency、残りは latency の間に均等に流す
+        step = 4
+        pieces = [reply[i:i + step] for i in range(0, len(reply), step)]
+        time.sleep(options['first_token_latency'])
+        self.start_chunked('text/event-stream')
+        event('message_start', {'type': 'message_start', 'message': message})
+        event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                      'content_block': {'type': 'text', 'text': ''}})
+        delay = max(options['latency'] - options['first_token_latency'], 0) / max(len(pieces), 1)
+        for piece in pieces:
+            event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                          'delta': {'type': 'text_delta', 'text': piece}})
+            time.sleep(delay)
+        event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                'usage': {'output_tokens': len(reply)}})
+        event('message_stop', {'type': 'message_stop'})
+        self.end_chunked()
+
+class ElevenLabsHandler(StubHandler):
+    """POST /v1/text-to-speech/{voice_id}[/stream]（文字数に比例した大きさのダミー音声を返す）"""
+
+    def do_POST(self):
+        body = self.read_json()
+        self.server.count()
+        options = self.server.options
+        text = body.get('text', '')
+        url = urlsplit(self.path)
+        output_format = parse_qs(url.query).get('output_format', [None])[0]
+        if output_format:
+            # 既定の形式で bytes_per_char になる長さの音声
+            seconds = options['bytes_per_char'] * max(len(text), 1) * 8 / BASELINE_BITRATE
+            audio, content_type = fake_audio(output_format, seconds, zlib.crc32(text.encode()))
+        else:
+            audio, content_type = bytes(options['bytes_per_char'] * max(len(text), 1)), 'audio/mpeg'
+        latency = options['latency'] + options['latency_per_char'] * len(text)
+
+        if url.path.endswith('/stream'):
+            time.sleep(options['latency'])
+            self.start_chunked(content_type)
+            pieces = [audio[i:i + 4096] for i in range(0, len(audio), 4096)]
+            for piece in pieces:
+                self.send_chunk(piece)
+                time.sleep(options['latency_per_char'] * len(text) / max(len(pieces), 1))
+            self.end_chunked()
+            return
+
+        time.sleep(latency)
+        self.send_bytes(200, content_type, audio)
+
+def start_stub(handler, port, **options):
+    """スタブを別スレッドで起動してサーバーを返す（port=0 なら空いているポート）"""
+    server = StubServer(('127.0.0.1', port), handler, options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_anthropic_stub(port=0, latency=0.8, first_token_latency=0.3, reply_chars=80):
+    return start_stub(AnthropicHandler, port, latency=latency,
+                      first_token_latency=first_token_latency, reply_chars=reply_chars)
+
+def start_elevenlabs_stub(port=0, latency=0.3, latency_per_char=0.003, bytes_per_char=400):
+    return start_stub(ElevenLabsHandler, port, latency=latency,
+                      latency_per_char=latency_per_char, bytes_per_char=bytes_per_char)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--anthropic-port', type=int, default=18001)
+    parser.add_argument('--elevenlabs-port', type=int, default=18002)
+    parser.add_argument('--claude-latency', type=float, default=0.8)
+    parser.add_argument('--tts-latency', type=float, default=0.3)
+    args = parser.parse_args()
+
+    start_anthropic_stub(args.anthropic_port, latency=args.claude_latency)
+    start_elevenlabs_stub(args.elevenlabs_port, latency=args.tts_latency)
+    print(f'Anthropic stub: http://127.0.0.1:{args.anthropic_port}')
+    print(f'ElevenLabs stub: http://127.0.0.1:{args.elevenlabs_port}')
+    threading.Event().wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""gunicorn の設定（Procfile の `gunicorn app:app` はこのファイルを自動で読み込む）
+
+GUNICORN_PRELOAD=1（既定）なら、親プロセスでクライアント・ブログ記事・検索構造を1度だけ用意してから
+ワーカーを fork する。ワーカーは準備済みのメモリをコピーオンライトで共有し、最初のリクエストで待たない。
+GUNICORN_PRELOAD=0 なら各ワーカーがリクエストを受け付ける前に同じ準備をする。
+"""
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import app
+        app.warmup(start_sync=False)
+        app.prepare_fork()
+
+def post_worker_init(worker):
+    import app
+    app.warmup()
@@ -0,0 +1,26 @@
+"""テスト共通の設定
+
+app は読み込み時に環境変数から設定を決めるので、ここで外部サービス・共有ディレクトリを使わない設定にしてから読み込む。
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# bench/ のスタブ（fake_audio）と検証（check_mp3 / check_ogg）をテストでも使う
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+os.environ.update(
+    BLOG_SNAPSHOT_PATH='',
+    TTS_CACHE_MEMORY_BYTES='0',
+    TTS_CACHE_DISK_BYTES='0',
+    UTTERANCE_CACHE_MEMORY_BYTES='0',
+    UTTERANCE_CACHE_DISK_BYTES='0',
+    TTS_CACHE_DIR=tempfile.mkdtemp(prefix='test-tts-cache-'),
+    UTTERANCE_CACHE_DIR=tempfile.mkdtemp(prefix='test-utterance-cache-'),
+    TTS_OUTPUT_FORMAT='mp3_44100_128',
+    TTS_FIRST_CHUNK_LENGTH='20',
+    TTS_FIRST_CHUNK_MIN_LENGTH='4',
+    TTS_CHUNK_MAX_LENGTH='200',
+    TTS_CHUNK_GROWTH='6'
+)
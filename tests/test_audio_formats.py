@@ -0,0 +1,75 @@
+"""出力形式の選択と、チャンクごとの音声を1本につなぐ AudioJoiner のテスト"""
+import pytest
+
+import app
+from bench_audio_formats import check_mp3, check_ogg
+from stubs import fake_audio
+
+@pytest.mark.parametrize('requested, accept, expected', [
+    (None, None, 'mp3_44100_128'),
+    ('mp3_22050_32', None, 'mp3_22050_32'),
+    ('mp3-low', None, 'mp3_22050_32'),
+    ('opus', 'audio/mpeg', 'opus_48000_32'),
+    (None, '*/*', 'mp3_44100_128'),
+    (None, 'audio/ogg', 'opus_48000_32'),
+    (None, 'audio/ogg;q=0.5, audio/mpeg', 'mp3_44100_128'),
+    (None, 'audio/webm', 'mp3_44100_128'),
+])
+def test_negotiate_audio_format(requested, accept, expected):
+    assert app.negotiate_audio_format(requested, accept) == expected
+
+def test_negotiate_audio_format_rejects_unknown_names():
+    with pytest.raises(ValueError):
+        app.negotiate_audio_format('wav')
+
+def fake_chunks(output_format, count):
+    # チャンクごとに長さとシリアル番号を変える（ElevenLabs はリクエストごとに別のストリームを返す）
+    return [fake_audio(output_format, 0.5 + 0.3 * i, serial=1000 + i)[0] for i in range(count)]
+
+def check(output_format, audio):
+    if app.AUDIO_FORMATS[output_format]['container'] == 'ogg':
+        return check_ogg(app, audio)
+    return check_mp3(app, audio)
+
+@pytest.mark.parametrize('output_format', ['mp3_44100_128', 'mp3_22050_32', 'opus_48000_32', 'opus_48000_64'])
+@pytest.mark.parametrize('count', [1, 3])
+def test_join_makes_one_valid_stream(output_format, count):
+    joiner = app.create_audio_joiner(output_format)
+    audio = joiner.join(fake_chunks(output_format, count))
+    assert check(output_format, audio) is None
+    report = joiner.report(len(audio))
+    assert report['chunks'] == count
+    assert report['bytes'] == len(audio)
+    if count > 1:
+        # 2つ目以降のチャンクのヘッダーを取り除いている
+        assert report['header_bytes_stripped'] > 0
+
+@pytest.mark.parametrize('output_format', ['mp3_44100_128', 'opus_48000_32'])
+@pytest.mark.parametrize('piece_size', [1, 7, 417, 4096])
+def test_feeding_pieces_matches_join(output_format, piece_size):
+    chunks = fake_chunks(output_format, 3)
+    expected = app.create_audio_joiner(output_format).join(chunks)
+
+    # ストリーミングでは上流から届いた大きさのまま feed する
+    joiner = app.create_audio_joiner(output_format)
+    parts = []
+    for chunk in chunks:
+        joiner.start()
+        for i in range(0, len(chunk), piece_size):
+            parts.append(joiner.feed(chunk[i:i + piece_size]))
+    parts.append(joiner.finish())
+    assert b''.join(parts) == expected
+
+@pytest.mark.parametrize('output_format', ['mp3_44100_128', 'mp3_22050_32', 'opus_48000_32', 'opus_48000_64'])
+@pytest.mark.parametrize('cut', [0.5, 0.77, 1.0])
+def test_stream_cut_short_is_still_valid(output_format, cut):
+    # 2つ目のチャンクのフレーム・ページの途中で打ち切っても、届いた分で終わる1本のストリームになる
+    chunks = fake_chunks(output_format, 2)
+    joiner = app.create_audio_joiner(output_format)
+    joiner.start()
+    audio = joiner.feed(chunks[0])
+    joiner.start()
+    audio += joiner.feed(chunks[1][:int(len(chunks[1]) * cut) - 1])
+    audio += joiner.finish()
+    assert check(output_format, audio) is None
+    assert len(audio) > len(chunks[0]) // 2
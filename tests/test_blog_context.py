@@ -0,0 +1,46 @@
+"""build_context_with_blog のメモ（同じクエリの使い回し）のテスト"""
+from datetime import datetime
+
+import pytest
+
+import app
+
+@pytest.fixture
+def memo(monkeypatch):
+    """_build_context を呼ばれた回数を数えるだけのものに差し替え、今日の日付を変えられるようにする"""
+    built = []
+    now = [datetime(2025, 10, 20, 23, 59, tzinfo=app.JST)]
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now[0]
+
+    corpus = app.BlogCorpus([], 1)
+    monkeypatch.setattr(app, 'datetime', FixedDatetime)
+    monkeypatch.setattr(app, 'get_blog_corpus', lambda: corpus)
+    monkeypatch.setattr(app, '_build_context', lambda corpus, query: built.append(query) or f'context {len(built)}')
+    app.clear_blog_context_memo()
+    yield built, now
+    app.clear_blog_context_memo()
+
+def test_same_query_is_built_once(memo):
+    built, _ = memo
+    assert app.build_context_with_blog('ラーメン好き？') == app.build_context_with_blog('ラーメン好き')
+    assert built == ['ラーメン好き']
+
+def test_relative_date_query_is_rebuilt_after_midnight(memo):
+    built, now = memo
+    first = app.build_context_with_blog('昨日何した？')
+    assert app.build_context_with_blog('昨日何した？') == first
+
+    now[0] = datetime(2025, 10, 21, 0, 1, tzinfo=app.JST)
+    assert app.build_context_with_blog('昨日何した？') != first
+    assert len(built) == 2
+
+def test_other_queries_survive_midnight(memo):
+    built, now = memo
+    app.build_context_with_blog('10月中旬は何してた？')
+    now[0] = datetime(2025, 10, 21, 0, 1, tzinfo=app.JST)
+    app.build_context_with_blog('10月中旬は何してた？')
+    assert len(built) == 1
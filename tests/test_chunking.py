@@ -0,0 +1,67 @@
+"""plan_chunks（音声合成のチャンク分割）のテスト"""
+import pytest
+
+import app
+
+REPLY = ('いやー、まぁねー。高知の海はほんとにきれいだよ。天気いい日に海沿い歩くと気分転換になるし、'
+         'けっこうおすすめ！君はどこ出身なの？')
+LONG_REPLY = ('えっと、ブログにも書いたんだけど、先週は研究室の先輩と一緒に学会の準備をしてて、ポスターを三回くらい作り直したんだよね。'
+              '最初は文字ばっかりで全然伝わらなくて、図を増やしたらだいぶ見やすくなった。発表当日はけっこう緊張したけど、'
+              '質問もたくさんもらえて、次の研究のヒントになりそうなこともいろいろ聞けたから、やってよかったなって思う。')
+
+def test_short_text_is_one_chunk():
+    assert app.split_text('まぁ、ぼちぼちかな。') == ['まぁ、ぼちぼちかな。']
+
+@pytest.mark.parametrize('text', ['', '   ', '\n　'])
+def test_blank_text_has_no_chunks(text):
+    assert app.split_text(text) == []
+
+@pytest.mark.parametrize('text', [REPLY, LONG_REPLY])
+@pytest.mark.parametrize('first_length', [None, 0, 12])
+def test_chunks_cover_the_whole_text(text, first_length):
+    assert ''.join(app.split_text(text, first_length=first_length)) == text
+
+def test_first_chunk_is_the_first_short_phrase():
+    chunks = app.split_text(REPLY)
+    assert chunks[0] == 'いやー、'
+    assert len(chunks) == 2
+
+def test_first_chunk_joins_phrases_shorter_than_the_minimum():
+    assert app.split_text('うん、テニスサークルは週に二回くらい。ゆるい感じだから初心者でも全然大丈夫だよ。')[0] == \
+        'うん、テニスサークルは週に二回くらい。'
+
+def test_first_length_zero_disables_the_small_first_chunk():
+    assert app.split_text(REPLY, first_length=0) == [REPLY]
+    chunks = app.split_text(LONG_REPLY, first_length=0)
+    assert len(chunks[0]) > app.TTS_FIRST_CHUNK_LENGTH
+    assert len(chunks) < len(app.split_text(LONG_REPLY))
+
+def test_chunk_limits_grow_up_to_max_length():
+    chunks = app.split_text('あ' * 450)
+    # 区切りが無いので上限の文字数で切る（20 → 120 → 200 で頭打ち）
+    assert [len(chunk) for chunk in chunks] == [20, 120, 200, 110]
+
+def test_chunks_end_at_the_strongest_boundary_in_the_back_half():
+    text = 'きょうは、いい天気。だから、海まで歩いて行った。そのあとは、カフェでのんびり過ごした。'
+    chunks = app.split_text(text, max_length=30, first_length=0)
+    assert chunks == ['きょうは、いい天気。だから、海まで歩いて行った。', 'そのあとは、カフェでのんびり過ごした。']
+    assert all(len(chunk) <= 30 for chunk in chunks)
+
+def particle_boundaries(text):
+    """助詞の後の区切り（強さ 0）の位置までの文字列"""
+    return [text[:position] for position, rank in app.chunk_boundaries(text) if rank == 0]
+
+@pytest.mark.parametrize('text', ['お金', 'ご飯', 'お父さん', 'きれい好き', 'その時', 'この前', 'ひらがな漢字'])
+def test_no_boundary_inside_prefixes_and_words(text):
+    assert particle_boundaries(text) == []
+
+def test_boundary_after_particles():
+    assert particle_boundaries('ご飯を食べたお父さんと東京へ行った') == ['ご飯を', 'ご飯を食べたお父さんと', 'ご飯を食べたお父さんと東京へ']
+    assert particle_boundaries('お金がないからバイトする') == ['お金がないから']
+    assert particle_boundaries('その時は先輩の家で映画を見た') == ['その時は', 'その時は先輩の', 'その時は先輩の家で',
+                                                             'その時は先輩の家で映画を']
+
+def test_first_chunk_does_not_split_a_prefix():
+    # 句読点が無く、以前は「お|金」の間で切っていた
+    chunks = app.split_text('きのうはみんなでお金を出し合って先輩の誕生日ケーキを買ったんだよ', first_length=12)
+    assert chunks[0] == 'きのうはみんなでお金を'
@@ -0,0 +1,24 @@
+"""correct_reading（読み仮名の置き換え）のテスト"""
+import pytest
+
+from app import correct_reading
+
+@pytest.mark.parametrize('text, expected', [
+    ('海沿いを散歩した', 'うみぞいを散歩した'),
+    ('海がきれい', 'うみがきれい'),
+    ('農林海洋科学部に通う', 'のうりんかいようかがくぶにかよう'),
+    ('丹羽康揮です', 'にわこうきです'),
+    ('丹羽です、庭園の庭', 'にわです、ていえんのにわ'),
+    ('高知大学は高知にある', 'こうちだいがくはこうちにある'),
+    ('丸源ラーメンと丸源', 'まるげんラーメンとまるげん'),
+    ('仕方なくないけど仕方ない', 'しかたなくないけどしかたない'),
+    ('岐阜県の岐阜', 'ぎふけんのぎふ'),
+    ('Rocket Lab を応援してる', 'ロケットラボ をおうえんしてる'),
+    ('いやー、まぁねー', 'いやー、まぁねー'),
+])
+def test_longest_match(text, expected):
+    # 長い語を優先し、置き換えた後の文字列を再び置き換えない
+    assert correct_reading(text) == expected
+
+def test_empty_text():
+    assert correct_reading('') == ''
@@ -0,0 +1,185 @@
+"""UpstreamLimiter（上流 API の枠・待ち行列・期限・再試行）のテスト"""
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+import app
+from app import UpstreamLimiter, UpstreamOverloaded
+
+def make_limiter(**options):
+    # 既定ではレートに余裕があり、同時実行は1つ・待てるのは1件・期限は 0.2 秒
+    settings = {'rate': 1000.0, 'burst': 1000, 'max_in_flight': 1, 'max_queue': 1, 'queue_timeout': 0.2,
+                'max_retries': 0}
+    settings.update(options)
+    return UpstreamLimiter('test', **settings)
+
+def test_rejects_without_waiting_when_queue_is_full():
+    limiter = make_limiter(max_queue=0, queue_timeout=5)
+    with limiter.slot():
+        start = time.monotonic()
+        with pytest.raises(UpstreamOverloaded) as excinfo:
+            limiter.acquire()
+        assert time.monotonic() - start < 0.5
+    assert excinfo.value.reason == 'queue_full'
+    assert excinfo.value.service == 'test'
+    assert limiter.counters['rejected_queue_full'] == 1
+    assert limiter.queued == 0
+
+def test_rejects_when_queue_is_full_of_waiting_requests():
+    limiter = make_limiter(queue_timeout=5)
+    errors = []
+
+    def wait_for_slot():
+        try:
+            with limiter.slot():
+                pass
+        except UpstreamOverloaded as e:
+            errors.append(e)
+
+    with limiter.slot():
+        waiter = threading.Thread(target=wait_for_slot)
+        waiter.start()
+        while not limiter.queued:
+            time.sleep(0.01)
+        with pytest.raises(UpstreamOverloaded) as excinfo:
+            limiter.acquire()
+    waiter.join()
+    assert excinfo.value.reason == 'queue_full'
+    # 待っていた方は枠が空いた時点で通る
+    assert errors == []
+    assert limiter.counters['admitted'] == 2
+
+def test_rejects_when_deadline_passes_in_queue():
+    limiter = make_limiter(queue_timeout=0.2)
+    with limiter.slot():
+        start = time.monotonic()
+        with pytest.raises(UpstreamOverloaded) as excinfo:
+            limiter.acquire()
+        elapsed = time.monotonic() - start
+    assert excinfo.value.reason == 'timeout'
+    assert 0.15 <= elapsed < 1
+    assert limiter.counters['rejected_timeout'] == 1
+    assert limiter.queued == 0
+    # 枠が空けば次は待たずに通る
+    limiter.acquire()
+    limiter.release()
+
+def test_waits_for_token_bucket_within_deadline():
+    limiter = make_limiter(rate=20.0, burst=1, max_in_flight=10, queue_timeout=1)
+    with limiter.slot():
+        pass
+    start = time.monotonic()
+    with limiter.slot():
+        pass
+    # 次のトークンまで 1 / rate 秒待つ
+    assert time.monotonic() - start >= 0.03
+    assert limiter.counters['waited'] == 1
+
+def test_token_bucket_rejects_when_next_token_is_after_deadline():
+    limiter = make_limiter(rate=1.0, burst=1, max_in_flight=10, queue_timeout=0.1)
+    with limiter.slot():
+        pass
+    with pytest.raises(UpstreamOverloaded) as excinfo:
+        limiter.acquire()
+    assert excinfo.value.reason == 'timeout'
+
+def test_async_rejects_when_deadline_passes_in_queue():
+    limiter = make_limiter(queue_timeout=0.2)
+
+    async def run():
+        async with limiter.slot_async():
+            with pytest.raises(UpstreamOverloaded) as excinfo:
+                await limiter.acquire_async()
+            return excinfo.value
+
+    assert asyncio.run(run()).reason == 'timeout'
+    assert limiter.queued == 0
+    assert limiter.in_flight == 0
+
+def test_async_rejects_when_queue_is_full():
+    limiter = make_limiter(max_queue=0)
+
+    async def run():
+        async with limiter.slot_async():
+            with pytest.raises(UpstreamOverloaded) as excinfo:
+                await limiter.acquire_async()
+            return excinfo.value
+
+    assert asyncio.run(run()).reason == 'queue_full'
+
+def test_call_retries_then_gives_up(monkeypatch):
+    monkeypatch.setattr(app, 'UPSTREAM_BACKOFF_BASE', 0.001)
+    limiter = make_limiter(max_retries=2, queue_timeout=5)
+    calls = []
+
+    with pytest.raises(UpstreamOverloaded) as excinfo:
+        limiter.call(lambda: calls.append(1), lambda result, error: 0)
+    assert excinfo.value.reason == 'retries'
+    assert len(calls) == 3
+    assert limiter.counters['retries'] == 2
+    assert limiter.in_flight == 0
+
+def test_call_does_not_retry_past_deadline():
+    limiter = make_limiter(max_retries=5)
+    calls = []
+
+    # 上流が 10 秒後を指定してきたら、期限（0.2 秒）までにやり直せないのですぐ諦める
+    start = time.monotonic()
+    with pytest.raises(UpstreamOverloaded) as excinfo:
+        limiter.call(lambda: calls.append(1), lambda result, error: 10)
+    assert excinfo.value.reason == 'retries'
+    assert len(calls) == 1
+    assert time.monotonic() - start < 1
+
+def test_call_returns_result_and_raises_other_errors():
+    limiter = make_limiter()
+    assert limiter.call(lambda: 'ok', lambda result, error: None) == 'ok'
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        limiter.call(fail, lambda result, error: None)
+    assert limiter.in_flight == 0
+
+def test_call_async_closes_responses_it_retries(monkeypatch):
+    monkeypatch.setattr(app, 'UPSTREAM_BACKOFF_BASE', 0.001)
+    limiter = make_limiter(max_retries=2, queue_timeout=5)
+    statuses = iter([503, 429, 200])
+    transport = httpx.MockTransport(lambda request: httpx.Response(next(statuses), content=b'audio'))
+    responses = []
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            async def post():
+                # ストリーミングの応答（本文を読む前に返る）
+                response = await client.send(client.build_request('POST', 'http://tts/'), stream=True)
+                responses.append(response)
+                return response
+
+            response = await limiter.call_async(post, app.http_retry_after)
+            body = await response.aread()
+            await response.aclose()
+            return response.status_code, body
+
+    assert asyncio.run(run()) == (200, b'audio')
+    assert [response.status_code for response in responses] == [503, 429, 200]
+    assert all(response.is_closed for response in responses)
+
+def test_call_async_gives_up_with_overloaded(monkeypatch):
+    monkeypatch.setattr(app, 'UPSTREAM_BACKOFF_BASE', 0.001)
+    limiter = make_limiter(max_retries=1, queue_timeout=5)
+    transport = httpx.MockTransport(lambda request: httpx.Response(503))
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await limiter.call_async(
+                lambda: client.send(client.build_request('POST', 'http://tts/'), stream=True), app.http_retry_after)
+
+    with pytest.raises(UpstreamOverloaded) as excinfo:
+        asyncio.run(run())
+    assert excinfo.value.reason == 'retries'
+    assert limiter.in_flight == 0